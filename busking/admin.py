@@ -4,8 +4,9 @@ from django.contrib.auth.admin import GroupAdmin, UserAdmin
 
 from cmm.admin import SuperUserAdminSite
 from cmm.models import AuthUser, AuthGroup
-from cmm.csv import (download_csv, download_excel, DOWNLOAD_CSV, DOWNLOAD_EXCEL, CsvMixin)
-from cmm.csv import CsvLog, CsvLogModelAdmin
+from cmm.csv import (download_csv, download_excel, DOWNLOAD_CSV, DOWNLOAD_EXCEL,
+                     download_csv_gzip, download_csv_zip, DOWNLOAD_CSV_GZIP, DOWNLOAD_CSV_ZIP, CsvMixin)
+from cmm.csv import CsvLog, CsvLogModelAdmin, CsvLotSummary, CsvLotSummaryModelAdmin
 
 
 class AuthUserAdmin(CsvMixin, UserAdmin):
@@ -40,7 +41,10 @@ buskingSite = BuskingAdminSite(name='buskingSite')
 
 buskingSite.add_action(download_csv, DOWNLOAD_CSV)
 buskingSite.add_action(download_excel, DOWNLOAD_EXCEL)
+buskingSite.add_action(download_csv_gzip, DOWNLOAD_CSV_GZIP)
+buskingSite.add_action(download_csv_zip, DOWNLOAD_CSV_ZIP)
 
 buskingSite.register(AuthUser, AuthUserAdmin)
 buskingSite.register(AuthGroup, AuthGroupAdmin)
 buskingSite.register(CsvLog, CsvLogModelAdmin)
+buskingSite.register(CsvLotSummary, CsvLotSummaryModelAdmin)
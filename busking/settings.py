@@ -266,22 +266,42 @@ LOGGING = {
             'filters': ['require_debug_true', 'extra_attributes'],
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
-        }
+        },
+        # 整形とファイル出力をバックグラウンドスレッドで行う、extra_attributesはリクエストのスレッドで設定する
+        # handlerは名前順に作成されるため、出力先のhandler名 + '_async'とする
+        'sql_log_async': {
+            '()': 'cmm.logging.QueueListenerHandler',
+            'handlers': ['sql_log'],
+            'queue_size': 10000,
+            'filters': ['require_debug_true', 'extra_attributes'],
+        },
+        'root_log_async': {
+            '()': 'cmm.logging.QueueListenerHandler',
+            'handlers': ['root_log'],
+            'queue_size': 10000,
+            'filters': ['extra_attributes'],
+        },
+        'app_log_async': {
+            '()': 'cmm.logging.QueueListenerHandler',
+            'handlers': ['app_log'],
+            'queue_size': 10000,
+            'filters': ['extra_attributes'],
+        },
     },
     'root': {
-        'handlers': ['console', 'root_log'],
+        'handlers': ['console', 'root_log_async'],
         'level': 'INFO',
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'app_log'],
+            'handlers': ['console', 'app_log_async'],
             # 'level': getenv('DJANGO_LOG_LEVEL', 'INFO'),
             'level': 'INFO',
             'propagate': True,
         },
         'django.db.backends': {
             # 'handlers': ['sql_log'],
-            'handlers': ['sql_log'],
+            'handlers': ['sql_log_async'],
             'level': 'DEBUG',
             'propagate': False,
         },
@@ -291,3 +311,11 @@ LOGGING = {
 
 # Disable logging for "Not Found: /favicon.ico"
 logging.getLogger('django.request').setLevel(logging.ERROR)
+
+# CSVアップロードのバックグラウンドジョブ
+CSV_UPLOAD_WORKERS = 2
+CSV_UPLOAD_SPOOL_DIR = path.join(BASE_DIR, 'temp', 'csv_upload')
+
+# CSVログ(cmm_csv_log)の保存日数と削除前の退避先、purge_csv_logコマンドで使用する
+CSV_LOG_RETENTION_DAYS = 90
+CSV_LOG_ARCHIVE_DIR = path.join(BASE_DIR, 'temp', 'csv_log_archive')
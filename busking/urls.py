@@ -14,7 +14,7 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 # from django.contrib import admin
-from django.urls import path
+from django.urls import include, path
 from django.views.generic.base import RedirectView
 from busking.admin import buskingSite
 
@@ -22,4 +22,5 @@ urlpatterns = [
     # path('admin/', admin.site.urls),
     path('', RedirectView.as_view(url='/admin')),
     path('admin/', buskingSite.urls),
+    path('api/', include('cmm_data.urls')),
 ]
@@ -10,5 +10,9 @@ class CmmConfig(AppConfig):
     def ready(self):
         from .signals import ldap_auth_handler
         from django_auth_ldap.backend import populate_user
+        from django.db.models.signals import post_migrate
+        from cmm.models import clear_unique_constraint_cache
         # Explicitly connect a signal handler.
         populate_user.connect(ldap_auth_handler)
+        # マイグレーションでUnique制約が変わる可能性があるため、キャッシュをクリアする
+        post_migrate.connect(clear_unique_constraint_cache, dispatch_uid='cmm_clear_unique_constraint_cache')
@@ -0,0 +1,78 @@
+import threading
+import time
+from typing import Any, Generic, Hashable, Optional, TypeVar
+
+
+T = TypeVar('T')
+
+
+class StampedCache(Generic[T]):
+    """
+    テーブル全体を読み込んで作成する、プロセス内の読み取り専用キャッシュのベースクラス
+    get_stamp()の値(件数、最終更新日時など)が変わった場合に作り直す
+    stampの確認、作り直しはcheck_interval秒ごとに1つのスレッドだけが行い、その間も他のスレッドは作成済みのキャッシュを参照する
+    (未作成の場合のみ、作成が終わるまで待つ)
+    """
+
+    # stampを確認する間隔(秒)、0の場合は毎回確認する
+    check_interval: float = 60
+
+    def __init__(self):
+        self._value: Optional[T] = None
+        self._stamp: Optional[Hashable] = None
+        self._checked_at = 0.0
+        # 現在のキャッシュの作成を開始した時刻、古いデータで作成したキャッシュで入れ替えないため
+        self._built_from = 0.0
+        self._lock = threading.Lock()
+
+    def get_stamp(self) -> Hashable:
+        """キャッシュ元のデータのバージョン、DBを参照する軽い問い合わせにすること"""
+        raise NotImplementedError
+
+    def build(self) -> T:
+        raise NotImplementedError
+
+    def get(self) -> T:
+        value = self._value
+        if value is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return value
+        if value is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(blocking=False):
+            return value        # 他のスレッドが確認中、作り直し中
+        try:
+            # 待っている間に他のスレッドが作り直した場合はそれを使う
+            if self._value is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._value
+            stamp = self.get_stamp()
+            if self._value is None or stamp != self._stamp:
+                started = time.monotonic()
+                self.__swap(self.build(), stamp, started)
+            self._checked_at = time.monotonic()
+            return self._value      # type: ignore[return-value]
+        finally:
+            self._lock.release()
+
+    def refresh(self) -> None:
+        """
+        データを更新した処理から呼び出す、作成済みの場合は新しいキャッシュを作成してから入れ替える
+        作成はロックの外で行い、その間も他のスレッドは作成済みのキャッシュを参照する
+        """
+        if self._value is None:
+            return
+        started = time.monotonic()
+        stamp = self.get_stamp()
+        value = self.build()
+        with self._lock:
+            self.__swap(value, stamp, started)
+            self._checked_at = time.monotonic()
+
+    def __swap(self, value: T, stamp: Hashable, started: float) -> None:
+        """ロック内で呼び出す、現在のキャッシュより後に作成を開始したものだけで入れ替える"""
+        if self._value is None or started >= self._built_from:
+            self._value, self._stamp, self._built_from = value, stamp, started
+
+    def invalidate(self, **kwargs: Any) -> None:
+        """次回のget()でstampを確認させる、シグナルのreceiverとしても使える"""
+        # pylint: disable = unused-argument
+        self._checked_at = 0.0
@@ -5,9 +5,10 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib import admin
 from cmm.models import SimpleTable
+from cmm.paginator import ApproximateCountMixin
 
 
-class CsvLogModelAdmin(admin.ModelAdmin):
+class CsvLogModelAdmin(ApproximateCountMixin, admin.ModelAdmin):
     """
     CSVアップロード、ダウンロードのログをAdminSiteに表示する
     """
@@ -38,3 +39,25 @@ class CsvLogModelAdmin(admin.ModelAdmin):
             form_url=form_url,
             extra_context=extra_context,
         )
+
+
+class CsvLotSummaryModelAdmin(admin.ModelAdmin):
+    """
+    CSVアップロードのロットごとの取込結果をAdminSiteに表示する
+    """
+
+    list_display = ('file_name', 'model_name', 'creator', 'started_at', 'duration', 'read_count', 'inserted_count',
+                    'updated_count', 'deleted_count', 'skipped_count', 'error_count', 'throughput')
+    list_display_links = None
+    list_per_page = 20
+    search_fields = ['file_name', 'creator', 'lot_number']
+    list_filter = ('model_name', 'creator', 'started_at')
+
+    def has_add_permission(self, request, obj=None):
+        '''hide the add button'''
+        # pylint: disable = unused-argument
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        # pylint: disable = unused-argument
+        return False
@@ -1,7 +1,10 @@
 import csv
-from datetime import date, datetime
 from enum import Enum, StrEnum, auto
-from typing import List
+from functools import partial
+from operator import methodcaller
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from django.db.models import F, Q
+from django.db.models.constants import LOOKUP_SEP
 from cmm.models import SimpleTable, VersionedTable
 
 
@@ -24,6 +27,21 @@ class CsvLogOutput(Enum):
     DATABASE = 3
 
 
+class CsvLogStorage(StrEnum):
+    """ アップロード時のCsvLogの記録方法 """
+
+    FULL = auto()           # 全行を記録する
+    COMPACT = auto()        # 警告、エラー行のみ記録し、正常行はロットごとに件数のサマリー行を1行記録する
+
+
+class CsvPagination(StrEnum):
+    """ ダウンロード時のquerysetの読み込み方法 """
+
+    OFFSET = auto()         # queryset[offset:offset + chunk_size]、offsetが大きくなるほど遅くなる
+    KEYSET = auto()         # 並び順のキー値で次のchunkを検索する(seek method)
+    CURSOR = auto()         # queryset.iterator(chunk_size)、PostgreSQLではサーバーサイドカーソルを使用する
+
+
 class CsvBase:
     """
     CSVファイルのアップロードとダウンロード処理の共通ベースクラス、
@@ -38,6 +56,7 @@ class CsvBase:
     date_format: str = '%Y/%m/%d'
     datetime_format: str = '%Y/%m/%d %H:%M:%S'
     log_output: CsvLogOutput = CsvLogOutput.DATABASE
+    pagination: CsvPagination = CsvPagination.KEYSET
 
     @property
     def model_name(self) -> str:
@@ -73,13 +92,127 @@ class CsvBase:
     def get_csv_headers(self) -> List[str]:
         return self.csv_headers if hasattr(self, 'csv_headers') else self.get_csv_field_names()
 
-    def generate_csv_data(self, queryset):
-        offset = 0
+    def get_keyset_ordering(self, queryset) -> List[Tuple[str, bool]]:
+        """
+        keyset paginationに使う並び順、(項目名, 降順)のリスト
+        querysetの並び順(なければMeta.ordering)に一意性を保証するためのpkを付け加える
+        項目名以外(式、関連先の項目等)が含まれる場合はpkのみで並べる
+        """
+        opts = self.model._meta
+        ordering = queryset.query.order_by or (queryset.query.default_ordering and opts.ordering) or []
+
+        keys: List[Tuple[str, bool]] = []
+        for order in ordering:
+            if not isinstance(order, str) or order == '?' or LOOKUP_SEP in order:
+                return [('pk', False)]
+            name = order.lstrip('-')
+            name = 'pk' if name in ('pk', opts.pk.name) else name
+            if name != 'pk' and not any(f.name == name and f.concrete and not f.is_relation for f in opts.get_fields()):
+                return [('pk', False)]
+            keys.append((name, order.startswith('-')))
+            if name == 'pk':
+                break
+        else:
+            keys.append(('pk', False))
+        return keys
+
+    def get_keyset_filter(self, keys: List[Tuple[str, bool]], values: Dict[str, Any]) -> Q:
+        """
+        直前のchunkの最終行より後ろの行を検索する条件
+        NULLはASC/DESCともに最後に並べる(nulls_last)前提とする
+        """
+        opts = self.model._meta
+        condition = Q()
+        for (name, descending) in reversed(keys):
+            value = values[name]
+            if value is None:
+                condition = Q(**{f'{name}__isnull': True}) & condition
+                continue
+
+            after = Q(**{f'{name}__lt' if descending else f'{name}__gt': value})
+            if name != 'pk' and opts.get_field(name).null:
+                after |= Q(**{f'{name}__isnull': True})
+            condition = after | (Q(**{name: value}) & condition) if condition else after
+        return condition
+
+    def iter_model_rows(self, queryset) -> Iterator[Tuple[Any, ...]]:
+        """pagination方式に従って、querysetをchunk_size行ずつ読み込み、CSV項目順のtupleで返す"""
+        field_names = self.get_csv_field_names()
+
+        if self.pagination == CsvPagination.CURSOR:
+            yield from queryset.values_list(*field_names).iterator(chunk_size=self.chunk_size)
+            return
+
+        if self.pagination == CsvPagination.OFFSET or queryset.query.is_sliced:
+            offset = 0
+            while True:
+                chunk_queryset = queryset[offset:offset + self.chunk_size].values_list(*field_names)
+                if not chunk_queryset:
+                    break
+                yield from chunk_queryset
+                offset += self.chunk_size
+            return
+
+        keys = self.get_keyset_ordering(queryset)
+        key_names = [name for (name, _) in keys]
+        ordered = queryset.order_by(*[F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_last=True)
+                                      for (name, descending) in keys])
+        extra_names = [name for name in key_names if name not in field_names]
+        value_names = list(field_names) + extra_names
+        key_indexes = [value_names.index(name) for name in key_names]
+        field_count = len(field_names)
+        condition = Q()
         while True:
-            chunk_queryset = queryset[offset:offset + self.chunk_size].values(*self.get_csv_field_names())
-            if not chunk_queryset:
+            chunk = list(ordered.filter(condition).values_list(*value_names)[:self.chunk_size])
+            if extra_names:
+                for row in chunk:
+                    yield row[:field_count]
+            else:
+                yield from chunk
+            if len(chunk) < self.chunk_size:
                 break
-            for row in chunk_queryset:
-                yield [v.strftime(self.datetime_format) if isinstance(v, datetime) else
-                       (v.strftime(self.date_format) if isinstance(v, date) else v) for (k, v) in row.items()]
-            offset += self.chunk_size
+            condition = self.get_keyset_filter(keys, {name: chunk[-1][i] for (name, i) in zip(key_names, key_indexes)})
+
+    def iter_model_values(self, queryset) -> Iterator[Dict[str, Any]]:
+        """iter_model_rowsの各行を{項目名: 値}のdictで返す"""
+        field_names = self.get_csv_field_names()
+        for row in self.iter_model_rows(queryset):
+            yield dict(zip(field_names, row))
+
+    def get_csv_formatters(self) -> List[Tuple[int, Callable[[Any], Any]]]:
+        """
+        CSV出力時に変換が必要な列の(列番号, 変換関数)のリスト、項目の型から一度だけ作成する
+        文字列、数値、真偽値、choicesの値はそのままcsv.writerに渡す(アップロード時にそのまま読み込めるように)
+        """
+        opts = self.model._meta
+        formatters: List[Tuple[int, Callable[[Any], Any]]] = []
+        for (col_num, name) in enumerate(self.get_csv_field_names()):
+            field = opts.get_field(name)
+            internal_type = field.get_internal_type()
+            if internal_type == 'DateTimeField':
+                formatter = methodcaller('strftime', self.datetime_format)
+            elif internal_type == 'DateField':
+                formatter = methodcaller('strftime', self.date_format)
+            else:
+                continue
+            if field.null:
+                formatter = partial(_format_nullable, formatter)
+            formatters.append((col_num, formatter))
+        return formatters
+
+    def generate_csv_data(self, queryset) -> Iterator[List[Any]]:
+        """CSV出力用の行データ、変換が必要な列のみ変換関数を適用し、値ごとの型判定は行わない"""
+        formatters = self.get_csv_formatters()
+        if not formatters:
+            yield from map(list, self.iter_model_rows(queryset))
+            return
+
+        for row in self.iter_model_rows(queryset):
+            row = list(row)
+            for (col_num, formatter) in formatters:
+                row[col_num] = formatter(row[col_num])
+            yield row
+
+
+def _format_nullable(formatter: Callable[[Any], Any], value: Any) -> Any:
+    return None if value is None else formatter(value)
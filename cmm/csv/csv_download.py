@@ -1,20 +1,108 @@
 import logging
 import csv
+import io
+import tempfile
+import zipfile
+import zlib
+from enum import StrEnum, auto
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Tuple
 from urllib.parse import quote
+from asgiref.sync import sync_to_async
 from django.contrib import admin
-from django.http import HttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
 from xlsxwriter.workbook import Workbook
 from cmm.csv import CsvBase
-from cmm.logging import log_decorator
+from cmm.csv.pg_copy import get_pg_encoding, is_copy_available, iter_copy_csv
+from cmm.logging import log_decorator, set_log_row_count
 
 
 # 定数の定義はmethod名と一致する必要がある
 DOWNLOAD_CSV = 'download_csv'
 DOWNLOAD_EXCEL = 'download_excel'
+DOWNLOAD_CSV_GZIP = 'download_csv_gzip'
+DOWNLOAD_CSV_ZIP = 'download_csv_zip'
 _logger = logging.getLogger(__name__)
 
 
+class CsvDownloadEngine(StrEnum):
+    """ CSVデータの生成方法 """
+
+    PYTHON = auto()     # querysetの値をPythonで変換してcsv.writerで出力する
+    COPY = auto()       # PostgreSQLのCOPY (SELECT ...) TO STDOUTでDB側でCSVを生成する、PostgreSQL以外ではPYTHONで出力する
+
+
+async def aiter_sync_content(iterator: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    ASGI用、DBアクセスを伴うchunkの生成はsync_to_asyncで実行する
+    クライアントの切断などで途中で終了した場合も、iteratorをclose()してCOPYのスレッド、接続などを後始末させる
+    """
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            chunk = await next_chunk(iterator, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=True)()
+
+
+class _ZipStream:
+    """
+    ZipFileの出力先、seekできないストリームとして扱わせて、書き込まれたbytesを順次取り出す
+    (ZipFileはseekできない出力先の場合、data descriptorを使ってエントリーを書き出す)
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def iter_zip_content(entries: Iterable[Tuple[str, Iterable[bytes]]]) -> Iterator[bytes]:
+    """(ファイル名, 内容のbytesのiterator)ごとにZIPのエントリーを作成し、圧縮しながら順次返す"""
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for (file_name, content) in entries:
+            with zip_file.open(file_name, 'w', force_zip64=True) as entry:
+                for chunk in content:
+                    entry.write(chunk)
+                    if stream.buffer:
+                        yield stream.pop()
+            yield stream.pop()
+    # 中央ディレクトリ
+    yield stream.pop()
+
+
+def generate_zip_response(file_name: str, targets: Iterable[Tuple['CsvDownloadMixin', object]],
+                          is_async: bool = False) -> StreamingHttpResponse:
+    """
+    複数の(model_admin, queryset)のCSVを1つのZIPファイルにまとめてストリーミングで出力する
+    使用例: generate_zip_response('master.zip', [(postcode_admin, postcodes), (shikuchoson_admin, shikuchosons)])
+    """
+    content = iter_zip_content((model_admin.get_csv_file_name(), model_admin.iter_csv_content(queryset))
+                               for (model_admin, queryset) in targets)
+    http_response = StreamingHttpResponse(aiter_sync_content(content) if is_async else content,
+                                          content_type='application/zip')
+    # quote()を使わないとファイル名がセットされない
+    http_response['Content-Disposition'] = f'attachment; filename={quote(file_name)}'
+    return http_response
+
+
 # pragma: no cover
 class CsvDownloadMixin(CsvBase):
     """
@@ -23,21 +111,53 @@ class CsvDownloadMixin(CsvBase):
     {opts.app_label}.{DOWNLOAD_CSV}_{opts.model_name}の権限有無により、各Actionの表示非表示をコントロールする
     """
 
+    # Trueの場合、StreamingHttpResponseでchunkごとに出力し、ファイル全体をメモリに保持しない
+    is_streaming: bool = False
+    # gzipの圧縮レベル(1-9)、大きいほど圧縮率が高く遅い
+    gzip_compress_level: int = 6
+    download_engine: CsvDownloadEngine = CsvDownloadEngine.PYTHON
+
     def get_actions(self, request):
-        """CSVダウンロード権限がない場合、Django admin list viewのアクションリストから非表示にする"""
+        """
+        CSVダウンロード権限がない場合、Django admin list viewのアクションリストから非表示にする
+        圧縮ダウンロード(gzip、zip)もCSVダウンロード権限で制御する
+        """
         actions = super().get_actions(request)
         # pylint: disable = protected-access
         opts = self.model._meta
         if not request.user.has_perm(f'{opts.app_label}.{DOWNLOAD_CSV}_{opts.model_name}'):
-            if DOWNLOAD_CSV in actions:
-                del actions[DOWNLOAD_CSV]
+            for action in (DOWNLOAD_CSV, DOWNLOAD_CSV_GZIP, DOWNLOAD_CSV_ZIP):
+                if action in actions:
+                    del actions[action]
         return actions
 
-    def generate_csv_response(self, queryset) -> HttpResponse:
+    def is_copy_download(self) -> bool:
+        """
+        COPY TO STDOUTでCSVデータを生成するか、PostgreSQL(psycopg2)以外ではPythonで生成する
+        PostgreSQLに対応するencodingがない場合(utf-8-sigなど)も、ヘッダー行と同じencodingで出力するためPythonで生成する
+        """
+        return self.download_engine == CsvDownloadEngine.COPY and is_copy_available() \
+            and get_pg_encoding(self.encoding) is not None
+
+    def get_csv_gzip_file_name(self) -> str:
+        return self.get_csv_file_name() + '.gz'
+
+    def get_zip_file_name(self) -> str:
+        return self.model_name + '.zip'
+
+    def generate_csv_response(self, queryset, request=None) -> HttpResponse | StreamingHttpResponse:
+        if self.is_streaming:
+            return self.generate_csv_streaming_response(queryset, is_async=isinstance(request, ASGIRequest))
+
         http_response = HttpResponse(content_type=self.get_csv_content_type())
         # quote()を使わないとファイル名がセットされない
         http_response['Content-Disposition'] = f'attachment; filename={quote(self.get_csv_file_name())}'
 
+        if self.is_copy_download():
+            for chunk in self.iter_csv_content(queryset):
+                http_response.write(chunk)
+            return http_response
+
         writer = csv.writer(http_response, self.dialect)
 
         # ヘッダーを出力
@@ -45,11 +165,85 @@ class CsvDownloadMixin(CsvBase):
             writer.writerow(self.get_csv_headers())
 
         # CSVデータを出力
+        row_count = 0
+        for row in self.generate_csv_data(queryset):
+            writer.writerow(row)
+            row_count += 1
+        # ストリーミング、COPYの場合は出力前に戻るため、行数は記録しない
+        set_log_row_count(row_count)
+
+        return http_response
+
+    def iter_csv_content(self, queryset) -> Iterator[bytes]:
+        """ヘッダーとCSVデータをchunk_size行ごとにエンコード済みのbytesとして返す"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, self.dialect)
+
+        def flush() -> bytes:
+            content = buffer.getvalue().encode(self.encoding)
+            buffer.seek(0)
+            buffer.truncate()
+            return content
+
+        if self.get_csv_headers():
+            writer.writerow(self.get_csv_headers())
+            yield flush()
+
+        if self.is_copy_download():
+            yield from iter_copy_csv(queryset, self.get_csv_field_names(), self.date_format, self.datetime_format,
+                                     self.encoding)
+            return
+
+        row_cnt = 0
         for row in self.generate_csv_data(queryset):
             writer.writerow(row)
+            row_cnt += 1
+            if row_cnt % self.chunk_size == 0:
+                yield flush()
+
+        if buffer.tell():
+            yield flush()
+
+    async def aiter_csv_content(self, queryset) -> AsyncIterator[bytes]:
+        """ASGI用、DBアクセスを伴うchunkの生成はsync_to_asyncで実行する"""
+        async for chunk in aiter_sync_content(self.iter_csv_content(queryset)):
+            yield chunk
+
+    def iter_csv_gzip_content(self, queryset) -> Iterator[bytes]:
+        """iter_csv_contentのchunkを順次gzip圧縮して返す、圧縮結果が溜まっていないchunkは返さない"""
+        compressor = zlib.compressobj(self.gzip_compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in self.iter_csv_content(queryset):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def generate_csv_streaming_response(self, queryset, is_async: bool = False) -> StreamingHttpResponse:
+        """
+        CSVデータをストリーミングで出力する、メモリ使用量はchunk_size行分に抑えられる
+        ASGI配下ではasync iteratorを渡して、DjangoによるイテレータのSync/Async変換を避ける
+        """
+        content = self.aiter_csv_content(queryset) if is_async else self.iter_csv_content(queryset)
+        http_response = StreamingHttpResponse(content, content_type=self.get_csv_content_type())
+        # quote()を使わないとファイル名がセットされない
+        http_response['Content-Disposition'] = f'attachment; filename={quote(self.get_csv_file_name())}'
+        return http_response
 
+    def generate_csv_gzip_response(self, queryset, request=None) -> StreamingHttpResponse:
+        """gzip圧縮したCSVファイルをストリーミングで出力する"""
+        content = self.iter_csv_gzip_content(queryset)
+        if isinstance(request, ASGIRequest):
+            content = aiter_sync_content(content)
+        http_response = StreamingHttpResponse(content, content_type='application/gzip')
+        # quote()を使わないとファイル名がセットされない
+        http_response['Content-Disposition'] = f'attachment; filename={quote(self.get_csv_gzip_file_name())}'
         return http_response
 
+    def generate_csv_zip_response(self, queryset, request=None) -> StreamingHttpResponse:
+        """CSVファイルをZIPファイルに圧縮してストリーミングで出力する"""
+        return generate_zip_response(self.get_zip_file_name(), [(self, queryset)],
+                                     is_async=isinstance(request, ASGIRequest))
+
 
 @admin.display(description=_('download csv'))
 @log_decorator
@@ -60,11 +254,35 @@ def download_csv(model_admin, request, queryset) -> HttpResponse:
     """
     file_name = model_admin.get_csv_file_name()
     _logger.info('%s download has started.', file_name)
-    response = model_admin.generate_csv_response(queryset)
+    response = model_admin.generate_csv_response(queryset, request)
     _logger.info('%s download finished.', file_name)
     return response
 
 
+@admin.display(description=_('download csv (gzip)'))
+@log_decorator
+def download_csv_gzip(model_admin, request, queryset) -> StreamingHttpResponse:
+    """
+    django admin site用gzip圧縮csv download action
+    使用例: admin.site.add_action(download_csv_gzip, DOWNLOAD_CSV_GZIP)
+    """
+    file_name = model_admin.get_csv_gzip_file_name()
+    _logger.info('%s download has started.', file_name)
+    return model_admin.generate_csv_gzip_response(queryset, request)
+
+
+@admin.display(description=_('download csv (zip)'))
+@log_decorator
+def download_csv_zip(model_admin, request, queryset) -> StreamingHttpResponse:
+    """
+    django admin site用zip圧縮csv download action
+    使用例: admin.site.add_action(download_csv_zip, DOWNLOAD_CSV_ZIP)
+    """
+    file_name = model_admin.get_zip_file_name()
+    _logger.info('%s download has started.', file_name)
+    return model_admin.generate_csv_zip_response(queryset, request)
+
+
 # pragma: no cover
 class ExcelDownloadMixin(CsvBase):
     """
@@ -73,6 +291,19 @@ class ExcelDownloadMixin(CsvBase):
     {opts.app_label}.{DOWNLOAD_EXCEL}_{opts.model_name}の権限有無により、各Actionの表示非表示をコントロールする
     """
 
+    # Trueの場合、xlsxwriterのconstant_memoryモードで一時ファイルに出力し、セルをメモリに保持しない
+    is_constant_memory: bool = False
+    # 1シートの最大行数(ヘッダー行を含む)、超えた場合は次のシートに出力する
+    excel_max_rows: int = 1048576
+    # 項目の型(get_internal_type)ごとの列の表示形式
+    excel_num_formats: Dict[str, str] = {
+        'DateField': 'yyyy/mm/dd',
+        'DateTimeField': 'yyyy/mm/dd hh:mm:ss',
+        'TimeField': 'hh:mm:ss',
+    }
+    # xlsxwriterが直接書き込めない型、文字列に変換して出力する
+    excel_str_types = ('UUIDField', 'JSONField', 'DurationField', 'BinaryField')
+
     def get_actions(self, request):
         """EXCELダウンロード権限がない場合、Django admin list viewのアクションリストから非表示にする"""
         actions = super().get_actions(request)
@@ -83,8 +314,11 @@ class ExcelDownloadMixin(CsvBase):
                 del actions[DOWNLOAD_EXCEL]
         return actions
 
-    def generate_excel_response(self, queryset) -> HttpResponse:
+    def generate_excel_response(self, queryset) -> HttpResponse | FileResponse:
         """ダウンロード内容を生成する"""
+        if self.is_constant_memory:
+            return self.generate_excel_file_response(queryset)
+
         file_name = self.get_excel_file_name()
         http_response = HttpResponse(content_type='application/vnd.ms-excel')
         # quote()を使わないとファイル名がセットされない
@@ -112,6 +346,60 @@ class ExcelDownloadMixin(CsvBase):
 
         return http_response
 
+    def __add_excel_worksheet(self, workbook: Workbook, sheet_no: int, column_formats: List):
+        """シートを追加し、列の表示形式とヘッダー行を設定する、戻り値は次に出力する行番号"""
+        sheet_name = self.model._meta.model_name
+        if sheet_no > 1:
+            suffix = f'_{sheet_no}'
+            sheet_name = sheet_name[:31 - len(suffix)] + suffix
+        worksheet = workbook.add_worksheet(sheet_name[:31])
+
+        # constant_memoryモードでは行の出力前に列の設定が必要
+        for col_num, cell_format in enumerate(column_formats):
+            if cell_format is not None:
+                worksheet.set_column(col_num, col_num, None, cell_format)
+
+        csv_headers = self.get_csv_headers()
+        if csv_headers:
+            worksheet.write_row(0, 0, csv_headers)
+            return worksheet, 1
+        return worksheet, 0
+
+    def generate_excel_file_response(self, queryset) -> FileResponse:
+        """
+        constant_memoryモードで一時ファイルにExcelを出力し、FileResponseで返す
+        値はCSV文字列に変換せず、項目の型に応じた列の表示形式で出力する
+        行数がexcel_max_rowsを超えた場合、ヘッダー行を付けて次のシートに出力する
+        """
+        model_fields = self.get_model_fields()
+        field_types = [model_fields.get(name) for name in self.get_csv_field_names()]
+        str_columns = [i for (i, field_type) in enumerate(field_types) if field_type in self.excel_str_types]
+
+        temp_file = tempfile.TemporaryFile()
+        workbook = Workbook(temp_file, {'constant_memory': True, 'remove_timezone': True})
+        column_formats = [workbook.add_format({'num_format': self.excel_num_formats[field_type]})
+                          if field_type in self.excel_num_formats else None for field_type in field_types]
+
+        sheet_no = 1
+        worksheet, row_num = self.__add_excel_worksheet(workbook, sheet_no, column_formats)
+        for values in self.iter_model_values(queryset):
+            if row_num >= self.excel_max_rows:
+                sheet_no += 1
+                worksheet, row_num = self.__add_excel_worksheet(workbook, sheet_no, column_formats)
+            row = list(values.values())
+            for col_num in str_columns:
+                if row[col_num] is not None:
+                    row[col_num] = str(row[col_num])
+            worksheet.write_row(row_num, 0, row)
+            row_num += 1
+
+        workbook.close()
+        temp_file.seek(0)
+
+        # FileResponseがレスポンス送信後に一時ファイルを閉じる(閉じた時点で削除される)
+        return FileResponse(temp_file, as_attachment=True, filename=self.get_excel_file_name(),
+                            content_type='application/vnd.ms-excel')
+
 
 @admin.display(description=_('download excel'))
 def download_excel(model_admin, request, queryset):
@@ -1,16 +1,53 @@
 import math
-from typing import Any, Dict, Tuple, Type
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import StrEnum, auto
+from functools import cached_property, partial
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Type
 import io
 import csv
+import django
 from datetime import date, datetime
-from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.contrib.admin import AdminSite
+from django.db.models import F, Model
+from django.db.models.functions import Coalesce
 from django.forms import ModelForm, modelform_factory
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.db.utils import IntegrityError
-from cmm.models import SimpleTable
-from cmm.csv import CsvBase, CsvLog, UploadMixin
-from cmm.forms import get_modelform_error_messages, get_modelform_non_unique_error_codes
+from django.db.utils import DatabaseError, IntegrityError
+from cmm.models import (SimpleTable, VersionedTable, BulkHistoryWriter, get_existing_keys, get_rows_by_unique_keys,
+                        get_unique_fields)
+from cmm.csv import CsvBase, CsvLog, CsvLogStorage, CsvLotSummary, UploadMixin
+from cmm.csv.pg_copy import copy_upsert, get_copy_fields, is_copy_available, is_copy_supported, to_copy_row
+from cmm.forms import (get_modelform_error_messages, get_modelform_non_unique_error_codes,
+                       NoUniqueValidationModelForm)
+
+
+class CsvImportEngine(StrEnum):
+    """ DBへの保存方法 """
+
+    ORM = auto()            # update_or_create()/create()で1行ずつ保存する
+    BULK = auto()           # chunkごとにbulk_create(update_conflicts=True)で一括保存する
+    COPY = auto()           # PostgreSQLのCOPYで一時テーブルに読み込み、INSERT ... ON CONFLICTでマージする
+
+
+class CsvImportOperation(StrEnum):
+    """ ファイルの行の処理方法 """
+
+    UPSERT = auto()         # 新規登録、既存行の更新
+    DELETE = auto()         # Uniqueキーに一致する既存行を削除する(差分ファイルの削除分など)
+
+
+# CSVの行の変換処理、(行番号, 行)のiteratorを受け取り、変換後の(行番号, 行)を返す
+RowTransform = Callable[[Iterator[Tuple[int, list[str]]]], Iterator[Tuple[int, list[str]]]]
+
+# 検証用プロセス内で生成したadminインスタンス、ModelFormクラス等のキャッシュを再利用するため保持する
+_worker_model_admins: dict[Tuple[type, type], Any] = {}
 
 
 class CsvUploadMixin(CsvBase, UploadMixin):
@@ -23,24 +60,48 @@ class CsvUploadMixin(CsvBase, UploadMixin):
     error_tolerance_rate = 10
     # DBにすでに存在するレコードを上書きするかスキップするかを指定する。true: 上書き; false: スキップ
     is_overwrite_existing = True
+    # Uniqueキーの重複チェックを行ごとのModelFormではなく、chunkごとにまとめて行う。ファイル内の重複も検出する
+    is_chunk_unique_check = True
+    # 1以上の場合、指定した数のプロセスでchunkごとに並列に入力チェックを行う。DBへの保存はファイルの順番で1プロセスで行う
+    validation_workers = 0
+    # HistoryTableのモデルで、一括保存した行の履歴をchunkのトランザクションの最後にまとめて記録する場合はTrue
+    is_history_deferred = False
+    # COMPACTの場合、正常行のCsvLogは記録せず、ロットごとに件数のサマリー行を記録する
+    log_storage: CsvLogStorage = CsvLogStorage.FULL
+    # ファイル名がこの正規表現に一致する場合、ファイルの行をUniqueキーに一致する既存行の削除として扱う
+    delete_file_pattern: Optional[str] = None
+    # csv2modelの前に行を変換する処理、get_row_transforms()を参照
+    row_transforms: Tuple[RowTransform, ...] = ()
+    # 読み込み中のファイルの処理方法、read_csv_fileでファイルごとに設定する
+    import_operation: CsvImportOperation = CsvImportOperation.UPSERT
+    # Uniqueキーが定義されていないモデル、ON CONFLICTをサポートしないDBでは自動的にORMで保存する
+    # COPYはPostgreSQL以外のDBではBULKで保存する
+    import_engine: CsvImportEngine = CsvImportEngine.BULK
 
     # CSVファイルからインポートされない項目のデフォルト値を設定する
     def get_default_values(self) -> Dict[str, Any]:
         default_values = {}
         return default_values
 
+    @cached_property
+    def csv_converters(self) -> Dict[str, Callable[[str], Any]]:
+        """CSVの項目名ごとの変換処理、モデル項目の型から一度だけ生成してadminインスタンスに保持する"""
+        def identity(value):
+            return value
+
+        def to_date(value):
+            return datetime.strptime(value, self.date_format).date()
+
+        def to_datetime(value):
+            return datetime.strptime(value, self.datetime_format)
+
+        converters = {'DateField': to_date, 'DateTimeField': to_datetime}
+        return {k: converters.get(field_type, identity) for (k, field_type) in self.get_model_fields().items()}
+
     def csv2model(self, csv_data: Dict[str, str]) -> Dict[str, Any]:
         """デフォルトでは同名項目を転送、CSVの項目名とDBのカラム名が同じではない場合はここでのマッピングが必要"""
-        model_dict = {}
-        for (k, v) in csv_data.items():
-            if k in self.get_model_fields():
-                if self.get_model_fields().get(k) == 'DateField':
-                    model_dict[k] = datetime.strptime(v, self.date_format).date()
-                elif self.get_model_fields().get(k) == 'DateTimeField':
-                    model_dict[k] = datetime.strptime(v, self.datetime_format)
-                else:
-                    model_dict[k] = v
-        # model_dict = {k: v for (k, v) in csv_data.items() if k in [f.name for f in self.get_model_fields()]}
+        converters = self.csv_converters
+        model_dict = {k: converters[k](v) for (k, v) in csv_data.items() if k in converters}
         if issubclass(self.model, SimpleTable):
             updater = 'updater'
             if updater not in model_dict:
@@ -48,8 +109,15 @@ class CsvUploadMixin(CsvBase, UploadMixin):
 
         return model_dict
 
-    def __get_modelform_class(self) -> Type[ModelForm]:
-        """Dynamically generate ModelForm class"""
+    __modelform_classes: Optional[Dict[bool, Type[ModelForm]]] = None
+
+    def __get_modelform_class(self, validate_unique: bool = True) -> Type[ModelForm]:
+        """Dynamically generate ModelForm class, 生成したクラスはadminインスタンスに保持して再利用する"""
+        if self.__modelform_classes is None:
+            self.__modelform_classes = {}
+        if validate_unique in self.__modelform_classes:
+            return self.__modelform_classes[validate_unique]
+
         def disable_formfield(db_field, **kwargs):
             form_field = db_field.formfield(**kwargs)
             if form_field:
@@ -57,18 +125,26 @@ class CsvUploadMixin(CsvBase, UploadMixin):
             return form_field
 
         model_form: Type[ModelForm] = modelform_factory(self.model, fields=self.get_model_fields().keys(),
+                                                        form=ModelForm if validate_unique else
+                                                        NoUniqueValidationModelForm,
                                                         formfield_callback=disable_formfield)
+        self.__modelform_classes[validate_unique] = model_form
         return model_form
 
-    def __validate_by_modelform(self, csv_log: CsvLog):
-        """ModelFormの入力チェックを実施"""
-        modelform = self.__get_modelform_class()(self.csv2model(csv_log.row_content))
+    def __validate_by_modelform(self, csv_log: CsvLog, validate_unique: bool = True):
+        """ModelFormの入力チェックを実施、validate_unique=Falseの場合、Uniqueキーの重複は__check_unique_in_chunkで判定する"""
+        if self.is_delete_row(csv_log.row_content):
+            self.__validate_delete_key(csv_log)
+            return
+        modelform = self.__get_modelform_class(validate_unique)(self.csv2model(csv_log.row_content))
 
         if modelform.is_valid():
             csv_log.log_level = CsvLog.INFO
             csv_log.message = _('Newly imported row.')
             modelform.cleaned_data = modelform.data
             csv_log.modelform = modelform
+            csv_log.cleaned_data = modelform.cleaned_data
+            self.__validate_row(csv_log)
         else:
             non_unique_error_codes = get_modelform_non_unique_error_codes(modelform)
             if not non_unique_error_codes:      # only unique violation
@@ -78,6 +154,8 @@ class CsvUploadMixin(CsvBase, UploadMixin):
                     csv_log.edit_type = CsvLog.UPDATE
                     modelform.cleaned_data = modelform.data
                     csv_log.modelform = modelform
+                    csv_log.cleaned_data = modelform.cleaned_data
+                    self.__validate_row(csv_log)
                 else:
                     csv_log.log_level = CsvLog.WARN     # DBと重複したのでスキップする
                     csv_log.message = get_modelform_error_messages(modelform)
@@ -85,6 +163,73 @@ class CsvUploadMixin(CsvBase, UploadMixin):
                 csv_log.log_level = CsvLog.ERROR
                 csv_log.message = get_modelform_error_messages(modelform)
 
+    def validate_csv_row(self, cleaned_data: Dict[str, Any]) -> None:
+        """
+        ModelFormの入力チェック後の行ごとのチェック、他のテーブルとの整合性チェックなどを実装する
+        エラーの場合はValidationErrorを送出する、行ごとにDBを検索しないようにすること
+        """
+
+    def __validate_row(self, csv_log: CsvLog) -> None:
+        try:
+            self.validate_csv_row(csv_log.cleaned_data)
+        except ValidationError as e:
+            csv_log.log_level = CsvLog.ERROR
+            csv_log.message = ' '.join(e.messages)
+
+    def get_import_operation(self, file_name: str) -> CsvImportOperation:
+        """ファイル単位の処理方法、delete_file_patternに一致するファイルは削除"""
+        if self.delete_file_pattern and re.fullmatch(self.delete_file_pattern, os.path.basename(file_name),
+                                                     flags=re.IGNORECASE):
+            return CsvImportOperation.DELETE
+        return CsvImportOperation.UPSERT
+
+    def is_delete_row(self, row_content: Dict[str, str]) -> bool:
+        """行を削除として扱うか、行の内容(更新区分など)で判定する場合はオーバーライドする"""
+        # pylint: disable = unused-argument
+        return self.import_operation == CsvImportOperation.DELETE
+
+    def __validate_delete_key(self, csv_log: CsvLog) -> None:
+        """削除する行はUniqueキーのみ変換する、ModelFormの入力チェックは行わない"""
+        cleaned_data = self.csv2model(csv_log.row_content)
+        key = tuple(cleaned_data.get(f) for f in get_unique_fields(self.model))
+        if not key or any(v in (None, '') for v in key):
+            csv_log.log_level = CsvLog.ERROR
+            csv_log.message = _('The unique key of the row to delete is not specified.')
+            return
+        csv_log.log_level = CsvLog.INFO
+        csv_log.edit_type = CsvLog.DELETE
+        csv_log.cleaned_data = cleaned_data
+
+    def __can_check_unique_in_chunk(self) -> bool:
+        return self.is_chunk_unique_check and bool(get_unique_fields(self.model))
+
+    def __check_unique_in_chunk(self, chunk: list[CsvLog], file_keys: set[Tuple[Any, ...]]) -> None:
+        """
+        chunkの有効行のUniqueキーを1回(DBのパラメータ数上限を超える場合は分割)の検索でDBと照合し、新規登録か更新かを判定する
+        file_keysはファイル内でこれまでに読み込んだキー、ファイル内の重複も既存行と同様に扱う
+        """
+        unique_fields = get_unique_fields(self.model)
+        valid_data = [(tuple(csv_log.cleaned_data.get(f) for f in unique_fields), csv_log)
+                      for csv_log in chunk if csv_log.log_level == CsvLog.INFO and csv_log.edit_type != CsvLog.DELETE]
+        existing_keys = get_existing_keys(self.model, unique_fields, [key for (key, _) in valid_data])
+
+        for (key, csv_log) in valid_data:
+            if None in key:
+                continue        # NULLを含むキーは重複とみなさない
+            is_in_file = key in file_keys
+            if not is_in_file and key not in existing_keys:
+                file_keys.add(key)
+                continue
+
+            if self.is_overwrite_existing:
+                csv_log.message = _("Update existing row.")
+                csv_log.edit_type = CsvLog.UPDATE
+            else:
+                csv_log.log_level = CsvLog.WARN
+                csv_log.message = _('Skipped because the row is duplicated in the file.') if is_in_file \
+                    else _('Skipped because the row already exists.')
+            file_keys.add(key)
+
     def __has_too_many_errors(self, error_cnt: int) -> bool:
         error_limit = math.floor(self.chunk_size * self.error_tolerance_rate / 100)
         return error_cnt > error_limit
@@ -97,37 +242,366 @@ class CsvUploadMixin(CsvBase, UploadMixin):
 
     @transaction.atomic
     def __save2db(self, chunk: list[CsvLog]) -> int:
-        """DB保存処理"""
-        saved_rows = 0
-        valid_data = [v for v in chunk if v.log_level == CsvLog.INFO]
+        """DB保存処理、削除する行を先に処理する"""
+        valid_rows = [v for v in chunk if v.log_level == CsvLog.INFO]
+        deleted_rows = self.__delete2db([v for v in valid_rows if v.edit_type == CsvLog.DELETE])
+        valid_data = [v for v in valid_rows if v.edit_type != CsvLog.DELETE]
+
+        if self.import_engine == CsvImportEngine.ORM or not self.__can_bulk_upsert():
+            return deleted_rows + self.__save2db_rows(valid_data)
+
+        # 1行ずつの保存はsave()のシグナルで履歴が記録されるため、一括保存した行のみ履歴を記録する
+        history_writer = None
+        if BulkHistoryWriter.is_history_model(self.model):
+            history_writer = BulkHistoryWriter(self.model, batch_size=self.chunk_size,
+                                               is_deferred=self.is_history_deferred)
+        if self.import_engine == CsvImportEngine.COPY and is_copy_available() and is_copy_supported(self.model):
+            saved_rows = self.__save2db_copy(valid_data, history_writer)
+        else:
+            saved_rows = self.__save2db_bulk(valid_data, history_writer)
+        if history_writer is not None:
+            history_writer.flush()
+        return deleted_rows + saved_rows
+
+    def __delete2db(self, delete_data: list[CsvLog]) -> int:
+        """
+        Uniqueキーに一致する既存行をまとめて削除する、存在しない行は読み飛ばす
+        削除はQuerySet.delete()で行うため、履歴テーブルにも削除が記録される
+        """
+        if not delete_data:
+            return 0
+        unique_fields = get_unique_fields(self.model)
+        keys = [tuple(csv_log.cleaned_data.get(f) for f in unique_fields) for csv_log in delete_data]
+        db_rows = get_rows_by_unique_keys(self.model, unique_fields, keys)
+
+        pks = set()
+        for (key, csv_log) in zip(keys, delete_data):
+            db_row = db_rows.get(key)
+            if db_row is None or db_row.pk in pks:
+                csv_log.log_level = CsvLog.WARN
+                csv_log.message = _('Skipped because the row does not exist.')
+                continue
+            csv_log.message = _('Deleted existing row.')
+            pks.add(db_row.pk)
+        self.model.objects.filter(pk__in=pks).delete()
+        return len(pks)
 
+    def __save2db_rows(self, valid_data: list[CsvLog]) -> int:
+        """
+        1行ずつ保存する、エラーになった行はsavepointまでロールバックしてCsvLogにエラーを記録する
+        上書きの場合はUniqueキーで既存行を検索し、それ以外の項目を更新する
+        """
+        manager = self.model.objects
+        unique_fields = get_unique_fields(manager.model)
+        saved_rows = 0
         for csv_log in valid_data:
+            cleaned_data = csv_log.cleaned_data
             try:
-                if self.is_overwrite_existing:
-                    self.model.objects.update_or_create(**csv_log.modelform.cleaned_data)
-                else:
-                    self.model.objects.create(**csv_log.modelform.cleaned_data)
+                with transaction.atomic():
+                    if self.is_overwrite_existing and unique_fields:
+                        manager.update_or_create(
+                            **{k: cleaned_data.get(k) for k in unique_fields},
+                            defaults={k: v for (k, v) in cleaned_data.items() if k not in unique_fields})
+                    elif self.is_overwrite_existing:
+                        manager.update_or_create(**cleaned_data)
+                    else:
+                        manager.create(**cleaned_data)
                 saved_rows += 1
-            except IntegrityError as e:
+            except ValidationError as e:
+                csv_log.log_level = CsvLog.ERROR
+                csv_log.message = ' '.join(e.messages)
+            except (DatabaseError, TypeError, ValueError) as e:
                 csv_log.log_level = CsvLog.ERROR
-                csv_log.message = e.args[0]
+                csv_log.message = str(e.args[0]) if e.args else str(e)
 
         return saved_rows
 
+    def __can_bulk_upsert(self) -> bool:
+        """bulk_createでupsertできるか、マルチテーブル継承のモデルはbulk_createできない"""
+        opts = self.model._meta
+        return bool(get_unique_fields(self.model)) and not opts.parents \
+            and connection.features.supports_update_conflicts_with_target
+
+    def __build_instance(self, cleaned_data: Dict[str, Any], now: datetime) -> Model:
+        """bulk_createはsave()を呼ばないため、SimpleTableとVersionedTableの共通項目をここで設定する"""
+        instance = self.model(**cleaned_data)
+        if isinstance(instance, SimpleTable):
+            instance.created_at = instance.updated_at = now
+            instance.creator = instance.creator or instance.updater
+        if isinstance(instance, VersionedTable):
+            instance.version = 1
+        return instance
+
+    def __check_db_values(self, instance: Model) -> Model:
+        """bulk_createで保存する前に、各項目の値をDBの値に変換できるか確認する"""
+        for field in self.model._meta.concrete_fields:
+            if not field.primary_key:
+                field.get_db_prep_save(getattr(instance, field.attname), connection)
+        return instance
+
+    def __increment_versions(self, instances: list[Model], unique_fields: Tuple[str, ...]) -> None:
+        """
+        ON CONFLICT DO UPDATEで更新される既存行のversionを加算する、bulk_createはversionを更新しないため
+        bulk_createの前に呼び出し、Uniqueキーで既存行を特定する
+        """
+        model = self.model
+        if not issubclass(model, VersionedTable):
+            return
+        keys = [tuple(getattr(instance, f) for f in unique_fields) for instance in instances]
+        pks = [db_row.pk for db_row in get_rows_by_unique_keys(model, unique_fields, keys).values()]
+        batch_size = max(connection.ops.bulk_batch_size(['pk'], pks), 1)
+        for i in range(0, len(pks), batch_size):
+            model.objects.filter(pk__in=pks[i:i + batch_size]).update(version=Coalesce(F('version'), 0) + 1)
+
+    def __get_bulk_update_fields(self, valid_data: list[CsvLog], unique_fields: Tuple[str, ...]) -> list[str]:
+        """ON CONFLICT DO UPDATEで更新する項目、作成日時、作成者、versionは既存の値を残す(versionは別途加算する)"""
+        keep_fields = set(unique_fields) | {'created_at', 'creator', 'version'}
+        data_fields = {k for csv_log in valid_data for k in csv_log.cleaned_data.keys()}
+        if issubclass(self.model, SimpleTable):
+            data_fields |= {'updated_at', 'updater'}
+        return [f.name for f in self.model._meta.concrete_fields
+                if f.name in data_fields and f.name not in keep_fields and not f.primary_key]
+
+    def __split_duplicated_rows(self, valid_data: list[CsvLog], unique_fields: Tuple[str, ...]) -> \
+            Tuple[dict[Any, CsvLog], list[CsvLog], int]:
+        """
+        chunk内でUniqueキーが重複する行を振り分ける
+        上書きの場合は最後の行を一括保存し、それ以外はエラー行の特定のため1行ずつ保存する
+        戻り値は(一括保存する行、1行ずつ保存する行、後続行で上書きされた行数)
+        """
+        bulk_data: dict[Any, CsvLog] = {}
+        row_data: list[CsvLog] = []
+        superseded_rows = 0
+        for csv_log in valid_data:
+            key = tuple(csv_log.cleaned_data.get(f) for f in unique_fields)
+            if None in key:
+                key = (csv_log.row_no, )     # NULLは重複とみなさない
+            if key not in bulk_data:
+                bulk_data[key] = csv_log
+            elif self.is_overwrite_existing:
+                bulk_data[key] = csv_log
+                superseded_rows += 1
+            else:
+                row_data.append(csv_log)
+        return bulk_data, row_data, superseded_rows
+
+    def __write_history(self, history_writer: Optional[BulkHistoryWriter], saved: list[Tuple[Model, bool]]) -> None:
+        """
+        一括保存した行の履歴を記録する、(保存したインスタンス, 新規登録か)のリスト
+        upsertではpkと更新後の値がインスタンスに反映されないため、Uniqueキーで保存後の行を読み直す
+        """
+        if history_writer is None or not saved:
+            return
+        unique_fields = get_unique_fields(self.model)
+        keys = [tuple(getattr(instance, f) for f in unique_fields) for (instance, _) in saved]
+        db_rows = get_rows_by_unique_keys(self.model, unique_fields, keys)
+
+        inserted_rows, updated_rows = [], []
+        for (key, (instance, inserted)) in zip(keys, saved):
+            db_row = db_rows.get(key, instance if None in key else None)
+            if db_row is not None:
+                (inserted_rows if inserted else updated_rows).append(db_row)
+        history_writer.add(inserted_rows)
+        history_writer.add(updated_rows, update=True)
+
+    def __save2db_bulk(self, valid_data: list[CsvLog], history_writer: Optional[BulkHistoryWriter] = None) -> int:
+        """
+        chunkごとにbulk_createで一括保存する
+        一括保存に失敗した場合は、エラー行を特定するため該当chunkを1行ずつ保存し直す
+        """
+        unique_fields = get_unique_fields(self.model)
+        bulk_data, row_data, superseded_rows = self.__split_duplicated_rows(valid_data, unique_fields)
+
+        now = timezone.now()
+        instance_map = {key: self.__build_instance(csv_log.cleaned_data, now)
+                        for (key, csv_log) in bulk_data.items()}
+        instances = self.__convert_rows(bulk_data, instance_map, self.__check_db_values)
+        update_fields = self.__get_bulk_update_fields(valid_data, unique_fields)
+        # ignore_conflictsの場合、既存行は更新されないため履歴を記録しない
+        is_updated = bool(self.is_overwrite_existing and update_fields)
+        try:
+            with transaction.atomic():
+                if is_updated:
+                    self.__increment_versions(instances, unique_fields)
+                    self.model.objects.bulk_create(instances, batch_size=self.chunk_size, update_conflicts=True,
+                                                   unique_fields=unique_fields, update_fields=update_fields)
+                elif self.is_overwrite_existing:
+                    self.model.objects.bulk_create(instances, batch_size=self.chunk_size, ignore_conflicts=True)
+                else:
+                    self.model.objects.bulk_create(instances, batch_size=self.chunk_size)
+        except DatabaseError:
+            return self.__save2db_rows([v for v in valid_data if v.log_level != CsvLog.ERROR])
+
+        self.__write_history(history_writer, [(instance, csv_log.edit_type == CsvLog.INSERT)
+                                              for (instance, csv_log) in zip(instances, bulk_data.values())
+                                              if is_updated or csv_log.edit_type == CsvLog.INSERT])
+        return len(bulk_data) + superseded_rows + self.__save2db_rows(row_data)
+
+    def __save2db_copy(self, valid_data: list[CsvLog], history_writer: Optional[BulkHistoryWriter] = None) -> int:
+        """
+        chunkごとにCOPYで一時テーブルに読み込み、1回のINSERT ... ON CONFLICTで対象テーブルにマージする
+        RETURNINGの結果から行ごとの新規登録、更新をCsvLogに記録する
+        マージに失敗した場合は、エラー行を特定するため該当chunkを1行ずつ保存し直す
+        """
+        opts = self.model._meta
+        unique_fields = get_unique_fields(self.model)
+        bulk_data, row_data, superseded_rows = self.__split_duplicated_rows(valid_data, unique_fields)
+
+        now = timezone.now()
+        instances = {key: self.__build_instance(csv_log.cleaned_data, now)
+                     for (key, csv_log) in bulk_data.items()}
+        update_fields = self.__get_bulk_update_fields(valid_data, unique_fields)
+        copy_rows = self.__convert_rows(bulk_data, instances, partial(to_copy_row, get_copy_fields(self.model)))
+        try:
+            with transaction.atomic():
+                results = copy_upsert(self.model, copy_rows, unique_fields, update_fields,
+                                      self.is_overwrite_existing)
+        except DatabaseError:
+            return self.__save2db_rows([v for v in valid_data if v.log_level != CsvLog.ERROR])
+
+        saved_rows = superseded_rows
+        saved: list[Tuple[Model, bool]] = []
+        for (key, csv_log) in bulk_data.items():
+            instance = instances[key]
+            inserted = results.get(tuple(opts.get_field(f).to_python(getattr(instance, f)) for f in unique_fields))
+            if inserted is None:
+                csv_log.log_level = CsvLog.WARN     # 検証後に他の処理で登録された行
+                csv_log.message = _('Skipped because the row already exists.')
+                continue
+            csv_log.edit_type = CsvLog.INSERT if inserted else CsvLog.UPDATE
+            csv_log.message = _('Newly imported row.') if inserted else _('Update existing row.')
+            saved.append((instance, inserted))
+            saved_rows += 1
+
+        self.__write_history(history_writer, saved)
+        return saved_rows + self.__save2db_rows(row_data)
+
+    def __convert_rows(self, bulk_data: dict[Any, CsvLog], instances: dict[Any, Model],
+                       convert: Callable[[Model], Any]) -> list:
+        """
+        一括保存用に行ごとにconvertで変換する(COPYの行、bulk_createの値の確認)
+        値を変換できない行はCsvLogにエラーを記録してbulk_data、instancesから除く、他の行はそのまま保存する
+        """
+        rows = []
+        for (key, csv_log) in list(bulk_data.items()):
+            try:
+                rows.append(convert(instances[key]))
+                continue
+            except ValidationError as e:
+                message = ' '.join(e.messages)
+            except (TypeError, ValueError) as e:
+                message = str(e)
+            csv_log.log_level = CsvLog.ERROR
+            csv_log.message = message
+            del bulk_data[key]
+            del instances[key]
+        return rows
+
     @transaction.atomic
     def __save2db_csv_logs(self, chunk: list[CsvLog]) -> None:
-        """インポートログ情報をDBに記録する"""
+        """インポートログ情報をDBに記録する、COMPACTの場合は正常行を記録しない(件数はCsvLotSummaryに集計する)"""
+        if self.log_storage == CsvLogStorage.COMPACT:
+            chunk = [csv_log for csv_log in chunk if csv_log.log_level != CsvLog.INFO]
         CsvLog.objects.bulk_create([csv_log.convert_content2json() for csv_log in chunk])
 
+    def __save2db_summary_log(self) -> None:
+        """COMPACTの場合に、ロットの正常行の件数をサマリー行として記録する"""
+        now = timezone.now()
+        inserted, updated = self.lot_summary.inserted_count, self.lot_summary.updated_count
+        deleted = self.lot_summary.deleted_count
+        message = _('Imported %(inserted)s new rows and updated %(updated)s rows.') % {
+            'inserted': inserted, 'updated': updated}
+        if deleted:
+            message += ' ' + _('Deleted %(deleted)s rows.') % {'deleted': deleted}
+        CsvLog(file_name=self.csv_file.name,
+               row_no=CsvLog.SUMMARY_ROW_NO,
+               row_content={CsvLog.INSERT: str(inserted), CsvLog.UPDATE: str(updated), CsvLog.DELETE: str(deleted)},
+               message=message,
+               creator=self.user_name,
+               created_at=now,
+               updater=self.user_name,
+               updated_at=now,
+               version=1,
+               lot_number=self.lot_number).convert_content2json().save()
+
+    def get_row_transforms(self) -> list[RowTransform]:
+        """
+        CSVの行をcsv2modelの前に変換する処理、読み込み順に適用する
+        各処理は(行番号, 行)のiteratorを受け取り、変換後の(行番号, 行)を返すgenerator
+        複数行を1行にまとめる場合は最初の行の行番号を返す
+        """
+        return list(self.row_transforms)
+
     def pre_import_processing(self, *args, **kwargs):
         """CSV importの前処理"""
 
     def post_import_processing(self, *args, **kwargs):
         """CSV importの後処理"""
 
+    def __validate_chunk(self, chunk: list[CsvLog], validate_unique: bool) -> list[CsvLog]:
+        for csv_log in chunk:
+            self.__validate_by_modelform(csv_log, validate_unique=validate_unique)
+        return chunk
+
+    @classmethod
+    def validate_rows_in_worker(cls, model, attributes: Dict[str, Any], rows: list[Dict[str, str]],
+                                validate_unique: bool) -> list[Tuple[str, Any, str, Optional[Dict[str, Any]]]]:
+        """
+        検証用プロセスで実行する入力チェック、結果は(log_level, message, edit_type, cleaned_data)のリスト
+        ModelFormはプロセス間で受け渡せないため、cleaned_dataのみを返す
+        """
+        model_admin = _worker_model_admins.get((cls, model))
+        if model_admin is None:
+            # clsはModelAdminと組み合わせたサブクラス、mixin単体の__init__は引数を取らない
+            model_admin = _worker_model_admins[(cls, model)] = cls(model, AdminSite())  # type: ignore[call-arg]
+        for (name, value) in attributes.items():
+            setattr(model_admin, name, value)
+
+        results = []
+        for row_content in rows:
+            csv_log = CsvLog(row_content=row_content)
+            model_admin.__validate_by_modelform(csv_log, validate_unique=validate_unique)
+            results.append((csv_log.log_level, csv_log.message, csv_log.edit_type,
+                            getattr(csv_log, 'cleaned_data', None)))
+        return results
+
+    def __validate_chunks_in_pool(self, chunks: Iterator[list[CsvLog]], validate_unique: bool) -> \
+            Iterator[list[CsvLog]]:
+        """
+        chunkを検証用プロセスに振り分けて並列に入力チェックし、読み込んだ順番で返す
+        先読みするchunk数はプロセス数の2倍までとし、メモリ使用量を抑える
+        """
+        attributes = {name: getattr(self, name) for name in
+                      ('user_name', 'date_format', 'datetime_format', 'is_overwrite_existing', 'import_operation')}
+        executor = ProcessPoolExecutor(max_workers=self.validation_workers,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=django.setup)   # spawnしたプロセスではDjangoの初期化が必要
+        pending: deque = deque()
+        try:
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(self.__class__.validate_rows_in_worker, self.model, attributes,
+                                                       [csv_log.row_content for csv_log in chunk], validate_unique)))
+                if len(pending) > self.validation_workers * 2:
+                    yield self.__apply_worker_results(*pending.popleft())
+            while pending:
+                yield self.__apply_worker_results(*pending.popleft())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def __apply_worker_results(chunk: list[CsvLog], future) -> list[CsvLog]:
+        for (csv_log, (log_level, message, edit_type, cleaned_data)) in zip(chunk, future.result()):
+            csv_log.log_level = log_level
+            csv_log.message = message
+            csv_log.edit_type = edit_type
+            if cleaned_data is not None:
+                csv_log.cleaned_data = cleaned_data
+        return chunk
+
     def read_csv_file(self) -> int:
         """
         CSVファイルの読み込み処理、性能を考慮してchunkごとに読み込んでDBに保存する
+        読み込み、入力チェック、DB保存をchunk単位のパイプラインで処理する
         """
 
         # アップロード事前処理
@@ -136,39 +610,73 @@ class CsvUploadMixin(CsvBase, UploadMixin):
         text_wrapper = io.TextIOWrapper(self.csv_file, encoding=self.encoding)
         csv_reader = csv.reader(text_wrapper, dialect=self.dialect)
 
+        csv_field_names = self.get_csv_field_names()
+        is_chunk_unique_check = self.__can_check_unique_in_chunk()
+        file_keys: set[Tuple[Any, ...]] = set()
+        self.import_operation = self.get_import_operation(self.csv_file.name)
+        # pylint: disable = protected-access
+        self.lot_summary = CsvLotSummary.start(self.lot_number, self.csv_file.name, self.model._meta.label_lower,
+                                               self.user_name)
         row_no = 0
-        chunk: list[CsvLog] = []              # list[CsvLog]
-        error_cnt = 0
-        for row in csv_reader:
-            row_no += 1
 
-            # ヘッダー行と空行は読み飛ばすだけ、ログ記録は残さない
-            if row_no <= self.header_row_number or not row:
-                continue
+        def read_rows() -> Iterator[Tuple[int, list[str]]]:
+            nonlocal row_no
+            for row in csv_reader:
+                row_no += 1
 
-            csv_log = CsvLog(file_name=self.csv_file.name,
-                             row_no=row_no,
-                             row_content=dict(zip(self.get_csv_field_names(), row)),
-                             creator=self.user_name,
-                             created_at=timezone.now(),
-                             updater=self.user_name,
-                             updated_at=timezone.now(),
-                             version=1,
-                             lot_number=self.lot_number)
+                # ヘッダー行と空行は読み飛ばすだけ、ログ記録は残さない
+                if row_no <= self.header_row_number or not row:
+                    continue
+                yield row_no, row
 
-            self.__validate_by_modelform(csv_log)
-            chunk.append(csv_log)
+        def read_chunks() -> Iterator[list[CsvLog]]:
+            rows = read_rows()
+            for transform in self.get_row_transforms():
+                rows = transform(rows)
 
-            if len(chunk) >= self.chunk_size:
-                saved_rows = self.__save(chunk)
+            chunk: list[CsvLog] = []
+            for (first_row_no, row) in rows:
+                chunk.append(CsvLog(file_name=self.csv_file.name,
+                                    row_no=first_row_no,
+                                    row_content=dict(zip(csv_field_names, row)),
+                                    creator=self.user_name,
+                                    created_at=timezone.now(),
+                                    updater=self.user_name,
+                                    updated_at=timezone.now(),
+                                    version=1,
+                                    lot_number=self.lot_number))
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
 
-                error_cnt += len(chunk) - saved_rows
-                if self.__has_too_many_errors(error_cnt):
-                    break
-                chunk.clear()
+        if self.validation_workers > 0:
+            validated_chunks = self.__validate_chunks_in_pool(read_chunks(), not is_chunk_unique_check)
         else:
-            if chunk:
-                self.__save(chunk)
+            validated_chunks = (self.__validate_chunk(chunk, not is_chunk_unique_check) for chunk in read_chunks())
+
+        error_cnt = 0
+        try:
+            for chunk in validated_chunks:
+                if is_chunk_unique_check:
+                    self.__check_unique_in_chunk(chunk, file_keys)
+                saved_rows = self.__save(chunk)
+                self.lot_summary.add_counts(chunk)
+
+                # 最後の端数のchunkはエラー件数の判定対象外
+                if len(chunk) >= self.chunk_size:
+                    error_cnt += len(chunk) - saved_rows
+                    if self.__has_too_many_errors(error_cnt):
+                        # 先読みした行は処理しないため、処理済みの最終行の行番号を返す
+                        row_no = chunk[-1].row_no
+                        validated_chunks.close()
+                        break
+        finally:
+            self.lot_summary.finish()
+
+        if self.log_storage == CsvLogStorage.COMPACT:
+            self.__save2db_summary_log()
 
         # インポートファイルを読み込みがすべて完了した後の処理
         self.post_import_processing()
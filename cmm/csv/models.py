@@ -1,6 +1,7 @@
 import json
-from typing import Any, List
+from typing import Iterable, List, Optional
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib import admin
 from cmm.models import SimpleTable, VersionedTable
@@ -31,10 +32,15 @@ class CsvLog(SimpleTable, VersionedTable):
 
     INSERT = 'insert'
     UPDATE = 'update'
+    DELETE = 'delete'
+
+    # CsvLogStorage.COMPACTで、ロットごとの正常行の件数を記録するサマリー行の行番号(CSVの行番号は1から)
+    SUMMARY_ROW_NO = 0
 
     DATA_CHANGE_CHOICES = [
         (INSERT, _('insert')),
         (UPDATE, _('update')),
+        (DELETE, _('delete')),
     ]
 
     """CSV upload, downloadのログ情報"""
@@ -55,22 +61,159 @@ class CsvLog(SimpleTable, VersionedTable):
 
         unique_together = ['lot_number', 'file_name', 'row_no']
         ordering = ['lot_number', 'file_name', 'row_no']
+        indexes = [
+            # 保存期間を過ぎたロットの削除用
+            models.Index(fields=['created_at'], name='cmm_csv_log_created_at_idx'),
+            # ロットごとのレベル別件数の集計用
+            models.Index(fields=['lot_number', 'log_level'], name='cmm_csv_log_lot_level_idx'),
+        ]
+
+    @classmethod
+    def count_by_log_level(cls, lot_number: str) -> dict[str, int]:
+        """ロットのレベル別件数、サマリー行は記録した正常行の件数に展開する"""
+        queryset = cls.objects.filter(lot_number=lot_number)
+        counts = dict(queryset.exclude(row_no=cls.SUMMARY_ROW_NO).values_list('log_level')
+                      .annotate(models.Count('id')).order_by())
+        for row_content in queryset.filter(row_no=cls.SUMMARY_ROW_NO).values_list('row_content', flat=True):
+            summary = json.loads(row_content)
+            counts[cls.INFO] = counts.get(cls.INFO, 0) + int(summary.get(cls.INSERT, 0)) \
+                + int(summary.get(cls.UPDATE, 0)) + int(summary.get(cls.DELETE, 0))
+        return counts
 
     @admin.display(description=_('csv'))
     def csv_content(self):
         return ','.join(json.loads(self.row_content).values())
 
-    def convert_content2json(self) -> str:
+    def convert_content2json(self) -> 'CsvLog':
         """json型に変換する"""
         self.row_content = json.dumps(self.row_content, ensure_ascii=False)
         return self
 
-    def convert_content2dict(self) -> dict[str, Any]:
+    def convert_content2dict(self) -> 'CsvLog':
         """dict型に変換する"""
         self.row_content = json.loads(self.row_content)
         return self
 
-    def convert_content2values(self) -> list[Any]:
+    def convert_content2values(self) -> 'CsvLog':
         """dict型に変換する"""
         self.row_content = list(json.loads(self.row_content).values())
         return self
+
+
+class CsvUploadJob(SimpleTable, VersionedTable):
+    """
+    バックグラウンドで実行するCSVアップロードのジョブ、lot_numberでCsvLogと紐づける
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (QUEUED, _('Queued')),
+        (RUNNING, _('Running')),
+        (FINISHED, _('Finished')),
+        (FAILED, _('Failed')),
+    ]
+
+    lot_number = models.CharField(_('lot number'), max_length=64, unique=True)
+    file_name = models.CharField(_('file name'), max_length=120, blank=True, null=True)
+    # 取り込み先のモデル(app_label.model_name)、他のモデルの画面からジョブを参照させないため
+    model_name = models.CharField(_('model name'), max_length=120, blank=True, null=True)
+    spool_path = models.CharField(_('spool path'), max_length=1024, blank=True, null=True)
+    status = models.CharField(_('job status'), max_length=12, choices=STATUS_CHOICES, blank=False, default=QUEUED)
+    row_count = models.IntegerField(_('row count'), blank=True, null=True)
+    message = models.CharField(_('message'), max_length=2048, blank=True, null=True)
+
+    class Meta:
+        db_table = 'cmm_csv_upload_job'
+        verbose_name = _('csv upload job')
+        verbose_name_plural = _('csv upload jobs')
+        default_permissions: List[str] = []
+
+        ordering = ['-created_at']
+
+    @property
+    def is_done(self) -> bool:
+        return self.status in (self.FINISHED, self.FAILED)
+
+
+class CsvLotSummary(SimpleTable, VersionedTable):
+    """
+    CSVアップロードのロットごとの集計、read_csv_fileがchunkごとに件数を加算する
+    画面とジョブの進捗表示はCsvLogを集計せずにこのテーブルを参照する
+    """
+
+    lot_number = models.CharField(_('lot number'), max_length=64, unique=True)
+    file_name = models.CharField(_('file name'), max_length=120, blank=True, null=True)
+    model_name = models.CharField(_('model name'), max_length=120, blank=True, null=True)
+    started_at = models.DateTimeField(_('start time'), blank=True, null=True)
+    finished_at = models.DateTimeField(_('finish time'), blank=True, null=True)
+    read_count = models.IntegerField(_('read rows'), default=0)
+    inserted_count = models.IntegerField(_('inserted rows'), default=0)
+    updated_count = models.IntegerField(_('updated rows'), default=0)
+    deleted_count = models.IntegerField(_('deleted rows'), default=0)
+    skipped_count = models.IntegerField(_('skipped rows'), default=0)
+    error_count = models.IntegerField(_('error rows'), default=0)
+
+    class Meta:
+        db_table = 'cmm_csv_lot_summary'
+        verbose_name = _('csv lot summary')
+        verbose_name_plural = _('csv lot summaries')
+        default_permissions: List[str] = ['view', 'delete']
+
+        ordering = ['-started_at']
+
+    @classmethod
+    def start(cls, lot_number: str, file_name: str, model_name: str, user_name: str) -> 'CsvLotSummary':
+        """ロットの集計を開始する、同じロットを再実行した場合は件数をクリアする"""
+        now = timezone.now()
+        summary, _created = cls.objects.update_or_create(
+            lot_number=lot_number,
+            defaults={'file_name': file_name, 'model_name': model_name, 'started_at': now, 'finished_at': None,
+                      'read_count': 0, 'inserted_count': 0, 'updated_count': 0, 'deleted_count': 0,
+                      'skipped_count': 0, 'error_count': 0, 'creator': user_name, 'updater': user_name})
+        return summary
+
+    def add_counts(self, csv_logs: Iterable['CsvLog']) -> None:
+        """chunkの件数を加算する、並行して参照されるためUPDATE ... SET count = count + nで更新する"""
+        counts = {'read_count': 0, 'inserted_count': 0, 'updated_count': 0, 'deleted_count': 0, 'skipped_count': 0,
+                  'error_count': 0}
+        for csv_log in csv_logs:
+            counts['read_count'] += 1
+            if csv_log.log_level == CsvLog.WARN:
+                counts['skipped_count'] += 1
+            elif csv_log.log_level == CsvLog.ERROR:
+                counts['error_count'] += 1
+            elif csv_log.edit_type == CsvLog.UPDATE:
+                counts['updated_count'] += 1
+            elif csv_log.edit_type == CsvLog.DELETE:
+                counts['deleted_count'] += 1
+            else:
+                counts['inserted_count'] += 1
+        type(self).objects.filter(pk=self.pk).update(
+            updated_at=timezone.now(), **{name: models.F(name) + count for (name, count) in counts.items()})
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def finish(self) -> None:
+        self.finished_at = timezone.now()
+        type(self).objects.filter(pk=self.pk).update(finished_at=self.finished_at, updated_at=self.finished_at)
+
+    @property
+    @admin.display(description=_('duration(s)'))
+    def duration(self) -> Optional[float]:
+        """処理時間(秒)、処理中の場合は現在までの経過時間"""
+        if self.started_at is None:
+            return None
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+    @property
+    @admin.display(description=_('rows/s'))
+    def throughput(self) -> Optional[float]:
+        """1秒あたりの読み込み行数"""
+        duration = self.duration
+        if not duration:
+            return None
+        return round(self.read_count / duration, 1)
@@ -0,0 +1,244 @@
+import codecs
+import io
+import json
+import queue
+import re
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, Type
+from django.db import connection
+from django.db.models import BooleanField, Case, CharField, F, Field, Func, JSONField, Model, Value, When
+from cmm.models import VersionedTable
+
+
+STAGING_TABLE = 'cmm_csv_staging'
+# strftimeの書式をPostgreSQLのto_char()の書式に変換する
+PG_DATE_FORMATS = {'%Y': 'YYYY', '%y': 'YY', '%m': 'MM', '%d': 'DD', '%H': 'HH24', '%I': 'HH12', '%M': 'MI',
+                   '%S': 'SS', '%f': 'US', '%p': 'AM', '%j': 'DDD', '%%': '%'}
+# Pythonのcodec名(codecs.lookup()で正規化した名前)をPostgreSQLのclient encodingに変換する
+PG_ENCODINGS = {'utf-8': 'UTF8', 'shift_jis': 'SJIS', 'cp932': 'SJIS', 'shift_jis_2004': 'SHIFT_JIS_2004',
+                'euc_jp': 'EUC_JP', 'euc_jis_2004': 'EUC_JIS_2004', 'euc_kr': 'EUC_KR', 'gbk': 'GBK', 'big5': 'BIG5',
+                'iso8859-1': 'LATIN1', 'cp1252': 'WIN1252'}
+# COPYのテキスト表記に変換できない項目、これらの項目を持つモデルはBULKで保存する
+COPY_UNSUPPORTED_TYPES = ('ArrayField', 'HStoreField')
+
+
+def is_copy_available() -> bool:
+    """COPYが使えるか、PostgreSQLかつpsycopg2の場合のみ"""
+    return connection.vendor == 'postgresql' and connection.Database.__name__ == 'psycopg2'
+
+
+def get_pg_encoding(encoding: str) -> Optional[str]:
+    """
+    Pythonのcodec名に対応するPostgreSQLのclient encoding、対応するものがない場合はNone
+    (utf-8-sigなどのBOM付きはCOPYで出力できないためNone)
+    """
+    try:
+        return PG_ENCODINGS.get(codecs.lookup(str(encoding)).name)
+    except LookupError:
+        return None
+
+
+def to_copy_value(value: Any) -> str:
+    """
+    COPY FROM STDIN (FORMAT csv)用の値、NULLは引用符なしの\\N、それ以外は常に引用符で囲む
+    bytesはbytea型の16進数表記(\\x...)にする
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '"\\x' + bytes(value).hex() + '"'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def get_copy_fields(model: Type[Model]) -> List[Field]:
+    """COPYで読み込む項目、主キー以外の項目"""
+    return [f for f in model._meta.concrete_fields if not f.primary_key]
+
+
+def is_copy_supported(model: Type[Model]) -> bool:
+    """モデルの全項目をCOPYのテキスト表記に変換できるか、配列、範囲型などの項目を持つ場合はFalse"""
+    return not any(f.get_internal_type() in COPY_UNSUPPORTED_TYPES or f.get_internal_type().endswith('RangeField')
+                   for f in get_copy_fields(model))
+
+
+def get_copy_value(field: Field, value: Any) -> Any:
+    """
+    項目の値をCOPYの値に変換する、get_db_prep_save()はDBドライバーのアダプター(JSONなど)を返す場合があるため使わない
+    値を変換できない場合はValueError、ValidationErrorなどが発生する
+    """
+    value = field.get_prep_value(value)
+    if value is not None and isinstance(field, JSONField):
+        return json.dumps(value, cls=field.encoder)
+    return value
+
+
+def to_copy_row(fields: List[Field], instance: Model) -> str:
+    """instanceをCOPY FROM STDIN (FORMAT csv)の1行に変換する"""
+    return ','.join(to_copy_value(get_copy_value(f, getattr(instance, f.attname))) for f in fields) + '\n'
+
+
+def copy_upsert(model: Type[Model], copy_rows: Iterable[str], unique_fields: Tuple[str, ...],
+                update_fields: List[str], is_overwrite: bool) -> dict[Tuple[Any, ...], bool]:
+    """
+    to_copy_row()で変換した行を一時テーブルにCOPYし、INSERT ... ON CONFLICTで対象テーブルにマージする
+    戻り値は保存した行のUniqueキーと新規登録かどうか(True: INSERT、False: UPDATE)
+    """
+    opts = model._meta
+    qn = connection.ops.quote_name
+    fields = get_copy_fields(model)
+    key_fields = [opts.get_field(name) for name in unique_fields]
+    columns = ', '.join(qn(f.column) for f in fields)
+
+    buffer = io.StringIO()
+    buffer.writelines(copy_rows)
+    buffer.seek(0)
+
+    conflict = ', '.join(qn(f.column) for f in key_fields)
+    if is_overwrite and update_fields:
+        updates = [f'{qn(opts.get_field(name).column)} = EXCLUDED.{qn(opts.get_field(name).column)}'
+                   for name in update_fields]
+        if issubclass(model, VersionedTable):
+            updates.append(f'{qn("version")} = COALESCE(t.{qn("version")}, 0) + 1')
+        on_conflict = f'DO UPDATE SET {", ".join(updates)}'
+    else:
+        on_conflict = 'DO NOTHING'
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMPORARY TABLE {STAGING_TABLE} ON COMMIT DROP AS '
+                       f'SELECT {columns} FROM {qn(opts.db_table)} WITH NO DATA')
+        cursor.copy_expert(f"COPY {STAGING_TABLE} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        cursor.execute(f'INSERT INTO {qn(opts.db_table)} AS t ({columns}) '
+                       f'SELECT {columns} FROM {STAGING_TABLE} '
+                       f'ON CONFLICT ({conflict}) {on_conflict} '
+                       f'RETURNING {", ".join("t." + qn(f.column) for f in key_fields)}, (t.xmax = 0)')
+        results = {tuple(f.to_python(v) for (f, v) in zip(key_fields, row[:-1])): row[-1]
+                   for row in cursor.fetchall()}
+        cursor.execute(f'DROP TABLE {STAGING_TABLE}')
+
+    return results
+
+
+def strftime_to_pg(date_format: str) -> str:
+    """strftimeの書式をto_char()の書式に変換する、書式以外の英字は二重引用符で囲む"""
+    result = []
+    for token in re.split(r'(%.)', date_format):
+        if token in PG_DATE_FORMATS:
+            result.append(PG_DATE_FORMATS[token])
+        elif token.startswith('%') and len(token) == 2:
+            raise ValueError(f'{token} is not supported in COPY export.')
+        elif token:
+            result.append(re.sub(r'([A-Za-z"]+)', lambda m: '"' + m.group(1).replace('"', '\\"') + '"', token))
+    return ''.join(result)
+
+
+def get_copy_expressions(model: Type[Model], field_names: List[str], date_format: str, datetime_format: str) -> dict:
+    """
+    CSV出力でPython側と同じ表記にするためのSQL式
+    日付はto_char()でdate_format/datetime_formatに、真偽値はTrue/Falseに変換する
+    """
+    opts = model._meta
+    expressions = {}
+    for name in field_names:
+        field = opts.get_field(name)
+        internal_type = field.get_internal_type()
+        if internal_type in ('DateField', 'DateTimeField'):
+            pg_format = strftime_to_pg(datetime_format if internal_type == 'DateTimeField' else date_format)
+            expressions[name] = Func(F(name), Value(pg_format), function='to_char', output_field=CharField())
+        elif isinstance(field, BooleanField):
+            expressions[name] = Case(When(**{name: True}, then=Value('True')),
+                                     When(**{name: False}, then=Value('False')), output_field=CharField())
+        else:
+            expressions[name] = F(name)
+    return expressions
+
+
+class _QueueWriter:
+    """copy_expertの出力先、書き込まれたbytesをqueueに渡す、読み込み側が中断した場合はCOPYを中断させる"""
+
+    def __init__(self, content_queue: queue.Queue, cancelled: threading.Event):
+        self.content_queue = content_queue
+        self.cancelled = cancelled
+
+    def write(self, data) -> int:
+        if self.cancelled.is_set():
+            raise IOError('COPY export was cancelled.')
+        self.content_queue.put(bytes(data))
+        return len(data)
+
+
+def open_copy_connection():
+    """
+    COPY TO STDOUT専用のpsycopg2の接続、リクエストの接続とは別にする
+    (COPYのスレッドとリクエストのスレッドで接続を共有せず、中断時はCOPY中の接続をそのまま閉じられるように)
+    日時の書式変換(to_char)の結果をリクエストの接続とそろえるため、タイムゾーンを同じにする
+    """
+    copy_connection = connection.Database.connect(**connection.get_connection_params())
+    copy_connection.autocommit = True
+    with copy_connection.cursor() as cursor:
+        cursor.execute('SET TIME ZONE %s', [connection.timezone_name])
+    return copy_connection
+
+
+def iter_copy_select(open_connection: Callable[[], Any], sql: str, params, pg_encoding: str,
+                     queue_size: int = 16) -> Iterator[bytes]:
+    """
+    open_connection()で開いた接続でCOPY (SELECT ...) TO STDOUTを別スレッドで実行し、受信したbytesを順次返す
+    queueの上限で受信量を抑える、終了時、中断時(iteratorのclose())はCOPYスレッドの終了を待ってから接続を閉じる
+    """
+    copy_connection = open_connection()
+    cancelled = threading.Event()
+    content_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    thread: Optional[threading.Thread] = None
+    try:
+        with copy_connection.cursor() as cursor:
+            select_sql = cursor.mogrify(sql, params).decode(copy_connection.encoding)
+        copy_sql = f"COPY ({select_sql}) TO STDOUT WITH (FORMAT csv, ENCODING '{pg_encoding}')"
+
+        errors: List[BaseException] = []
+        end = object()
+
+        def run_copy():
+            try:
+                with copy_connection.cursor() as copy_cursor:
+                    copy_cursor.copy_expert(copy_sql, _QueueWriter(content_queue, cancelled))
+            except BaseException as e:      # pylint: disable = broad-exception-caught
+                errors.append(e)
+            finally:
+                content_queue.put(end)
+
+        thread = threading.Thread(target=run_copy, name='csv_copy', daemon=True)
+        thread.start()
+        while True:
+            chunk: Optional[Any] = content_queue.get()
+            if chunk is end:
+                break
+            yield chunk
+        if errors:
+            raise errors[0]
+    finally:
+        cancelled.set()
+        # COPYスレッドがqueueの空きを待っている場合に備えて読み捨てる
+        while thread is not None and thread.is_alive():
+            try:
+                content_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if thread is not None:
+            thread.join()
+        copy_connection.close()
+
+
+def iter_copy_csv(queryset, field_names: List[str], date_format: str, datetime_format: str,
+                  encoding: str, queue_size: int = 16) -> Iterator[bytes]:
+    """
+    querysetをCOPY (SELECT ...) TO STDOUTでCSV出力し、受信したbytesを順次返す(ヘッダー行は出力しない)
+    COPYは専用の接続で実行する、open_copy_connection()を参照
+    """
+    expressions = get_copy_expressions(queryset.model, field_names, date_format, datetime_format)
+    alias_names = [f'_csv_{i}' for i in range(len(field_names))]
+    select_queryset = queryset.annotate(**dict(zip(alias_names, expressions.values()))).values_list(*alias_names)
+    sql, params = select_queryset.query.sql_with_params()
+    pg_encoding = get_pg_encoding(encoding)
+    if pg_encoding is None:
+        raise ValueError(f'{encoding} is not supported in COPY export.')
+    return iter_copy_select(open_copy_connection, sql, params, pg_encoding, queue_size)
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from typing import Optional
+from django.conf import settings
+from django.core.files import File
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+from django.utils.translation import gettext as _
+from cmm.csv import CsvLotSummary, CsvUploadJob
+
+
+_logger = logging.getLogger(__name__)
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_upload_executor() -> ThreadPoolExecutor:
+    """アップロードジョブを実行するプロセス内のスレッドプール、最初の利用時に生成する"""
+    global _executor    # pylint: disable = global-statement
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'CSV_UPLOAD_WORKERS', 2),
+                                           thread_name_prefix='csv_upload')
+        return _executor
+
+
+def get_spool_dir() -> str:
+    spool_dir: str = getattr(settings, 'CSV_UPLOAD_SPOOL_DIR', os.path.join(settings.MEDIA_ROOT, 'csv_upload'))
+    os.makedirs(spool_dir, exist_ok=True)
+    return spool_dir
+
+
+def spool_upload_file(uploaded_file, lot_number: str) -> str:
+    """アップロードファイルをディスクに書き出す、InMemoryUploadedFileはリクエスト終了後に使えないため"""
+    spool_path = os.path.join(get_spool_dir(), f'{lot_number}.csv')
+    with open(spool_path, 'wb') as spool_file:
+        for chunk in uploaded_file.chunks():
+            spool_file.write(chunk)
+    return spool_path
+
+
+def run_upload_job(model_admin, job_id: int) -> None:
+    """
+    ジョブを実行する、model_adminはリクエストごとにコピーしたインスタンスを渡すこと
+    (csv_file、user_name、lot_numberをインスタンスに保持するため)
+    状態はfail_stale_upload_job()と競合するため、想定した状態の場合のみ条件付きのUPDATEで更新する
+    """
+    job = CsvUploadJob.objects.get(pk=job_id)
+    try:
+        if not _update_job_status(job, CsvUploadJob.QUEUED, status=CsvUploadJob.RUNNING):
+            return
+
+        values = {}
+        try:
+            with open(job.spool_path, 'rb') as spool_file:
+                model_admin.csv_file = File(spool_file, name=job.file_name)
+                model_admin.user_name = job.creator
+                model_admin.lot_number = job.lot_number
+                values = {'status': CsvUploadJob.FINISHED, 'row_count': model_admin.read_csv_file()}
+        except Exception as e:      # pylint: disable = broad-exception-caught
+            _logger.exception('CSV upload job %s failed.', job.lot_number)
+            values = {'status': CsvUploadJob.FAILED, 'message': str(e)[:2048]}
+        _update_job_status(job, CsvUploadJob.RUNNING, **values)
+    finally:
+        if job.spool_path and os.path.exists(job.spool_path):
+            os.remove(job.spool_path)
+
+
+def _update_job_status(job: CsvUploadJob, expected_status: str, **values) -> bool:
+    """
+    ジョブがexpected_statusの場合のみ更新する、更新できなかった場合(失敗にされたジョブ)はログを出力してFalseを返す
+    """
+    updated = CsvUploadJob.objects.filter(pk=job.pk, status=expected_status).update(
+        updated_at=timezone.now(), version=F('version') + 1, **values)
+    job.refresh_from_db()
+    if not updated:
+        _logger.warning('CSV upload job %s was not %s but %s, %s was not recorded.',
+                        job.lot_number, expected_status, job.status, values.get('status'))
+    return bool(updated)
+
+
+def fail_stale_upload_job(job: CsvUploadJob) -> CsvUploadJob:
+    """
+    待機中、実行中のまま更新が止まったジョブを失敗にする
+    ジョブはプロセス内のスレッドプールで実行するため、プロセスが再起動した場合は再開されずに状態だけが残る
+    ジョブとCsvLotSummary(chunkごとに更新される)の最終更新からCSV_UPLOAD_JOB_TIMEOUT秒(既定は1時間)経過した場合に失敗とする
+    """
+    if job.is_done:
+        return job
+    summary_updated_at = CsvLotSummary.objects.filter(lot_number=job.lot_number) \
+        .values_list('updated_at', flat=True).first()
+    last_activity = max(t for t in (job.updated_at, job.created_at, summary_updated_at) if t is not None)
+    timeout = timedelta(seconds=getattr(settings, 'CSV_UPLOAD_JOB_TIMEOUT', 3600))
+    if timezone.now() - last_activity < timeout:
+        return job
+
+    # ワーカーが同時に状態を更新した場合はそちらを優先する
+    _logger.warning('CSV upload job %s has not been updated since %s, marking it failed.',
+                    job.lot_number, last_activity)
+    CsvUploadJob.objects.filter(pk=job.pk, status=job.status, version=job.version).update(
+        status=CsvUploadJob.FAILED, message=_('The upload job was interrupted. Please upload the file again.'),
+        updated_at=timezone.now(), version=F('version') + 1)
+    job.refresh_from_db()
+    return job
+
+
+def _run_in_worker(model_admin, job_id: int) -> None:
+    try:
+        run_upload_job(model_admin, job_id)
+    finally:
+        connections.close_all()     # ワーカースレッドのDB接続を閉じる
+
+
+def submit_upload_job(model_admin, job: CsvUploadJob) -> Future:
+    return get_upload_executor().submit(_run_in_worker, model_admin, job.pk)
@@ -1,16 +1,21 @@
+import copy
 import logging
-from typing import Tuple
+from typing import Optional, Tuple
 
+from django.contrib.admin.views.main import PAGE_VAR
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
 from django.db import transaction
 from django.forms import FileField, Form
+from django.http import Http404, JsonResponse
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
-from django.urls import path, reverse_lazy
+from django.urls import path, reverse, reverse_lazy
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
-from cmm.csv import CsvLog
-from cmm.logging import log_decorator
+from cmm.csv import CsvLog, CsvLotSummary, CsvUploadJob
+from cmm.csv.upload_job import fail_stale_upload_job, spool_upload_file, submit_upload_job
+from cmm.logging import log_decorator, set_log_row_count
 
 
 UPLOAD_CSV = 'upload_csv'
@@ -32,6 +37,11 @@ class UploadMixin:
 
     # change_list_template = 'cmm/change_list_with_csv_upload.html'
     upload_template = 'cmm/csv_upload.html'
+    upload_progress_template = 'cmm/csv_upload_progress.html'
+    # このサイズ(byte)を超えるファイルはバックグラウンドで取り込む、Noneの場合は常にリクエスト内で取り込む
+    background_upload_size: Optional[int] = 1024 * 1024
+    # エラー画面の1ページあたりの表示行数
+    upload_error_per_page = 100
 
     def has_upload_csv_permission(self, request) -> bool:
         """CSV upload権限有無のチェック"""
@@ -51,12 +61,116 @@ class UploadMixin:
         upload_url = [
             path('csv_upload/', self.admin_site.admin_view(self.upload_action),
                  name=f'{opts.app_label}_{opts.model_name}_csv_upload'),
+            path('csv_upload/<str:lot_number>/progress/', self.admin_site.admin_view(self.upload_progress_view),
+                 name=f'{opts.app_label}_{opts.model_name}_csv_upload_progress'),
+            path('csv_upload/<str:lot_number>/status/', self.admin_site.admin_view(self.upload_status_view),
+                 name=f'{opts.app_label}_{opts.model_name}_csv_upload_status'),
+            path('csv_upload/<str:lot_number>/errors/', self.admin_site.admin_view(self.upload_error_view),
+                 name=f'{opts.app_label}_{opts.model_name}_csv_upload_errors'),
         ]
         return upload_url + super().get_urls()
 
     def read_csv_file(self, csv_file, login_user_name: str) -> Tuple[int, str]:
         raise NotImplementedError("Subclasses must implement my_abstract_method")
 
+    def is_background_upload(self, csv_file) -> bool:
+        """バックグラウンドで取り込むかどうか"""
+        return self.background_upload_size is not None and csv_file.size > self.background_upload_size
+
+    def submit_upload_job(self, job: CsvUploadJob) -> None:
+        """ジョブをワーカープールに登録する、adminインスタンスはリクエスト間で共有されるためコピーして渡す"""
+        submit_upload_job(copy.copy(self), job)
+
+    def get_upload_job(self, request, lot_number: str) -> CsvUploadJob:
+        """このモデルのジョブ、更新が止まったジョブ(プロセスの再起動などで中断されたジョブ)は失敗にする"""
+        if not self.has_upload_csv_permission(request):
+            raise PermissionDenied
+        try:
+            job = CsvUploadJob.objects.get(lot_number=lot_number,
+                                           model_name=self.model._meta.label_lower)  # type: ignore[attr-defined]
+        except CsvUploadJob.DoesNotExist as e:
+            raise Http404 from e
+        return fail_stale_upload_job(job)
+
+    def upload_progress_view(self, request, lot_number: str):
+        """バックグラウンドジョブの進捗画面、upload_status_viewをポーリングして表示を更新する"""
+        job = self.get_upload_job(request, lot_number)
+        # pylint: disable = protected-access
+        opts = self.model._meta
+        context = {
+            **self.admin_site.each_context(request),
+            'title': _('Upload %(name)s') % {'name': opts.verbose_name},
+            'opts': opts,
+            'has_view_permission': self.has_view_permission(request),
+            'job': job,
+            'status_url': reverse(f'{self.admin_site.name}:{opts.app_label}_{opts.model_name}_csv_upload_status',
+                                  args=[lot_number]),
+        }
+        return TemplateResponse(request, self.upload_progress_template, context)
+
+    def upload_status_view(self, request, lot_number: str):
+        """
+        ジョブの状態と処理済み行数、エラー件数を返す
+        件数はCsvLotSummaryから取得し、集計がないロット(集計テーブル追加前のロット)はCsvLogから集計する
+        """
+        job = self.get_upload_job(request, lot_number)
+        summary = CsvLotSummary.objects.filter(lot_number=lot_number).first()
+        if summary is not None:
+            processed, skipped, discarded = summary.read_count, summary.skipped_count, summary.error_count
+        else:
+            counts = CsvLog.count_by_log_level(lot_number)
+            processed, skipped, discarded = sum(counts.values()), counts.get(CsvLog.WARN, 0), \
+                counts.get(CsvLog.ERROR, 0)
+        return JsonResponse({
+            'status': job.status,
+            'status_display': str(job.get_status_display()),
+            'is_done': job.is_done,
+            'processed': processed,
+            'skipped': skipped,
+            'discarded': discarded,
+            'message': job.message,
+        })
+
+    @staticmethod
+    def get_upload_result_info(summary: CsvLotSummary) -> str:
+        uploaded = summary.inserted_count + summary.updated_count + summary.deleted_count
+        return _('Upload result: uploaded %(imp)s rows, skipped %(skip)s rows and discarded: %(dis)s rows.') % {
+            'imp': uploaded, 'skip': summary.skipped_count, 'dis': summary.error_count}
+
+    def upload_error_view(self, request, lot_number: str):
+        """読み飛ばした行とエラーで破棄した行の一覧、CsvLogをページ単位で読み込む"""
+        if not self.has_upload_csv_permission(request):
+            raise PermissionDenied
+        try:
+            summary = CsvLotSummary.objects.get(lot_number=lot_number,
+                                                model_name=self.model._meta.label_lower)  # type: ignore[attr-defined]
+        except CsvLotSummary.DoesNotExist as e:
+            raise Http404 from e
+
+        # エラー(error)、読み飛ばし(warn)の順に行番号順で表示する
+        queryset = CsvLog.objects.filter(lot_number=lot_number, log_level__in=[CsvLog.ERROR, CsvLog.WARN]) \
+            .exclude(row_no=CsvLog.SUMMARY_ROW_NO).order_by('log_level', 'row_no')
+        paginator = Paginator(queryset, self.upload_error_per_page)
+        # 件数はCOUNT(*)を発行せずに集計テーブルの値を使う
+        paginator.count = summary.skipped_count + summary.error_count
+        page = paginator.get_page(request.GET.get(PAGE_VAR))
+
+        # pylint: disable = protected-access
+        opts = self.model._meta
+        context = {
+            **self.admin_site.each_context(request),
+            'title': _('%(name)s upload errors') % {'name': opts.verbose_name},
+            'opts': opts,
+            'has_view_permission': self.has_view_permission(request),
+            'field_names': self.csv_headers,
+            'csv_logs': [csv_log.convert_content2values() for csv_log in page],
+            'page': page,
+            'page_range': paginator.get_elided_page_range(page.number),
+            'page_var': PAGE_VAR,
+            'info': self.get_upload_result_info(summary),
+        }
+        return TemplateResponse(request, 'cmm/csv_upload_error.html', context)
+
     @transaction.non_atomic_requests
     @log_decorator
     def upload_action(self, request):
@@ -87,29 +201,32 @@ class UploadMixin:
                 self.csv_file = form.cleaned_data['upload_file']  # django.core.files.uploadedfile.InMemoryUploadedFile
                 self.user_name = request.user.username
                 self.lot_number = str(hash(self.csv_file.name + self.user_name + str(timezone.now())))
+
+                # 大きいファイルはディスクに書き出してバックグラウンドで取り込み、進捗画面に遷移する
+                if self.is_background_upload(self.csv_file):
+                    _logger.info('Queueing CSV file %s into %s.', self.csv_file.name, opts.model_name)
+                    job = CsvUploadJob.objects.create(lot_number=self.lot_number, file_name=self.csv_file.name,
+                                                      model_name=opts.label_lower,
+                                                      spool_path=spool_upload_file(self.csv_file, self.lot_number),
+                                                      updater=self.user_name)
+                    self.submit_upload_job(job)
+                    return redirect(reverse(
+                        f'{request.resolver_match.namespace}:{opts.app_label}_{opts.model_name}_csv_upload_progress',
+                        args=[self.lot_number]))
+
                 _logger.info('Importing CSV file %s into %s.', self.csv_file.name, opts.model_name)
 
                 # インポートファイルの読み込み処理
                 row_cnt = self.read_csv_file()
-
-                # ログ情報収集
-                queryset = CsvLog.objects.filter(lot_number=self.lot_number)
-                # 読み飛ばしたレコード
-                skipped = list(queryset.filter(log_level=CsvLog.WARN).order_by('row_no'))
-                # エラーで破棄したレコード
-                discarded = list(queryset.filter(log_level=CsvLog.ERROR).order_by('row_no'))
-                uploaded = row_cnt - self.header_row_number - len(skipped) - len(discarded)
-                info = _('Upload result: uploaded %(imp)s rows, skipped %(skip)s rows and discarded: %(dis)s rows.'
-                         ) % {'imp': uploaded, 'skip': len(skipped), 'dis': len(discarded)}
-                _logger.info(info)
-
-                if discarded or skipped:
-                    context['title'] = _('%(name)s upload errors') % {'name': opts.verbose_name}
-                    context['field_names'] = self.csv_headers
-                    context['csv_logs'] = [csv_log.convert_content2values() for csv_log in discarded] \
-                        + [csv_log.convert_content2values() for csv_log in skipped]
-                    context['info'] = info
-                    return TemplateResponse(request, 'cmm/csv_upload_error.html', context)
+                set_log_row_count(row_cnt)
+
+                _logger.info('%s rows read.', row_cnt)
+                # 取り込み結果はCsvLotSummaryの件数で判定し、エラー行はエラー画面でページごとに表示する
+                _logger.info(self.get_upload_result_info(self.lot_summary))
+                if self.lot_summary.skipped_count or self.lot_summary.error_count:
+                    return redirect(reverse(
+                        f'{request.resolver_match.namespace}:{opts.app_label}_{opts.model_name}_csv_upload_errors',
+                        args=[self.lot_number]))
 
                 return redirect(reverse_lazy(
                     f'{request.resolver_match.namespace}:{opts.app_label}_{opts.model_name}_changelist'))
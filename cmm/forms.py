@@ -16,3 +16,10 @@ def get_modelform_error_messages(modelform: ModelForm) -> Dict[str, list[str]]:
 def get_modelform_non_unique_error_codes(modelform: ModelForm) -> Set[str]:
     """Unique constraint違反以外のModelFormのエラーコード"""
     return get_modelform_error_codes(modelform).difference({'unique', 'unique_together'})
+
+
+class NoUniqueValidationModelForm(ModelForm):
+    """Unique制約のチェック(行ごとのDB検索)を行わないModelForm、チェックは呼び出し側でまとめて行う"""
+
+    def validate_unique(self):
+        """Unique制約のチェックを行わない"""
@@ -1,58 +1,332 @@
+from contextvars import ContextVar
 from logging import Filter
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, List, Optional
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.models import Model, QuerySet
+from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject, empty
+import atexit
+import copy
+import functools
 import logging
+import os
+import queue
+import sys
 import threading
+import time
+import weakref
 
 
-local = threading.local()
+class LogRequestContext:
+    """ログに出力するリクエストの属性、リクエストごとにContextVarで保持する"""
+    __slots__ = ('request', 'username', 'ip_address', 'session_key')
+
+    def __init__(self, request, username: Optional[str] = None):
+        self.request = request
+        self.username = username
+
+        # remote ip address, reverse proxyが使用されている場合、REMOTE_ADDRはproxyサーバーのIPアドレスになる
+        # X-Forwarded-Forは"client, proxy1, proxy2"の形式のため、先頭のIPアドレスを使う
+        forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+        self.ip_address = forwarded_for.split(',')[0].strip() if forwarded_for else request.META.get('REMOTE_ADDR')
+
+        # session key、sessionの読み込みは行わない(cookieの値)
+        session = getattr(request, 'session', None)
+        self.session_key = getattr(session, 'session_key', None)
+
+    def get_username(self) -> Optional[str]:
+        """
+        ユーザー名、非同期のリクエストではDBアクセスを避けるため、
+        request.userが他の処理で読み込み済みの場合のみ取得する
+        """
+        if self.username is None:
+            user = getattr(self.request, 'user', None)
+            if isinstance(user, SimpleLazyObject):
+                user = None if user._wrapped is empty else user._wrapped    # pylint: disable = protected-access
+            self.username = getattr(user, 'username', None)
+        return self.username
+
+
+_request_context: ContextVar[Optional[LogRequestContext]] = ContextVar('cmm_log_request_context', default=None)
+
+
+def get_request_context() -> Optional[LogRequestContext]:
+    """実行中のリクエストのログ属性、リクエスト外ではNone"""
+    return _request_context.get()
 
 
 class LoggingRequestAttributesMiddleware:
-    """IPアドレスとログインユーザー名を取得する"""
+    """
+    IPアドレスとログインユーザー名を取得する
+    ContextVarに保持するため、ASGIで複数のリクエストを並行して処理してもリクエスト間で混ざらない
+    同期、非同期どちらのmiddlewareチェーンでもスレッドの切り替えなしで動作する
+    """
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        # username
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        # 同期の場合は従来どおりrequest.userを読み込む
         try:
             username = request.user.username if request.user else None
-            setattr(local, 'log_username', username)
         except AttributeError:
-            ...
-
-        # remote ip address, reverse proxyが使用されている場合、REMOTE_ADDRはproxyサーバーのIPアドレスになる
-        ip_address = request.META.get('REMOTE_ADDR')
-        if request.META.get('HTTP_X_FORWARDED_FOR') is not None:
-            ip_address = request.META.get('HTTP_X_FORWARDED_FOR')[0]
-        setattr(local, 'log_ip_address', ip_address)
-
-        # session key
+            username = None
+        token = _request_context.set(LogRequestContext(request, username))
         try:
-            setattr(local, 'log_session_key', request.session.session_key)
-        except AttributeError:
-            ...
-
-        response = self.get_response(request)
-
-        # clear attributes on response
-        # setattr(local, 'log_username', None)
-        # setattr(local, 'log_ip_address', None)
-        # setattr(local, 'log_session_key', None)
+            return self.get_response(request)
+        finally:
+            _request_context.reset(token)
 
-        return response
+    async def __acall__(self, request):
+        token = _request_context.set(LogRequestContext(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            _request_context.reset(token)
 
 
 class LoggingRequestAttributesFilter(Filter):
     """IPアドレスとログインユーザー名を取得する"""
     def filter(self, record):
-        record.username = getattr(local, 'log_username', None)
-        record.ip_address = getattr(local, 'log_ip_address', None)
-        record.session_key = getattr(local, 'log_session_key', None)
+        """
+        出力元のスレッドで設定済みの場合は上書きしない
+        (QueueListenerHandler経由の場合、出力先のhandlerのfilterはバックグラウンドスレッドで実行されるため)
+        """
+        context = _request_context.get()
+        if not hasattr(record, 'username'):
+            record.username = context.get_username() if context else None
+        if not hasattr(record, 'ip_address'):
+            record.ip_address = context.ip_address if context else None
+        if not hasattr(record, 'session_key'):
+            record.session_key = context.session_key if context else None
 
         return True
 
 
+class _BoundedQueueListener(QueueListener):
+    """終了時のsentinelは、queueが満杯でも空きを待って登録する"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    ログの整形とファイル出力をバックグラウンドスレッドで行うhandler
+    出力元のスレッドではfilterの実行とqueueへの登録のみ行い、handlersに指定したhandlerへの出力はQueueListenerが行う
+    同じプロセス内のqueueのため、recordは整形せずに(msg、args、exc_infoを保持したまま)登録する
+    queueが満杯の場合はログを破棄して件数を数え、空きができた時点で破棄件数をWARNINGで出力する
+    プロセス終了時(atexit)にqueueに残ったログを出力してから停止する、fork後の子プロセスでは最初の出力時に開始し直す
+    LOGGINGの設定例(Python 3.12以降のQueueHandlerの特別扱いを避けるため、classではなく'()'で指定する):
+        'app_log_async': {
+            '()': 'cmm.logging.QueueListenerHandler',
+            'handlers': ['app_log'],
+            'queue_size': 10000,
+            'filters': ['extra_attributes'],
+        },
+    """
+
+    def __init__(self, handlers: List[str], queue_size: int = 10000, respect_handler_level: bool = True):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.queue_size = queue_size
+        self.handler_names = list(handlers)
+        self.target_handlers = self.resolve_handlers(self.handler_names)
+        self.respect_handler_level = respect_handler_level
+        self.listener: Optional[QueueListener] = None
+        self.enqueued_count = 0
+        self.dropped_count = 0
+        self.__unreported_drops = 0
+        self.__lock = threading.Lock()
+        # 件数とqueueへの登録は複数のスレッドから行われるため、listenerの開始とは別のlockで保護する
+        self.__enqueue_lock = threading.Lock()
+        _queue_listener_handlers.add(self)
+
+    @staticmethod
+    def get_handler_by_name(name: str) -> Optional[logging.Handler]:
+        """dictConfigで作成したhandler、Python 3.12未満はgetHandlerByNameがないため内部の辞書を参照する"""
+        if hasattr(logging, 'getHandlerByName'):
+            return logging.getHandlerByName(name)
+        return logging._handlers.get(name)     # pylint: disable = protected-access
+
+    @classmethod
+    def resolve_handlers(cls, names: List[str]) -> List[logging.Handler]:
+        """
+        出力先のhandlerを名前で解決する、loggerに登録されていないhandlerは弱参照のみのためここで参照を保持する
+        dictConfigはhandlerを名前順に作成するため、出力先より後ろになる名前(出力先の名前 + '_async'等)を付けること
+        """
+        handlers = [cls.get_handler_by_name(name) for name in names]
+        missing = [name for (name, handler) in zip(names, handlers) if handler is None]
+        if missing:
+            raise ValueError(f'Unknown logging handlers: {", ".join(missing)}')
+        return handlers
+
+    def start(self) -> None:
+        """QueueListenerを開始する、最初の出力時に行う"""
+        with self.__lock:
+            if self.listener is not None:
+                return
+            self.listener = _BoundedQueueListener(self.queue, *self.target_handlers,
+                                                  respect_handler_level=self.respect_handler_level)
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """queueに残ったログを出力してからQueueListenerを停止する"""
+        with self.__lock:
+            listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+            atexit.unregister(self.stop)
+        if self.dropped_count:
+            sys.stderr.write(f'{self.dropped_count} log records were dropped because the log queue was full.\n')
+
+    def reset_after_fork(self) -> None:
+        """fork後の子プロセス用、親プロセスのQueueListenerのスレッドは子プロセスには存在しないため作り直す"""
+        if self.listener is not None:
+            atexit.unregister(self.stop)
+        self.listener = None
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.enqueued_count = 0
+        self.dropped_count = 0
+        self.__unreported_drops = 0
+        self.__lock = threading.Lock()
+        self.__enqueue_lock = threading.Lock()
+
+    def prepare(self, record):
+        """
+        整形はQueueListenerのスレッドで出力先のhandlerが行うため、recordをコピーするのみとする
+        (QueueHandler.prepareは出力元のスレッドでformat()を実行し、msgを整形済みの文字列に置き換える)
+        """
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        if self.listener is None:
+            self.start()
+        with self.__enqueue_lock:
+            try:
+                if self.__unreported_drops:
+                    self.queue.put_nowait(self.__make_drop_record(record))
+                    self.__unreported_drops = 0
+                self.queue.put_nowait(record)
+                self.enqueued_count += 1
+            except queue.Full:
+                self.dropped_count += 1
+                self.__unreported_drops += 1
+
+    def __make_drop_record(self, record) -> logging.LogRecord:
+        drop_record = logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                        '%d log records were dropped because the log queue was full.',
+                                        (self.__unreported_drops, ), None)
+        for name in ('username', 'ip_address', 'session_key'):
+            setattr(drop_record, name, getattr(record, name, None))
+        return drop_record
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+_queue_listener_handlers: 'weakref.WeakSet[QueueListenerHandler]' = weakref.WeakSet()
+
+
+def _reset_queue_listener_handlers_after_fork() -> None:
+    for handler in list(_queue_listener_handlers):
+        handler.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_queue_listener_handlers_after_fork)
+
+
+def summarize_argument(value: Any) -> str:
+    """
+    ログ出力用の引数の要約、repr()は使わない
+    QuerySetのrepr()はクエリを実行し、HttpRequestのrepr()は大きいため、型と識別情報のみ出力する
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return str(value)
+    if isinstance(value, str):
+        return repr(value if len(value) <= 64 else value[:64] + '...')
+    if isinstance(value, QuerySet):
+        # 評価済みの場合のみ件数を出力する
+        result_cache = value._result_cache      # pylint: disable = protected-access
+        count = '' if result_cache is None else f' count={len(result_cache)}'
+        return f'<QuerySet {value.model._meta.label}{count}>'
+    if isinstance(value, HttpRequest):
+        return f'<{type(value).__name__} {value.method} {value.path}>'
+    if isinstance(value, Model):
+        return f'<{value._meta.label} pk={value.pk}>'
+    if hasattr(value, 'admin_site') and hasattr(value, 'model'):     # ModelAdmin
+        return f'<{type(value).__name__} {value.model._meta.label}>'
+    return f'<{type(value).__module__}.{type(value).__qualname__}>'
+
+
+class _LazyArguments:
+    """ログを出力する時点で引数を要約する"""
+    __slots__ = ('args', 'kwargs')
+
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        values = [summarize_argument(v) for v in self.args]
+        values += [f'{k}={summarize_argument(v)}' for (k, v) in self.kwargs.items()]
+        return ', '.join(values)
+
+
+_row_count: ContextVar[Optional[List[int]]] = ContextVar('cmm_log_row_count', default=None)
+
+
+def set_log_row_count(row_count: int) -> None:
+    """
+    log_decoratorを付けた関数の中から、処理した行数をログのrow_countに設定する
+    log_decoratorの外で呼び出した場合は何もしない
+    """
+    counter = _row_count.get()
+    if counter is not None:
+        counter[:] = [row_count]
+
+
 def log_decorator(func):
+    """
+    関数の呼び出しをINFOで記録する、経過時間(elapsed_ms)をextraに設定する
+    関数の中でset_log_row_count()を呼び出した場合は、その行数(row_count)もextraに設定する
+    例外が発生した場合はERRORでtracebackとともに記録する
+    引数の要約はログの出力時に行い、QuerySetを評価しない
+    """
+    logger = logging.getLogger(func.__module__)
+
+    def get_extra(start: float, counter: List[int]) -> dict:
+        extra: dict = {'elapsed_ms': (time.perf_counter() - start) * 1000}
+        if counter:
+            extra['row_count'] = counter[0]
+        return extra
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logging.info(f'{func.__name__} was called with parameter {args}, {kwargs}')
-        return func(*args, **kwargs)
+        counter: List[int] = []
+        token = _row_count.set(counter)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            extra = get_extra(start, counter)
+            logger.error('%s(%s) raised an exception in %.1f ms', func.__qualname__, _LazyArguments(args, kwargs),
+                         extra['elapsed_ms'], exc_info=True, extra=extra)
+            raise
+        finally:
+            _row_count.reset(token)
+        extra = get_extra(start, counter)
+        logger.info('%s(%s) finished in %.1f ms', func.__qualname__, _LazyArguments(args, kwargs),
+                    extra['elapsed_ms'], extra=extra)
+        return result
     return wrapper
@@ -0,0 +1,128 @@
+from datetime import date, datetime
+from typing import Optional
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from cmm.csv import CsvLog
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class Command(BaseCommand):
+    """
+    cmm_csv_logをcreated_atの月単位でパーティション化する(PostgreSQLのみ)
+    --convertはDjangoのマイグレーションを経由せずに主キー、Unique制約(created_atを追加)とidのDEFAULTを作り替える
+    変換後はマイグレーションの状態と実際のテーブル定義が一致しないため、cmm_csv_logを変更するマイグレーションは
+    makemigrationsの出力をそのまま使わず、パーティションテーブルに合わせたRunSQLで手書きすること
+    """
+    help = ('Partition cmm_csv_log by month of created_at (PostgreSQL only). '
+            'The first run with --convert rebuilds the table; later runs create upcoming partitions. '
+            'Run it monthly so that new rows never fall into the default partition. '
+            'After --convert, migrations that touch cmm_csv_log must be hand-written (RunSQL), '
+            'because the primary key and unique constraint no longer match the migration state.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true',
+                            help='Rebuild the existing table as a partitioned table and copy its rows. '
+                                 'The primary key and unique key are changed outside Django migrations.')
+        parser.add_argument('--months-ahead', type=int, default=3, help='Number of future monthly partitions.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning is only supported on PostgreSQL.')
+
+        table = CsvLog._meta.db_table
+        with transaction.atomic():
+            if not self.__is_partitioned(table):
+                if not options['convert']:
+                    raise CommandError(f'{table} is not partitioned. Run with --convert to rebuild it.')
+                self.__convert(table)
+            created = self.__create_partitions(table, options['months_ahead'])
+        self.stdout.write(self.style.SUCCESS(f'{created} partitions created.'))
+
+    @staticmethod
+    def __is_partitioned(table: str) -> bool:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(%s)", [table])
+            row = cursor.fetchone()
+        if row is None:
+            raise CommandError(f'{table} does not exist. Run migrate first.')
+        return row[0] == 'p'
+
+    def __convert(self, table: str) -> None:
+        """
+        既存テーブルをcreated_atのRANGEパーティションのテーブルに作り替える
+        パーティションテーブルの主キーとUnique制約にはパーティションキーを含める必要があるため、created_atを追加する
+        (lot_number, file_name, row_noの一意性はcreated_atを含めた組み合わせでのみ保証される)
+        IDENTITY列はパーティションテーブルで使えないため、シーケンスのDEFAULTに置き換える
+        """
+        qn = connection.ops.quote_name
+        old_table = f'{table}_old'
+        sequence = f'{table}_pid_seq'
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+            cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}')
+            cursor.execute(f'CREATE TABLE {qn(table)} (LIKE {qn(old_table)} INCLUDING DEFAULTS) '
+                           f'PARTITION BY RANGE ({qn("created_at")})')
+            cursor.execute(f'CREATE SEQUENCE {qn(sequence)} OWNED BY {qn(table)}.{qn("id")}')
+            cursor.execute(f"ALTER TABLE {qn(table)} ALTER COLUMN {qn('id')} SET DEFAULT nextval('{sequence}')")
+            # created_atがNULLの行とパーティション未作成の期間の行の受け皿
+            cursor.execute(f'CREATE TABLE {qn(table + "_default")} PARTITION OF {qn(table)} DEFAULT')
+
+            cursor.execute(f'SELECT MIN({qn("created_at")}) FROM {qn(old_table)}')
+            first_created_at = cursor.fetchone()[0]
+            if first_created_at is not None:
+                self.__create_partitions(table, 0, timezone.localtime(first_created_at).date())
+
+            # 旧テーブルの制約とインデックスを、名前を変えて作り直す(旧テーブル削除後に元の名前に戻す)
+            renames = []
+            for name, constraint in constraints.items():
+                if not constraint['index'] and not constraint['primary_key'] and not constraint['unique']:
+                    continue
+                if constraint['foreign_key'] or constraint['check']:
+                    continue
+                columns = list(constraint['columns'])
+                temp_name = f'{name[:50]}_part'
+                if constraint['primary_key'] or constraint['unique']:
+                    if 'created_at' not in columns:
+                        columns.append('created_at')
+                    kind = 'PRIMARY KEY' if constraint['primary_key'] else 'UNIQUE'
+                    cursor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(temp_name)} '
+                                   f'{kind} ({", ".join(qn(c) for c in columns)})')
+                else:
+                    cursor.execute(f'CREATE INDEX {qn(temp_name)} ON {qn(table)} '
+                                   f'({", ".join(qn(c) for c in columns)})')
+                renames.append((temp_name, name))
+
+            cursor.execute(f'INSERT INTO {qn(table)} SELECT * FROM {qn(old_table)}')
+            cursor.execute(f"SELECT setval('{sequence}', COALESCE(MAX({qn('id')}), 0) + 1, false) "
+                           f"FROM {qn(table)}")
+            cursor.execute(f'DROP TABLE {qn(old_table)}')
+            for temp_name, name in renames:
+                cursor.execute(f'ALTER INDEX {qn(temp_name)} RENAME TO {qn(name)}')
+        self.stdout.write(f'{table} converted to a partitioned table.')
+
+    def __create_partitions(self, table: str, months_ahead: int, first_month: Optional[date] = None) -> int:
+        """first_month(省略時は今月)から今月+months_aheadまでの月単位のパーティションを作成する"""
+        qn = connection.ops.quote_name
+        this_month = timezone.localdate().replace(day=1)
+        month = (first_month or this_month).replace(day=1)
+        last_month = _add_months(this_month, months_ahead)
+        created = 0
+        with connection.cursor() as cursor:
+            while month <= last_month:
+                partition = f'{table}_p{month:%Y%m}'
+                cursor.execute("SELECT to_regclass(%s) IS NULL", [partition])
+                if cursor.fetchone()[0]:
+                    next_month = _add_months(month, 1)
+                    cursor.execute(f'CREATE TABLE {qn(partition)} PARTITION OF {qn(table)} '
+                                   f'FOR VALUES FROM (%s) TO (%s)',
+                                   [timezone.make_aware(datetime(month.year, month.month, 1)),
+                                    timezone.make_aware(datetime(next_month.year, next_month.month, 1))])
+                    self.stdout.write(f'partition {partition} created')
+                    created += 1
+                month = _add_months(month, 1)
+        return created
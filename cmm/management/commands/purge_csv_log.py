@@ -0,0 +1,108 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from cmm.csv import CsvLog, CsvUploadJob
+
+
+class Command(BaseCommand):
+    help = 'Delete CSV logs whose lot is older than the retention period, optionally archiving them first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'CSV_LOG_RETENTION_DAYS', 90),
+                            help='Retention period in days (default: settings.CSV_LOG_RETENTION_DAYS).')
+        parser.add_argument('--archive-dir', default=None,
+                            help='Write each lot to <archive-dir>/<lot_number>.jsonl.gz before deleting it.')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows deleted per statement.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report the lots to be deleted.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError('--days must be 0 or greater.')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        archive_dir = options['archive_dir']
+        if archive_dir and not options['dry_run']:
+            os.makedirs(archive_dir, exist_ok=True)
+
+        # ロットの途中で削除しないように、最後の行が保存期間を過ぎたロットのみ対象にする
+        lot_numbers = list(CsvLog.objects.filter(lot_number__isnull=False).values('lot_number')
+                           .annotate(last_created_at=Max('created_at')).filter(last_created_at__lt=cutoff)
+                           .order_by('lot_number').values_list('lot_number', flat=True))
+
+        total = 0
+        for lot_number in lot_numbers:
+            queryset = CsvLog.objects.filter(lot_number=lot_number)
+            if options['dry_run']:
+                self.stdout.write(f'{lot_number}: {queryset.count()} rows')
+                continue
+            if archive_dir:
+                self.__archive_lot(queryset, os.path.join(archive_dir, f'{lot_number}.jsonl.gz'))
+            deleted = self.__delete_in_batches(queryset, options['batch_size'])
+            CsvUploadJob.objects.filter(lot_number=lot_number).delete()
+            self.stdout.write(f'{lot_number}: {deleted} rows deleted')
+            total += deleted
+
+        # ロット番号のないログ(ダウンロードなど)は作成日時で判定する
+        if not options['dry_run']:
+            queryset = CsvLog.objects.filter(lot_number__isnull=True, created_at__lt=cutoff)
+            if archive_dir and queryset.exists():
+                self.__archive_lot(queryset, os.path.join(archive_dir, f'no_lot_{cutoff:%Y%m%d}.jsonl.gz'))
+            total += self.__delete_in_batches(queryset, options['batch_size'])
+            self.__drop_expired_partitions(cutoff)
+
+        self.stdout.write(self.style.SUCCESS(f'{len(lot_numbers)} lots, {total} rows purged before {cutoff:%Y-%m-%d}.'))
+
+    @staticmethod
+    def __archive_lot(queryset, archive_path: str) -> None:
+        """削除するログをJSON Lines形式(gzip)で書き出す"""
+        with gzip.open(archive_path, 'wt', encoding='utf-8') as archive_file:
+            for row in queryset.order_by('pk').values().iterator(chunk_size=2000):
+                archive_file.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def __delete_in_batches(queryset, batch_size: int) -> int:
+        """ロックとWALを抑えるため、batch_size件ずつ削除する"""
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    return deleted
+                deleted += CsvLog.objects.filter(pk__in=pks).delete()[0]
+
+    def __drop_expired_partitions(self, cutoff) -> None:
+        """
+        partition_csv_logで月単位のパーティションにしている場合、上限が保存期間より前で空になったパーティションを削除する
+        (行は上記で削除済み、パーティション自体を残すとカタログとVACUUMの対象が増え続けるため)
+        """
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                           "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+                           "WHERE p.relname = %s", [CsvLog._meta.db_table])
+            partitions = cursor.fetchall()
+            for relname, bound in partitions:
+                upper = _get_partition_upper_bound(bound)
+                if upper is None or upper > cutoff:
+                    continue
+                cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {connection.ops.quote_name(relname)})')
+                if cursor.fetchone()[0]:
+                    continue
+                cursor.execute(f'DROP TABLE {connection.ops.quote_name(relname)}')
+                self.stdout.write(f'partition {relname} dropped')
+
+
+def _get_partition_upper_bound(bound: str):
+    """FOR VALUES FROM ('...') TO ('...')の上限、DEFAULTパーティションはNone"""
+    if ' TO (' not in bound:
+        return None
+    value = bound.split(' TO (', 1)[1].strip(")'")
+    upper = datetime.fromisoformat(value)
+    return upper if timezone.is_aware(upper) else timezone.make_aware(upper)
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CsvUploadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField(blank=True, null=True, verbose_name='version')),
+                ('created_at', models.DateTimeField(blank=True, null=True, verbose_name='create time')),
+                ('creator', models.CharField(blank=True, max_length=120, null=True, verbose_name='creator')),
+                ('updated_at', models.DateTimeField(blank=True, null=True, verbose_name='update time')),
+                ('updater', models.CharField(blank=True, max_length=120, null=True, verbose_name='updater')),
+                ('valid_flag', models.BooleanField(default=True, verbose_name='valid')),
+                ('lot_number', models.CharField(max_length=64, unique=True, verbose_name='lot number')),
+                ('file_name', models.CharField(blank=True, max_length=120, null=True, verbose_name='file name')),
+                ('spool_path', models.CharField(blank=True, max_length=1024, null=True, verbose_name='spool path')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='queued', max_length=12, verbose_name='job status')),
+                ('row_count', models.IntegerField(blank=True, null=True, verbose_name='row count')),
+                ('message', models.CharField(blank=True, max_length=2048, null=True, verbose_name='message')),
+            ],
+            options={
+                'verbose_name': 'csv upload job',
+                'verbose_name_plural': 'csv upload jobs',
+                'db_table': 'cmm_csv_upload_job',
+                'ordering': ['-created_at'],
+                'default_permissions': [],
+            },
+        ),
+    ]
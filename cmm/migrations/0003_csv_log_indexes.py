@@ -0,0 +1,21 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0002_csv_upload_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='csvlog',
+            index=models.Index(fields=['created_at'], name='cmm_csv_log_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='csvlog',
+            index=models.Index(fields=['lot_number', 'log_level'], name='cmm_csv_log_lot_level_idx'),
+        ),
+    ]
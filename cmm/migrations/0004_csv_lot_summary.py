@@ -0,0 +1,42 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0003_csv_log_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CsvLotSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField(blank=True, null=True, verbose_name='version')),
+                ('created_at', models.DateTimeField(blank=True, null=True, verbose_name='create time')),
+                ('creator', models.CharField(blank=True, max_length=120, null=True, verbose_name='creator')),
+                ('updated_at', models.DateTimeField(blank=True, null=True, verbose_name='update time')),
+                ('updater', models.CharField(blank=True, max_length=120, null=True, verbose_name='updater')),
+                ('valid_flag', models.BooleanField(default=True, verbose_name='valid')),
+                ('lot_number', models.CharField(max_length=64, unique=True, verbose_name='lot number')),
+                ('file_name', models.CharField(blank=True, max_length=120, null=True, verbose_name='file name')),
+                ('model_name', models.CharField(blank=True, max_length=120, null=True, verbose_name='model name')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='start time')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finish time')),
+                ('read_count', models.IntegerField(default=0, verbose_name='read rows')),
+                ('inserted_count', models.IntegerField(default=0, verbose_name='inserted rows')),
+                ('updated_count', models.IntegerField(default=0, verbose_name='updated rows')),
+                ('skipped_count', models.IntegerField(default=0, verbose_name='skipped rows')),
+                ('error_count', models.IntegerField(default=0, verbose_name='error rows')),
+            ],
+            options={
+                'verbose_name': 'csv lot summary',
+                'verbose_name_plural': 'csv lot summaries',
+                'db_table': 'cmm_csv_lot_summary',
+                'ordering': ['-started_at'],
+                'default_permissions': ['view', 'delete'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0004_csv_lot_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvlotsummary',
+            name='deleted_count',
+            field=models.IntegerField(default=0, verbose_name='deleted rows'),
+        ),
+        migrations.AlterField(
+            model_name='csvlog',
+            name='edit_type',
+            field=models.CharField(choices=[('insert', 'insert'), ('update', 'update'), ('delete', 'delete')], default='insert', max_length=12, verbose_name='csv edit type'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0005_csv_delete_operation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvuploadjob',
+            name='model_name',
+            field=models.CharField(blank=True, max_length=120, null=True, verbose_name='model name'),
+        ),
+    ]
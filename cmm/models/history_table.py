@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Iterable, List, Optional, Tuple, Type
 from django.db import models
 from django.utils import timezone
 from simple_history.models import HistoricalRecords
@@ -27,3 +28,60 @@ class HistoryTable(models.Model):
     @_history_date.setter
     def _history_date(self, value: datetime):
         self.__history_date = value
+
+
+class BulkHistoryWriter:
+    """
+    bulk_create等でsave()を経由せずに保存した行の履歴を、chunkごとに1回のbulk_createで記録する
+    is_deferredがTrueの場合は履歴をflush()まで保留する、withブロックで使うとブロックの終了時(トランザクション内)に記録する
+    使用例:
+        with transaction.atomic(), BulkHistoryWriter(Postcode, is_deferred=True) as writer:
+            Postcode.objects.bulk_create(objs)
+            writer.add(objs)
+    """
+
+    def __init__(self, model: Type[models.Model], batch_size: Optional[int] = None, default_user=None,
+                 is_deferred: bool = False):
+        self.model = model
+        self.batch_size = batch_size
+        self.default_user = default_user
+        self.is_deferred = is_deferred
+        self.pending: List[Tuple[List[models.Model], bool, datetime]] = []
+
+    @staticmethod
+    def is_history_model(model: Type[models.Model]) -> bool:
+        return issubclass(model, HistoryTable)
+
+    def add(self, objs: Iterable[models.Model], update: bool = False) -> None:
+        """保存済み(pkが設定済み)の行の履歴を記録する、updateがTrueの場合は更新、Falseの場合は新規登録の履歴"""
+        history_date = timezone.now()
+        objs = [obj for obj in objs if obj.pk is not None]
+        for obj in objs:
+            obj._history_date = history_date     # pylint: disable = protected-access
+        if not objs:
+            return
+        if self.is_deferred:
+            self.pending.append((objs, update, history_date))
+        else:
+            self.__write(objs, update, history_date)
+
+    def flush(self) -> None:
+        pending, self.pending = self.pending, []
+        for (objs, update, history_date) in pending:
+            self.__write(objs, update, history_date)
+
+    def discard(self) -> None:
+        self.pending = []
+
+    def __write(self, objs: List[models.Model], update: bool, history_date: datetime) -> None:
+        self.model.history.bulk_history_create(objs, batch_size=self.batch_size, update=update,
+                                               default_user=self.default_user, default_date=history_date)
+
+    def __enter__(self) -> 'BulkHistoryWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
@@ -1,12 +1,36 @@
-from typing import Optional, Type, Tuple
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Type, Tuple
 from django.db.models import Model
 from django.db import connection
 
 
 UNIQUE_CONSTRAINT = 'unique constraint'
 
+# モデルごとのUnique制約のキャッシュ、プロセス内で共有する(マイグレーション実行時にクリアする)
+_unique_constraints: Dict[Type[Model], Dict[str, List[str]]] = {}
+_unique_constraints_lock = threading.Lock()
 
-def get_unique_constraint(model: Type[Model]) -> dict[str, list[str]]:
+
+def get_meta_unique_constraint(model: Type[Model]) -> Dict[str, List[str]]:
+    """
+    Metaの定義からUnique制約を取得する、DBには問い合わせない
+    unique_together、UniqueConstraint(条件、式なし)、unique=Trueの項目の順で、値は項目のattname
+    """
+    opts = model._meta
+    unique_constraints: Dict[str, List[str]] = {}
+    for fields in opts.unique_together:
+        columns = [opts.get_field(name).attname for name in fields]
+        unique_constraints[f'{opts.db_table}_{"_".join(columns)}_uniq'] = columns
+    for constraint in opts.total_unique_constraints:
+        unique_constraints[constraint.name] = [opts.get_field(name).attname for name in constraint.fields]
+    for field in opts.concrete_fields:
+        if field.unique and not field.primary_key:
+            unique_constraints[f'{opts.db_table}_{field.column}_key'] = [field.attname]
+    return unique_constraints
+
+
+def introspect_unique_constraint(model: Type[Model]) -> Dict[str, List[str]]:
+    """DBのカタログからUnique制約を取得する"""
     unique_constraints = {}
     with connection.cursor() as cursor:
         constraints = connection.introspection.get_constraints(cursor, table_name=model._meta.db_table)
@@ -16,6 +40,25 @@ def get_unique_constraint(model: Type[Model]) -> dict[str, list[str]]:
         return unique_constraints
 
 
+def get_unique_constraint(model: Type[Model]) -> Dict[str, List[str]]:
+    """
+    モデルのUnique制約、最初の呼び出し時にMetaの定義から作成してキャッシュする
+    Metaに定義がない場合のみDBのカタログに問い合わせる(結果が空でもキャッシュする)
+    """
+    unique_constraints = _unique_constraints.get(model)
+    if unique_constraints is None:
+        unique_constraints = get_meta_unique_constraint(model) or introspect_unique_constraint(model)
+        with _unique_constraints_lock:
+            _unique_constraints[model] = unique_constraints
+    return unique_constraints
+
+
+def clear_unique_constraint_cache(**kwargs) -> None:
+    """Unique制約のキャッシュをクリアする、post_migrateシグナルのハンドラーとしても使う"""
+    with _unique_constraints_lock:
+        _unique_constraints.clear()
+
+
 def retrieve_by_unique_key(model_instance: Model, unique_fields: Optional[Tuple[str, ...]] = None) -> \
         Optional[Model]:
     """Uniqueキーで検索した結果"""
@@ -27,3 +70,76 @@ def retrieve_by_unique_key(model_instance: Model, unique_fields: Optional[Tuple[
             return None     # pragma: no cover
     return model_instance.__class__.objects.filter(**{k: getattr(model_instance, k)
                                                       for k in unique_fields}).first()  # type: ignore
+
+
+def get_unique_fields(model: Type[Model]) -> Tuple[str, ...]:
+    """
+    bulk upsert(ON CONFLICT)の衝突判定に使うUniqueキー、値はcleaned_dataと同じ項目名
+    get_unique_constraint()の最初の制約を使う(キャッシュ、post_migrateでのクリアも共通)
+    """
+    opts = model._meta
+    names = {}
+    for field in opts.concrete_fields:
+        names[field.attname] = names[field.column] = field.name
+    for columns in get_unique_constraint(model).values():
+        if all(column in names for column in columns):
+            return tuple(names[column] for column in columns)
+    return ()
+
+
+def _filter_by_keys(model: Type[Model], unique_fields: Tuple[str, ...],
+                    keys: Iterable[Tuple[Any, ...]]) -> Tuple[Dict[Tuple[Any, ...], List[Tuple[Any, ...]]], Any]:
+    """
+    keysをUniqueキーの型で正規化し、DBのパラメータ数上限に収まるbatchごとの検索querysetを返す
+    項目ごとのIN条件で絞り込むため、キーの組み合わせは呼び出し側で照合すること
+    """
+    fields = [model._meta.get_field(name) for name in unique_fields]
+
+    candidates: Dict[Tuple[Any, ...], List[Tuple[Any, ...]]] = {}
+    for key in keys:
+        if None not in key:
+            candidates.setdefault(normalize_key(fields, key), []).append(key)
+
+    def querysets():
+        normalized_keys = list(candidates.keys())
+        batch_size = max(connection.ops.bulk_batch_size(fields, normalized_keys), 1)
+        for i in range(0, len(normalized_keys), batch_size):
+            batch = normalized_keys[i:i + batch_size]
+            yield model._default_manager.filter(**{f'{name}__in': {key[n] for key in batch}
+                                                   for (n, name) in enumerate(unique_fields)})
+    return candidates, querysets()
+
+
+def normalize_key(fields, key: Tuple[Any, ...]) -> Tuple[Any, ...]:
+    return tuple(f.to_python(v) for (f, v) in zip(fields, key))
+
+
+def get_existing_keys(model: Type[Model], unique_fields: Tuple[str, ...],
+                      keys: Iterable[Tuple[Any, ...]]) -> Set[Tuple[Any, ...]]:
+    """
+    keysのうちDBに存在するものを返す、行ごとではなくまとめて検索する
+    項目ごとのIN条件で絞り込んでから、キーの組み合わせをPython側で照合する
+    NULLを含むキーはUnique制約の対象外なので存在しないものとして扱う
+    """
+    fields = [model._meta.get_field(name) for name in unique_fields]
+    candidates, querysets = _filter_by_keys(model, unique_fields, keys)
+
+    existing: Set[Tuple[Any, ...]] = set()
+    for queryset in querysets:
+        for db_key in queryset.values_list(*unique_fields):
+            existing.update(candidates.get(normalize_key(fields, db_key), []))
+    return existing
+
+
+def get_rows_by_unique_keys(model: Type[Model], unique_fields: Tuple[str, ...],
+                            keys: Iterable[Tuple[Any, ...]]) -> Dict[Tuple[Any, ...], Model]:
+    """keysに一致するDBの行を{キー: モデルインスタンス}で返す、bulk_create後のpk、DBの値の取得用"""
+    fields = [model._meta.get_field(name) for name in unique_fields]
+    candidates, querysets = _filter_by_keys(model, unique_fields, keys)
+
+    rows: Dict[Tuple[Any, ...], Model] = {}
+    for queryset in querysets:
+        for instance in queryset:
+            for key in candidates.get(normalize_key(fields, tuple(getattr(instance, f.attname) for f in fields)), []):
+                rows[key] = instance
+    return rows
@@ -1,32 +1,135 @@
-from django.db import models
+from typing import Iterable, List, Optional
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Cast, Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
-from cmm.models import retrieve_by_unique_key
+
+
+def race_condition_error() -> ValidationError:
+    return ValidationError(
+        _('Race condition was detected. Confirm the content and try again later.'),
+        code='race_condition',
+        params=None
+    )
+
+
+def version_condition(pk, version: Optional[int]) -> Q:
+    """更新対象行の条件、読み込んだ時点のversionと一致する行のみ更新する"""
+    return Q(pk=pk, version__isnull=True) if version is None else Q(pk=pk, version=version)
+
+
+class VersionedQuerySet(models.QuerySet):
+    def bulk_update_versioned(self, objs: Iterable[models.Model], fields: Optional[List[str]] = None,
+                              batch_size: Optional[int] = None) -> List[models.Model]:
+        """
+        versionを確認しながらまとめて更新する、戻り値は排他エラーで更新しなかった行
+        batchごとに対象行をSELECT FOR UPDATEでロックしてversionを照合し、一致した行のみ1回のUPDATEで更新する
+        更新した行のversionは+1する
+        """
+        objs = list(objs)
+        if not objs:
+            return []
+
+        opts = self.model._meta
+        if fields is None:
+            fields = [f.name for f in opts.concrete_fields if not f.primary_key]
+        update_fields = [opts.get_field(name) for name in fields if name != 'version']
+
+        connection = connections[self.db]
+        max_batch_size = max(connection.ops.bulk_batch_size(['pk', 'pk'] + update_fields, objs), 1)
+        batch_size = min(batch_size, max_batch_size) if batch_size else max_batch_size
+        requires_casting = connection.features.requires_casted_case_in_updates
+
+        conflicts: List[models.Model] = []
+        with transaction.atomic(using=self.db, savepoint=False):
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                current_versions = dict(self.select_for_update().filter(pk__in=[obj.pk for obj in batch])
+                                        .values_list('pk', 'version'))
+                matched = []
+                for obj in batch:
+                    if obj.pk in current_versions and current_versions[obj.pk] == obj.version:
+                        matched.append(obj)
+                    else:
+                        conflicts.append(obj)
+                if not matched:
+                    continue
+
+                updates = {}
+                for field in update_fields:
+                    when_statements = []
+                    for obj in matched:
+                        attr = getattr(obj, field.attname)
+                        if not hasattr(attr, 'resolve_expression'):
+                            attr = Value(attr, output_field=field)
+                        when_statements.append(When(pk=obj.pk, then=attr))
+                    case_statement = Case(*when_statements, output_field=field)
+                    if requires_casting:
+                        case_statement = Cast(case_statement, output_field=field)
+                    updates[field.attname] = case_statement
+                updates['version'] = Coalesce(F('version'), 0) + 1
+
+                condition = Q()
+                for obj in matched:
+                    condition |= version_condition(obj.pk, obj.version)
+                self.filter(condition).update(**updates)
+
+                for obj in matched:
+                    obj.version = (obj.version or 0) + 1
+        return conflicts
+
+
+class VersionedManager(models.Manager.from_queryset(VersionedQuerySet)):
+    pass
 
 
 class VersionedTable(models.Model):
     """楽観的排他用のversionカラムを持つテーブル"""
     version = models.IntegerField(_("version"), blank=True, null=True)
 
+    objects = VersionedManager()
+
     class Meta:
         abstract = True
 
     def save(self, *args, **kwargs):
-        """Unique keyがない場合は排他処理を行わない"""
-        if not self.version:
+        """
+        既存行の更新は UPDATE ... WHERE pk = ... AND version = ... で排他チェックとversionの加算を同時に行う
+        更新件数が0件で行が存在する場合は、他のユーザーが更新済みとして排他エラーにする
+        排他エラー後も外側のトランザクションを使い続けられるように、既存行の更新はsavepoint内で行う
+        """
+        if not self.version or self.pk is None:
             self.version = 1
+            self._expected_version = None
         else:
-            current_db_record = retrieve_by_unique_key(self)
-            if current_db_record and current_db_record.version:
-                if self.version == current_db_record.version:
-                    self.version += 1
-                else:
-                    raise ValidationError(
-                        _('Race condition was detected. Confirm the content and try again later.'),
-                        code='race_condition',
-                        params=None
-                    )
+            self._expected_version = self.version
+            self.version += 1
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'version' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'version']
+
+        try:
+            if self._expected_version is None:
+                super().save(*args, **kwargs)
             else:
-                self.version = 1        # pragma: no cover
+                with transaction.atomic(using=kwargs.get('using') or router.db_for_write(self.__class__,
+                                                                                         instance=self)):
+                    super().save(*args, **kwargs)
+        except ValidationError:
+            self.version = self._expected_version
+            raise
+        finally:
+            self._expected_version = None
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        expected_version = getattr(self, '_expected_version', None)
+        if expected_version is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
 
-        super().save(*args, **kwargs)
+        updated = super()._do_update(base_qs.filter(version=expected_version), using, pk_val, values,
+                                     update_fields, forced_update)
+        if not updated and base_qs.filter(pk=pk_val).exists():
+            raise race_condition_error()
+        return updated
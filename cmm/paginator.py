@@ -0,0 +1,103 @@
+import hashlib
+from typing import Optional, Type
+from django.core.cache import caches
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Model
+from django.utils.functional import cached_property
+
+
+def estimate_row_count(model: Type[Model], using: str = 'default') -> Optional[int]:
+    """
+    PostgreSQLの統計情報(pg_class.reltuples)によるテーブルの推定件数、推定できない場合はNone
+    パーティションテーブルは各パーティションの推定件数の合計
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT c.reltuples, c.relkind FROM pg_class c WHERE c.oid = to_regclass(%s)',
+                       [model._meta.db_table])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        reltuples, relkind = row
+        if relkind == 'p':
+            cursor.execute('SELECT SUM(c.reltuples) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                           'WHERE i.inhparent = to_regclass(%s) AND c.reltuples >= 0', [model._meta.db_table])
+            reltuples = cursor.fetchone()[0]
+    # 一度もANALYZEされていないテーブルは-1(PostgreSQL 14以降)、またはNULL
+    return None if reltuples is None or reltuples < 0 else int(reltuples)
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    件数の多いテーブル用のPaginator
+    絞り込みなしの件数はthreshold件を超える場合は推定件数を使い、それ以外の件数はcache_ttl秒の間キャッシュする
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 threshold: int = 100000, cache_ttl: int = 60, cache_alias: str = 'default'):
+        super().__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.threshold = threshold
+        self.cache_ttl = cache_ttl
+        self.cache_alias = cache_alias
+
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return super().count
+
+        if not queryset.query.has_filters():
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.threshold:
+                return estimate
+
+        sql, params = queryset.query.sql_with_params()
+        # pylint: disable = protected-access
+        cache_key = f'cmm_count:{queryset.model._meta.label_lower}:' \
+                    + hashlib.md5(f'{sql}{params!r}'.encode()).hexdigest()
+        cache = caches[self.cache_alias]
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.count()
+            cache.set(cache_key, count, self.cache_ttl)
+        return count
+
+
+class ApproximateCountMixin:
+    """
+    一覧画面の件数取得(絞り込み後と全件の2回のCOUNT(*))を抑えるModelAdminのMixin、ModelAdminより前に継承する
+    推定件数がapproximate_count_thresholdを超えるテーブルは全件数を表示しない(show_full_result_count = False)
+    """
+
+    paginator: Type[Paginator] = ApproximateCountPaginator
+    # この件数を超えるテーブルは推定件数を使う
+    approximate_count_threshold = 100000
+    # 絞り込み条件ごとの件数をキャッシュする秒数
+    count_cache_ttl = 60
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        return self.paginator(queryset, per_page, orphans, allow_empty_first_page,
+                              threshold=self.approximate_count_threshold, cache_ttl=self.count_cache_ttl)
+
+    def get_changelist_instance(self, request):
+        """
+        一覧画面の表示ごとに1回、全件数を表示するかを決める
+        ChangeListは件数の取得時にModelAdminのshow_full_result_countを参照するため、作成前に設定する
+        """
+        self.show_full_result_count = self.__is_full_result_count_shown()
+        return super().get_changelist_instance(request)       # type: ignore[misc]
+
+    def __is_full_result_count_shown(self) -> bool:
+        """推定件数が閾値を超える場合は全件数のCOUNT(*)を行わない"""
+        # pylint: disable = protected-access
+        opts = self.model._meta     # type: ignore[attr-defined]
+        cache = caches['default']
+        cache_key = f'cmm_estimate:{opts.label_lower}'
+        estimate = cache.get(cache_key)
+        if estimate is None:
+            estimate = estimate_row_count(self.model) or 0      # type: ignore[attr-defined]
+            cache.set(cache_key, estimate, self.count_cache_ttl)
+        return estimate <= self.approximate_count_threshold
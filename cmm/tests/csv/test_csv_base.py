@@ -1,8 +1,9 @@
 import pytest
+from datetime import datetime
 import csv
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
-from cmm.csv import CsvBase, CsvEncoding, CsvLogOutput, CsvLog
+from cmm.csv import CsvBase, CsvEncoding, CsvLogOutput, CsvLog, CsvPagination
 from cmm.tests.cmm_fixtures import *
 
 
@@ -24,6 +25,7 @@ def test_initial_values(csv_base: CsvBase):
     assert CsvBase.excel_extension == '.xlsx'
     assert CsvBase.date_format == '%Y/%m/%d'
     assert CsvBase.log_output == CsvLogOutput.DATABASE
+    assert CsvBase.pagination == CsvPagination.KEYSET
 
     assert csv_base.chunk_size == 1000
     assert csv_base.chunk_size == 1000
@@ -83,3 +85,37 @@ def test_generate_csv_data(auth_user_admin, query_set):
     assert len(csv_data) == 5
     for row in csv_data:
         assert row[5] == '2023/09/23 03:00:00'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('pagination', [CsvPagination.OFFSET, CsvPagination.KEYSET, CsvPagination.CURSOR])
+def test_generate_csv_data_pagination(auth_user_admin, query_set, pagination):
+    auth_user_admin.chunk_size = 2
+    auth_user_admin.pagination = pagination
+    csv_data = list(auth_user_admin.generate_csv_data(query_set.order_by('-username')))
+    assert [row[0] for row in csv_data] == ['tester5', 'tester4', 'tester3', 'tester2', 'tester1']
+
+
+@pytest.mark.django_db
+def test_keyset_ordering(auth_user_admin, query_set):
+    assert auth_user_admin.get_keyset_ordering(query_set) == [('username', False), ('pk', False)]
+    assert auth_user_admin.get_keyset_ordering(query_set.order_by('-last_name', 'id')) == \
+        [('last_name', True), ('pk', False)]
+    assert auth_user_admin.get_keyset_ordering(query_set.order_by('groups__name')) == [('pk', False)]
+
+
+@pytest.mark.django_db
+def test_generate_csv_data_keyset_nullable(csv_base: CsvBase):
+    for row_no in range(5):
+        CsvLog(file_name=None if row_no % 2 else 'test.csv', row_no=row_no, updater='pytest').save()
+    csv_base.chunk_size = 2
+    csv_base.get_csv_field_names = lambda: ['file_name', 'row_no']
+
+    csv_data = list(csv_base.generate_csv_data(CsvLog.objects.order_by('file_name', 'row_no')))
+    assert csv_data == [['test.csv', 0], ['test.csv', 2], ['test.csv', 4], [None, 1], [None, 3]]
+
+
+def test_get_csv_formatters(auth_user_admin):
+    formatters = auth_user_admin.get_csv_formatters()
+    assert [col_num for (col_num, _) in formatters] == [5]
+    assert formatters[0][1](datetime(2023, 9, 23, 12, 0, 0)) == '2023/09/23 12:00:00'
@@ -1,9 +1,54 @@
+import gzip
+import io
+import zipfile
 import pytest
+from asgiref.sync import async_to_sync
+from django.http import StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
-from cmm.csv import download_csv, DOWNLOAD_CSV, download_excel, DOWNLOAD_EXCEL
+from cmm.csv import (download_csv, DOWNLOAD_CSV, download_excel, DOWNLOAD_EXCEL, download_csv_gzip, download_csv_zip,
+                     DOWNLOAD_CSV_GZIP, DOWNLOAD_CSV_ZIP, generate_zip_response, CsvDownloadEngine)
+from cmm.csv.csv_download import aiter_sync_content
+from cmm.csv.pg_copy import get_pg_encoding, iter_copy_select, strftime_to_pg
 from cmm.tests.cmm_fixtures import *
 
 
+class FakeCopyConnection:
+    """for test、psycopg2の接続のCOPY TO STDOUTのみ"""
+    encoding = 'UTF8'
+
+    def __init__(self, rows: int):
+        self.rows = rows
+        self.written = 0
+        self.copy_sql = None
+        self.copy_error = None
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def mogrify(self, sql, params):
+        return sql.encode()
+
+    def copy_expert(self, sql, file):
+        self.copy_sql = sql
+        try:
+            for n in range(1, self.rows + 1):
+                file.write(f'{n}\n'.encode())
+                self.written += 1
+        except IOError as e:
+            self.copy_error = e
+            raise
+
+    def close(self):
+        self.closed = True
+
+
 class TestCsvDownloadMixin:
     @pytest.mark.django_db
     def test_get_actions(self, auth_user_admin, test_request):
@@ -15,6 +60,8 @@ class TestCsvDownloadMixin:
         csv_permission = Permission.objects.get(codename='download_csv_authuser', content_type=content_type)
         test_request.user.user_permissions.remove(csv_permission)
         assert DOWNLOAD_CSV not in auth_user_admin.get_actions(test_request)
+        assert DOWNLOAD_CSV_GZIP not in auth_user_admin.get_actions(test_request)
+        assert DOWNLOAD_CSV_ZIP not in auth_user_admin.get_actions(test_request)
 
     @pytest.mark.django_db
     def test_generate_csv_response(self, auth_user_admin, query_set):
@@ -29,6 +76,119 @@ class TestCsvDownloadMixin:
         assert download_response.content == csv_content
         assert download_response.status_code == 200
 
+    @pytest.mark.django_db
+    def test_generate_csv_streaming_response(self, auth_user_admin, query_set):
+        auth_user_admin.is_streaming = True
+        auth_user_admin.chunk_size = 2
+        download_response = auth_user_admin.generate_csv_response(query_set)
+        assert isinstance(download_response, StreamingHttpResponse)
+
+        chunks = list(download_response.streaming_content)
+        # ヘッダー、2行、2行、1行
+        assert len(chunks) == 4
+        assert chunks[0] == b'User Name,Password,Email,First Name,Last Name,Date Joined\r\n'
+        assert chunks[-1] == b'tester5,password,test5@test.com,first,last,2023/09/23 03:00:00\r\n'
+
+    @pytest.mark.django_db
+    def test_generate_csv_streaming_response_async(self, auth_user_admin, query_set):
+        download_response = auth_user_admin.generate_csv_streaming_response(query_set, is_async=True)
+        assert download_response.is_async
+
+        async def consume():
+            return b''.join([chunk async for chunk in download_response.streaming_content])
+
+        csv_content = async_to_sync(consume)()
+        assert csv_content.startswith(b'User Name,Password,Email,First Name,Last Name,Date Joined\r\n')
+        assert csv_content.count(b'\r\n') == 6
+
+    @pytest.mark.django_db
+    def test_generate_csv_gzip_response(self, auth_user_admin, query_set):
+        auth_user_admin.chunk_size = 2
+        download_response = auth_user_admin.generate_csv_gzip_response(query_set)
+        assert download_response['Content-Type'] == 'application/gzip'
+
+        csv_content = gzip.decompress(b''.join(download_response.streaming_content))
+        assert csv_content == b''.join(auth_user_admin.iter_csv_content(query_set))
+
+    @pytest.mark.django_db
+    def test_generate_zip_response(self, auth_user_admin, csv_log_admin, query_set):
+        download_response = generate_zip_response('test.zip', [(auth_user_admin, query_set),
+                                                               (csv_log_admin, CsvLog.objects.all())])
+        assert download_response['Content-Type'] == 'application/zip'
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(download_response.streaming_content))) as zip_file:
+            assert zip_file.namelist() == [auth_user_admin.get_csv_file_name(), csv_log_admin.get_csv_file_name()]
+            csv_content = zip_file.read(auth_user_admin.get_csv_file_name())
+            assert csv_content == b''.join(auth_user_admin.iter_csv_content(query_set))
+
+    @pytest.mark.django_db
+    def test_generate_csv_response_copy_engine_fallback(self, auth_user_admin, query_set):
+        expected = auth_user_admin.generate_csv_response(query_set).content
+        auth_user_admin.download_engine = CsvDownloadEngine.COPY
+        # PostgreSQL以外ではPythonで出力する
+        assert not auth_user_admin.is_copy_download()
+        assert auth_user_admin.generate_csv_response(query_set).content == expected
+
+    def test_is_copy_download_encoding(self, auth_user_admin, monkeypatch):
+        monkeypatch.setattr('cmm.csv.csv_download.is_copy_available', lambda: True)
+        auth_user_admin.download_engine = CsvDownloadEngine.COPY
+        auth_user_admin.encoding = 'euc_jp'
+        assert auth_user_admin.is_copy_download()
+        # PostgreSQLに対応するencodingがない場合はPythonで出力する
+        auth_user_admin.encoding = 'utf-8-sig'
+        assert not auth_user_admin.is_copy_download()
+
+    def test_get_pg_encoding(self):
+        assert [get_pg_encoding(e) for e in ('utf8', 'UTF-8', 'sjis', 's-jis', 'cp932', 'shift_jis', 'euc-jp')] == \
+            ['UTF8', 'UTF8', 'SJIS', 'SJIS', 'SJIS', 'SJIS', 'EUC_JP']
+        assert get_pg_encoding('utf-8-sig') is None
+        assert get_pg_encoding('unknown') is None
+
+    def test_aiter_sync_content_close(self):
+        closed = []
+
+        def content():
+            try:
+                yield from [b'1', b'2', b'3']
+            finally:
+                closed.append(True)
+
+        iterator = content()
+
+        async def read_first():
+            chunks = aiter_sync_content(iterator)
+            chunk = await chunks.__anext__()
+            # クライアントが切断した場合
+            await chunks.aclose()
+            return chunk
+
+        assert async_to_sync(read_first)() == b'1'
+        assert closed == [True]
+
+    def test_strftime_to_pg(self):
+        assert strftime_to_pg('%Y/%m/%d') == 'YYYY/MM/DD'
+        assert strftime_to_pg('%Y/%m/%d %H:%M:%S') == 'YYYY/MM/DD HH24:MI:SS'
+        assert strftime_to_pg('%Y年%m月%dT') == 'YYYY年MM月DD"T"'
+        with pytest.raises(ValueError):
+            strftime_to_pg('%a')
+
+    def test_iter_copy_select(self):
+        copy_connection = FakeCopyConnection(rows=3)
+        content = iter_copy_select(lambda: copy_connection, 'SELECT 1', [], 'UTF8', queue_size=1)
+        assert b''.join(content) == b'1\n2\n3\n'
+        assert copy_connection.copy_sql == "COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, ENCODING 'UTF8')"
+        assert copy_connection.closed
+
+    def test_iter_copy_select_close(self):
+        # クライアントの切断などで途中でcloseした場合、COPYを中断し、スレッドの終了を待ってから接続を閉じる
+        copy_connection = FakeCopyConnection(rows=1000)
+        content = iter_copy_select(lambda: copy_connection, 'SELECT 1', [], 'UTF8', queue_size=1)
+        assert next(content) == b'1\n'
+        content.close()
+        assert isinstance(copy_connection.copy_error, IOError)
+        assert copy_connection.written < 1000
+        assert copy_connection.closed
+
 
 @pytest.mark.django_db
 def test_download_csv(auth_user_admin, test_request, query_set):
@@ -44,6 +204,21 @@ def test_download_csv(auth_user_admin, test_request, query_set):
     assert download_response.status_code == 200
 
 
+@pytest.mark.django_db
+def test_download_csv_gzip(auth_user_admin, test_request, query_set):
+    download_response = download_csv_gzip(auth_user_admin, test_request, query_set)
+    assert download_response.status_code == 200
+    assert gzip.decompress(b''.join(download_response.streaming_content)).count(b'\r\n') == 6
+
+
+@pytest.mark.django_db
+def test_download_csv_zip(auth_user_admin, test_request, query_set):
+    download_response = download_csv_zip(auth_user_admin, test_request, query_set)
+    assert download_response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(b''.join(download_response.streaming_content))) as zip_file:
+        assert zip_file.testzip() is None
+
+
 class TestExcelDownloadMixin:
     @pytest.mark.django_db
     def test_get_actions(self, auth_user_admin, test_request):
@@ -61,6 +236,20 @@ class TestExcelDownloadMixin:
         download_response = auth_user_admin.generate_excel_response(query_set)
         assert download_response.status_code == 200
 
+    @pytest.mark.django_db
+    def test_generate_excel_file_response(self, auth_user_admin, query_set):
+        auth_user_admin.is_constant_memory = True
+        auth_user_admin.excel_max_rows = 3
+        download_response = auth_user_admin.generate_excel_response(query_set)
+        assert download_response.status_code == 200
+        assert 'attachment' in download_response['Content-Disposition']
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(download_response.streaming_content))) as xlsx:
+            sheets = sorted(name for name in xlsx.namelist() if name.startswith('xl/worksheets/sheet'))
+            # 5行 + 各シートのヘッダー行、1シート3行まで
+            assert len(sheets) == 3
+            assert b'User Name' in xlsx.read('xl/worksheets/sheet3.xml')
+
 
 @pytest.mark.django_db
 def test_download_excel(auth_user_admin, test_request, query_set):
@@ -1,14 +1,24 @@
 import pytest
 import copy
-from datetime import datetime, date
+import csv
+import json
+from datetime import datetime, date, timedelta
 from io import StringIO, BytesIO
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
+from django.db import models
+from django.db.models import F
 from django.forms import ModelForm
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.http import Http404
 from django.urls import reverse
 from django.test import Client
-from cmm.csv import UploadMixin, CsvLog
+from cmm.csv import (UploadMixin, CsvLog, CsvImportEngine, CsvImportOperation, CsvLogStorage, CsvLotSummary,
+                     CsvUploadJob)
+from cmm.csv.upload_job import run_upload_job, spool_upload_file
 from cmm.csv.csv_base import CsvBase
+from cmm.csv import csv_upload_mixin
+from cmm.csv.pg_copy import get_copy_fields, get_copy_value, is_copy_supported, to_copy_row, to_copy_value
 from cmm.models import AuthUser
 from cmm.tests.cmm_fixtures import *
 from cmm.tests.csv.csv_fixtures import *
@@ -102,11 +112,169 @@ class TestUploadMixin:
         assert reverse('admin:cmm_authuser_changelist') in response.url
 
 
+class TestUploadJob:
+    def test_is_background_upload(self, auth_user_admin, csv_file):
+        csv_file.size = len(csv_file.getvalue())
+        assert not auth_user_admin.is_background_upload(csv_file)
+        auth_user_admin.background_upload_size = 10
+        assert auth_user_admin.is_background_upload(csv_file)
+        auth_user_admin.background_upload_size = None
+        assert not auth_user_admin.is_background_upload(csv_file)
+
+    @pytest.mark.django_db
+    def test_run_upload_job(self, auth_user_admin, csv_file, settings, tmp_path):
+        settings.CSV_UPLOAD_SPOOL_DIR = str(tmp_path)
+        csv_file.chunks = lambda: [csv_file.getvalue()]
+        job = CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', updater='py_tester',
+                                          spool_path=spool_upload_file(csv_file, 'test_lot_number'))
+
+        run_upload_job(auth_user_admin, job.pk)
+
+        job.refresh_from_db()
+        assert job.status == CsvUploadJob.FINISHED
+        assert job.is_done
+        assert job.row_count == 3
+        assert CsvLog.objects.filter(lot_number='test_lot_number', file_name='test.csv').count() == 2
+        assert not list(tmp_path.iterdir())
+
+    @pytest.mark.django_db
+    def test_run_upload_job_failed(self, auth_user_admin):
+        job = CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', updater='py_tester',
+                                          spool_path='/not/exists.csv')
+        run_upload_job(auth_user_admin, job.pk)
+
+        job.refresh_from_db()
+        assert job.status == CsvUploadJob.FAILED
+        assert job.message
+
+    @pytest.mark.django_db
+    def test_run_upload_job_failed_while_running(self, auth_user_admin, csv_file, settings, tmp_path, caplog):
+        settings.CSV_UPLOAD_SPOOL_DIR = str(tmp_path)
+        csv_file.chunks = lambda: [csv_file.getvalue()]
+        job = CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', updater='py_tester',
+                                          spool_path=spool_upload_file(csv_file, 'test_lot_number'))
+
+        def read_csv_file():
+            # 実行中に更新が止まったジョブとして失敗にされた場合
+            CsvUploadJob.objects.filter(pk=job.pk).update(status=CsvUploadJob.FAILED, version=F('version') + 1)
+            return 3
+
+        auth_user_admin.read_csv_file = read_csv_file
+        run_upload_job(auth_user_admin, job.pk)
+
+        job.refresh_from_db()
+        assert (job.status, job.row_count) == (CsvUploadJob.FAILED, None)
+        assert 'was not running but failed' in caplog.text
+        assert not list(tmp_path.iterdir())
+
+    @pytest.mark.django_db
+    def test_run_upload_job_failed_before_start(self, auth_user_admin):
+        job = CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', updater='py_tester',
+                                          status=CsvUploadJob.FAILED)
+        auth_user_admin.read_csv_file = lambda: pytest.fail('failed job must not be started')
+        run_upload_job(auth_user_admin, job.pk)
+        job.refresh_from_db()
+        assert job.status == CsvUploadJob.FAILED
+
+    @pytest.mark.django_db
+    def test_upload_status_view(self, auth_user_admin, test_request):
+        CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', model_name='cmm.authuser',
+                                    updater='py_tester')
+        CsvLog(lot_number='test_lot_number', file_name='test.csv', row_no=1, updater='py_tester').save()
+        CsvLog(lot_number='test_lot_number', file_name='test.csv', row_no=2, log_level=CsvLog.ERROR,
+               updater='py_tester').save()
+
+        response = auth_user_admin.upload_status_view(test_request, 'test_lot_number')
+        assert json.loads(response.content) == {'status': CsvUploadJob.QUEUED, 'status_display': 'Queued',
+                                                'is_done': False, 'processed': 2, 'skipped': 0, 'discarded': 1,
+                                                'message': None}
+
+    @pytest.mark.django_db
+    def test_upload_status_view_lot_summary(self, auth_user_admin, test_request):
+        CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', model_name='cmm.authuser',
+                                    updater='py_tester')
+        summary = CsvLotSummary.start('test_lot_number', 'test.csv', 'cmm.authuser', 'py_tester')
+        summary.add_counts([CsvLog(log_level=CsvLog.INFO), CsvLog(log_level=CsvLog.INFO, edit_type=CsvLog.UPDATE),
+                            CsvLog(log_level=CsvLog.WARN), CsvLog(log_level=CsvLog.ERROR)])
+
+        response = auth_user_admin.upload_status_view(test_request, 'test_lot_number')
+        result = json.loads(response.content)
+        assert (result['processed'], result['skipped'], result['discarded']) == (4, 1, 1)
+        summary.refresh_from_db()
+        assert (summary.inserted_count, summary.updated_count) == (1, 1)
+
+    @pytest.mark.django_db
+    def test_upload_error_view(self, auth_user_admin, test_request):
+        auth_user_admin.upload_error_per_page = 1
+        summary = CsvLotSummary.start('test_lot_number', 'test.csv', 'cmm.authuser', 'py_tester')
+        csv_logs = [CsvLog(lot_number='test_lot_number', file_name='test.csv', row_no=row_no, log_level=log_level,
+                           row_content={'username': f'test{row_no}'}, updater='py_tester')
+                    for (row_no, log_level) in [(1, CsvLog.WARN), (2, CsvLog.INFO), (3, CsvLog.ERROR)]]
+        for csv_log in csv_logs:
+            csv_log.convert_content2json().save()
+        summary.add_counts(csv_logs)
+
+        response = auth_user_admin.upload_error_view(test_request, 'test_lot_number')
+        assert [csv_log.row_no for csv_log in response.context_data['csv_logs']] == [3]
+        assert response.context_data['page'].paginator.num_pages == 2
+
+        test_request.GET = {'p': '2'}
+        response = auth_user_admin.upload_error_view(test_request, 'test_lot_number')
+        assert [csv_log.row_no for csv_log in response.context_data['csv_logs']] == [1]
+        response.render()
+
+    @pytest.mark.django_db
+    def test_upload_error_view_not_found(self, auth_user_admin, test_request):
+        with pytest.raises(Http404):
+            auth_user_admin.upload_error_view(test_request, 'not_exists')
+
+    @pytest.mark.django_db
+    def test_upload_progress_view(self, auth_user_admin, test_request):
+        CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', model_name='cmm.authuser',
+                                    updater='py_tester')
+        response = auth_user_admin.upload_progress_view(test_request, 'test_lot_number')
+        assert response.status_code == 200
+        assert response.context_data['job'].lot_number == 'test_lot_number'
+
+    @pytest.mark.django_db
+    def test_upload_status_view_not_found(self, auth_user_admin, test_request):
+        with pytest.raises(Http404):
+            auth_user_admin.upload_status_view(test_request, 'not_exists')
+
+    @pytest.mark.django_db
+    def test_upload_status_view_other_model(self, auth_user_admin, test_request):
+        # 他のモデルのジョブ、取り込み結果は参照できない
+        CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', model_name='cmm.csvlog',
+                                    updater='py_tester')
+        CsvLotSummary.start('test_lot_number', 'test.csv', 'cmm.csvlog', 'py_tester')
+        with pytest.raises(Http404):
+            auth_user_admin.upload_status_view(test_request, 'test_lot_number')
+        with pytest.raises(Http404):
+            auth_user_admin.upload_error_view(test_request, 'test_lot_number')
+
+    @pytest.mark.django_db
+    def test_upload_status_view_stale_job(self, auth_user_admin, test_request, settings):
+        settings.CSV_UPLOAD_JOB_TIMEOUT = 60
+        job = CsvUploadJob.objects.create(lot_number='test_lot_number', file_name='test.csv', updater='py_tester',
+                                          model_name='cmm.authuser', status=CsvUploadJob.RUNNING)
+        response = auth_user_admin.upload_status_view(test_request, 'test_lot_number')
+        assert json.loads(response.content)['status'] == CsvUploadJob.RUNNING
+
+        # プロセスの再起動などで更新が止まったジョブは失敗にする
+        past = now() - timedelta(minutes=2)
+        CsvUploadJob.objects.filter(pk=job.pk).update(created_at=past, updated_at=past)
+        response = auth_user_admin.upload_status_view(test_request, 'test_lot_number')
+        result = json.loads(response.content)
+        assert (result['status'], result['is_done']) == (CsvUploadJob.FAILED, True)
+        assert result['message']
+
+
 class TestCsvUploadMixin:
     def test_initial_values(self, auth_user_admin):
         assert auth_user_admin.header_row_number == 1
         assert auth_user_admin.error_tolerance_rate == 10
         assert auth_user_admin.is_overwrite_existing
+        assert auth_user_admin.import_engine == CsvImportEngine.BULK
 
     def test_get_default_values(self, auth_user_admin):
         assert auth_user_admin.get_default_values() == {}
@@ -157,6 +325,14 @@ class TestCsvUploadMixin:
     def test_get_modelform_class(self, auth_user_admin):
         model_form_class = auth_user_admin._CsvUploadMixin__get_modelform_class()
         assert issubclass(model_form_class, ModelForm)
+        assert auth_user_admin._CsvUploadMixin__get_modelform_class() is model_form_class
+
+    def test_csv_converters(self, auth_user_admin):
+        converters = auth_user_admin.csv_converters
+        assert converters['username']('tester1') == 'tester1'
+        assert converters['date_joined']('2023/09/23 12:00:00') == datetime(2023, 9, 23, 12, 0, 0)
+        assert 'unrelated' not in converters
+        assert auth_user_admin.csv_converters is converters
 
     @pytest.mark.django_db
     def test_validate_by_modelform_valid(self, auth_user_admin, auth_user_csv_log):
@@ -165,6 +341,17 @@ class TestCsvUploadMixin:
         assert auth_user_csv_log.modelform.cleaned_data
         assert auth_user_csv_log.message == _('Newly imported row.')
 
+    @pytest.mark.django_db
+    def test_validate_csv_row(self, auth_user_admin, auth_user_csv_log):
+        def validate_csv_row(cleaned_data):
+            if cleaned_data['email'].endswith('@test.com'):
+                raise ValidationError('The email domain is not allowed.')
+
+        auth_user_admin.validate_csv_row = validate_csv_row
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log)
+        assert auth_user_csv_log.log_level == CsvLog.ERROR
+        assert auth_user_csv_log.message == 'The email domain is not allowed.'
+
     @pytest.mark.django_db
     def test_validate_by_modelform_invalid_unique_violation_overwrite(self, auth_user_admin, auth_user_csv_log):
         auth_user_content = auth_user_csv_log.row_content.copy()
@@ -278,6 +465,138 @@ class TestCsvUploadMixin:
 
         assert auth_user_admin._CsvUploadMixin__save(chunk) == 1
 
+    @pytest.mark.django_db
+    def test_save_bulk_update_existing(self, auth_user_admin, auth_user_csv_log):
+        auth_user_content = auth_user_csv_log.row_content.copy()
+        auth_user_content['date_joined'] = datetime(2023, 9, 23, 12, 0, 0)
+        auth_user_content['email'] = 'old@test.com'
+        AuthUser.objects.create(**auth_user_content)
+
+        chunk = []
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log)
+        chunk.append(auth_user_csv_log)
+
+        assert auth_user_admin._CsvUploadMixin__save(chunk) == 1
+        assert AuthUser.objects.get(username='tester1').email == 'tester@test.com'
+
+    @pytest.mark.django_db
+    def test_save_bulk_fallback_to_rows(self, auth_user_admin, auth_user_csv_log):
+        auth_user_admin.is_overwrite_existing = False
+        chunk = []
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log)
+        chunk.append(auth_user_csv_log)
+        # 検証後に他の処理で同じUniqueキーの行が登録された場合
+        AuthUser.objects.create(username='tester1', password='password')
+
+        assert auth_user_admin._CsvUploadMixin__save(chunk) == 0
+        assert auth_user_csv_log.log_level == CsvLog.ERROR
+
+    @pytest.mark.django_db
+    def test_save_orm_engine(self, auth_user_admin, auth_user_csv_log):
+        auth_user_admin.import_engine = CsvImportEngine.ORM
+        chunk = []
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log)
+        chunk.append(auth_user_csv_log)
+        copied = copy.deepcopy(auth_user_csv_log)
+        copied.row_no = auth_user_csv_log.row_no + 1
+        copied.row_content['username'] = ''
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(copied)
+        chunk.append(copied)
+
+        assert auth_user_admin._CsvUploadMixin__save(chunk) == 1
+        assert AuthUser.objects.filter(username='tester1').exists()
+
+    @pytest.mark.django_db
+    def test_save_bulk_invalid_value(self, auth_user_admin, auth_user_csv_log):
+        """DBの値に変換できない行は、その行のみエラーにする"""
+        invalid = copy.deepcopy(auth_user_csv_log)
+        invalid.row_no = 2
+        invalid.row_content['username'] = 'tester2'
+        chunk = [auth_user_csv_log, invalid]
+        for csv_log in chunk:
+            auth_user_admin._CsvUploadMixin__validate_by_modelform(csv_log)
+        invalid.cleaned_data['date_joined'] = 'invalid date'
+
+        assert auth_user_admin._CsvUploadMixin__save(chunk) == 1
+        assert AuthUser.objects.filter(username='tester1').exists()
+        assert not AuthUser.objects.filter(username='tester2').exists()
+        assert invalid.log_level == CsvLog.ERROR
+
+    @pytest.mark.django_db
+    def test_save_rows_update_existing(self, auth_user_admin, auth_user_csv_log):
+        """1行ずつの保存でも、Uniqueキーが一致する既存行は値が異なっていても更新する"""
+        auth_user_admin.import_engine = CsvImportEngine.ORM
+        AuthUser.objects.create(username='tester1', password='password', email='old@test.com')
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log)
+
+        assert auth_user_admin._CsvUploadMixin__save([auth_user_csv_log]) == 1
+        assert auth_user_csv_log.log_level == CsvLog.INFO
+        assert AuthUser.objects.get(username='tester1').email == 'tester@test.com'
+
+    @pytest.mark.django_db
+    def test_save_copy_engine_fallback(self, auth_user_admin, auth_user_csv_log):
+        """PostgreSQL以外のDBではBULKで保存する"""
+        auth_user_admin.import_engine = CsvImportEngine.COPY
+        chunk = []
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log)
+        chunk.append(auth_user_csv_log)
+
+        assert auth_user_admin._CsvUploadMixin__save(chunk) == 1
+        assert AuthUser.objects.filter(username='tester1').exists()
+
+    def test_to_copy_value(self):
+        assert to_copy_value(None) == '\\N'
+        assert to_copy_value('') == '""'
+        assert to_copy_value('a"b,c') == '"a""b,c"'
+        assert to_copy_value(1) == '"1"'
+        assert to_copy_value(b'\x00\xff') == '"\\x00ff"'
+
+    def test_get_copy_value(self):
+        # JSONField、BinaryFieldはアダプターのreprではなく、JSONの文字列、byteaの16進数表記にする
+        assert json.loads(get_copy_value(models.JSONField(), {'name': 'a"b'})) == {'name': 'a"b'}
+        assert get_copy_value(models.JSONField(), None) is None
+        assert to_copy_value(get_copy_value(models.BinaryField(), b'\x01')) == '"\\x01"'
+        with pytest.raises(ValidationError):
+            get_copy_value(models.DateField(), '2023/99/99')
+
+    def test_to_copy_row(self):
+        csv_log = CsvLog(file_name='test.csv', row_no=1, row_content='{"name": "a\\"b"}')
+        fields = get_copy_fields(CsvLog)
+        values = dict(zip([f.name for f in fields], next(csv.reader(StringIO(to_copy_row(fields, csv_log))))))
+        assert json.loads(values['row_content']) == {'name': 'a"b'}
+        assert values['message'] == '\\N'
+        assert is_copy_supported(CsvLog)
+
+    @pytest.mark.django_db
+    def test_save_copy_engine_invalid_value(self, auth_user_admin, auth_user_csv_log, monkeypatch):
+        """COPYの値に変換できない行は、その行のみエラーにする"""
+        copied_rows = []
+
+        def fake_copy_upsert(model, copy_rows, unique_fields, update_fields, is_overwrite):
+            copied_rows.extend(copy_rows)
+            return {('tester1', ): True}
+
+        def fake_to_copy_row(fields, instance):
+            if instance.username == 'tester2':
+                raise ValueError('invalid value')
+            return to_copy_row(fields, instance)
+
+        monkeypatch.setattr(csv_upload_mixin, 'is_copy_available', lambda: True)
+        monkeypatch.setattr(csv_upload_mixin, 'copy_upsert', fake_copy_upsert)
+        monkeypatch.setattr(csv_upload_mixin, 'to_copy_row', fake_to_copy_row)
+        auth_user_admin.import_engine = CsvImportEngine.COPY
+        invalid = copy.deepcopy(auth_user_csv_log)
+        invalid.row_no = 2
+        invalid.row_content['username'] = 'tester2'
+        chunk = [auth_user_csv_log, invalid]
+        for csv_log in chunk:
+            auth_user_admin._CsvUploadMixin__validate_by_modelform(csv_log)
+
+        assert auth_user_admin._CsvUploadMixin__save(chunk) == 1
+        assert len(copied_rows) == 1
+        assert (auth_user_csv_log.log_level, auth_user_csv_log.edit_type) == (CsvLog.INFO, CsvLog.INSERT)
+        assert (invalid.log_level, invalid.message) == (CsvLog.ERROR, 'invalid value')
+
     @pytest.mark.django_db
     def test_read_csv_file(self, auth_user_admin, csv_file):
         auth_user_admin.csv_file = csv_file
@@ -287,6 +606,59 @@ class TestCsvUploadMixin:
 
         assert row_no == 3
 
+    @pytest.mark.django_db
+    def test_read_csv_file_compact_log(self, auth_user_admin, csv_file):
+        auth_user_admin.log_storage = CsvLogStorage.COMPACT
+        auth_user_admin.csv_file = csv_file
+        auth_user_admin.user_name = 'login_user'
+        auth_user_admin.lot_number = 'test_lot_number'
+        auth_user_admin.read_csv_file()
+
+        csv_logs = CsvLog.objects.filter(lot_number='test_lot_number')
+        assert [csv_log.row_no for csv_log in csv_logs] == [CsvLog.SUMMARY_ROW_NO]
+        assert json.loads(csv_logs[0].row_content) == {CsvLog.INSERT: '2', CsvLog.UPDATE: '0', CsvLog.DELETE: '0'}
+        assert CsvLog.count_by_log_level('test_lot_number') == {CsvLog.INFO: 2}
+
+    @pytest.mark.django_db
+    def test_read_csv_file_delete(self, auth_user_admin):
+        AuthUser.objects.create_user(username='test1', password='password')
+        auth_user_admin.delete_file_pattern = r'DEL_\d{4}\.CSV'
+        csv_data = "User Name,Password,Email,First Name,Last Name,Joined Date\n"
+        csv_data += "test1,password,test1@hotmail.com,Jenny,Black,2023/09/23 12:00:00\n"
+        csv_data += "test3,password,test3@hotmail.com,Jenny,Black,2023/09/23 12:00:00"
+        byte_buffer = BytesIO(csv_data.encode())
+        byte_buffer.name = 'del_2401.csv'
+
+        auth_user_admin.csv_file = byte_buffer
+        auth_user_admin.user_name = 'login_user'
+        auth_user_admin.lot_number = 'test_lot_number'
+        auth_user_admin.read_csv_file()
+
+        assert not AuthUser.objects.filter(username='test1').exists()
+        csv_logs = CsvLog.objects.filter(lot_number='test_lot_number').order_by('row_no')
+        assert [(csv_log.log_level, csv_log.edit_type) for csv_log in csv_logs] == \
+            [(CsvLog.INFO, CsvLog.DELETE), (CsvLog.WARN, CsvLog.DELETE)]
+        assert auth_user_admin.lot_summary.deleted_count == 1
+        assert auth_user_admin.get_import_operation('ADD_2401.CSV') == CsvImportOperation.UPSERT
+
+    @pytest.mark.django_db
+    def test_read_csv_file_row_transforms(self, auth_user_admin, csv_file):
+        def skip_test1(rows):
+            for (row_no, row) in rows:
+                if row[0] != 'test1':
+                    yield row_no, [row[0].upper()] + row[1:]
+
+        auth_user_admin.row_transforms = (skip_test1, )
+        auth_user_admin.csv_file = csv_file
+        auth_user_admin.user_name = 'login_user'
+        auth_user_admin.lot_number = 'test_lot_number'
+        assert auth_user_admin.read_csv_file() == 3
+
+        csv_logs = CsvLog.objects.filter(lot_number='test_lot_number')
+        assert [csv_log.row_no for csv_log in csv_logs] == [3]
+        assert AuthUser.objects.filter(username='TEST2').exists()
+        assert not AuthUser.objects.filter(username='test1').exists()
+
     @pytest.mark.django_db
     def test_read_csv_file_chunk_size(self, auth_user_admin, csv_file):
         auth_user_admin.chunk_size = 1
@@ -298,6 +670,47 @@ class TestCsvUploadMixin:
 
         assert row_no == 3
 
+    @pytest.mark.django_db
+    def test_check_unique_in_chunk(self, auth_user_admin, auth_user_csv_log):
+        AuthUser.objects.create(username='tester1', password='password')
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(auth_user_csv_log, validate_unique=False)
+        assert auth_user_csv_log.log_level == CsvLog.INFO
+        assert auth_user_csv_log.edit_type == CsvLog.INSERT
+
+        new_csv_log = copy.deepcopy(auth_user_csv_log)
+        new_csv_log.row_no = 2
+        new_csv_log.row_content['username'] = 'tester2'
+        auth_user_admin._CsvUploadMixin__validate_by_modelform(new_csv_log, validate_unique=False)
+
+        auth_user_admin._CsvUploadMixin__check_unique_in_chunk([auth_user_csv_log, new_csv_log], set())
+        assert auth_user_csv_log.edit_type == CsvLog.UPDATE
+        assert auth_user_csv_log.message == _('Update existing row.')
+        assert new_csv_log.edit_type == CsvLog.INSERT
+
+    @pytest.mark.django_db
+    def test_read_csv_file_duplicated_in_file(self, auth_user_admin):
+        auth_user_admin.chunk_size = 1
+        auth_user_admin.is_overwrite_existing = False
+        csv_data = "User Name,Password,Email,First Name,Last Name,Joined Date\n"
+        csv_data += "test1,password,test1@hotmail.com,Jenny,Black,2023/09/23 12:00:00\n"
+        csv_data += "test1,password,test2@hotmail.com,Jenny,Black,2023/09/23 12:00:00"
+        byte_buffer = BytesIO(csv_data.encode())
+        byte_buffer.name = 'test.csv'
+
+        auth_user_admin.csv_file = byte_buffer
+        auth_user_admin.user_name = 'login_user'
+        auth_user_admin.lot_number = 'test_lot_number'
+        auth_user_admin.read_csv_file()
+
+        csv_logs = CsvLog.objects.filter(lot_number='test_lot_number').order_by('row_no')
+        assert [csv_log.log_level for csv_log in csv_logs] == [CsvLog.INFO, CsvLog.WARN]
+        assert csv_logs[1].message == _('Skipped because the row is duplicated in the file.')
+        assert AuthUser.objects.get(username='test1').email == 'test1@hotmail.com'
+
+        summary = CsvLotSummary.objects.get(lot_number='test_lot_number')
+        assert (summary.read_count, summary.inserted_count, summary.skipped_count) == (2, 1, 1)
+        assert summary.finished_at is not None
+
     @pytest.mark.django_db
     def test_read_csv_file_has_too_many_errors(self, auth_user_admin):
         auth_user_admin.chunk_size = 10
@@ -321,3 +734,19 @@ class TestCsvUploadMixin:
         row_no = auth_user_admin.read_csv_file()
 
         assert row_no == 2
+
+    @pytest.mark.django_db
+    def test_read_csv_file_validation_workers(self, auth_user_admin, csv_file):
+        auth_user_admin.chunk_size = 1
+        auth_user_admin.validation_workers = 2
+
+        auth_user_admin.csv_file = csv_file
+        auth_user_admin.user_name = 'login_user'
+        auth_user_admin.lot_number = 'test_lot_number'
+        row_no = auth_user_admin.read_csv_file()
+
+        assert row_no == 3
+        csv_logs = CsvLog.objects.filter(lot_number='test_lot_number').order_by('row_no')
+        assert [csv_log.row_no for csv_log in csv_logs] == [2, 3]
+        assert [csv_log.edit_type for csv_log in csv_logs] == [CsvLog.INSERT, CsvLog.INSERT]
+        assert AuthUser.objects.filter(username__in=['test1', 'test2']).count() == 2
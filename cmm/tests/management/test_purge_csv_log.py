@@ -0,0 +1,85 @@
+import pytest
+import gzip
+import json
+from datetime import date, timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+from cmm.csv import CsvLog
+from cmm.management.commands.partition_csv_log import Command as PartitionCommand, _add_months
+
+
+def create_csv_log(lot_number, row_no, days_ago):
+    CsvLog(lot_number=lot_number, file_name='test.csv', row_no=row_no, updater='py_tester',
+           created_at=timezone.now() - timedelta(days=days_ago)).save()
+
+
+@pytest.mark.django_db
+def test_purge_csv_log(tmp_path):
+    create_csv_log('old_lot', 1, 100)
+    create_csv_log('old_lot', 2, 100)
+    create_csv_log('new_lot', 1, 1)
+    # 最後の行が保存期間内のロットは残す
+    create_csv_log('mixed_lot', 1, 100)
+    create_csv_log('mixed_lot', 2, 10)
+
+    out = StringIO()
+    call_command('purge_csv_log', days=30, archive_dir=str(tmp_path), batch_size=1, stdout=out)
+
+    assert set(CsvLog.objects.values_list('lot_number', flat=True)) == {'new_lot', 'mixed_lot'}
+    with gzip.open(tmp_path / 'old_lot.jsonl.gz', 'rt', encoding='utf-8') as archive_file:
+        rows = [json.loads(line) for line in archive_file]
+    assert [row['row_no'] for row in rows] == [1, 2]
+    assert '2 rows purged' in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_purge_csv_log_dry_run():
+    create_csv_log('old_lot', 1, 100)
+
+    out = StringIO()
+    call_command('purge_csv_log', days=30, dry_run=True, stdout=out)
+
+    assert CsvLog.objects.filter(lot_number='old_lot').exists()
+    assert 'old_lot: 1 rows' in out.getvalue()
+
+
+def test_purge_csv_log_invalid_days():
+    with pytest.raises(CommandError):
+        call_command('purge_csv_log', days=-1)
+
+
+@pytest.mark.django_db
+def test_partition_csv_log_without_convert():
+    # PostgreSQL以外、またはパーティション化前に--convertなしで実行した場合はエラー
+    with pytest.raises(CommandError):
+        call_command('partition_csv_log')
+
+
+def test_add_months():
+    assert _add_months(date(2024, 11, 1), 1) == date(2024, 12, 1)
+    assert _add_months(date(2024, 11, 1), 2) == date(2025, 1, 1)
+    assert _add_months(date(2024, 1, 1), -1) == date(2023, 12, 1)
+    assert _add_months(date(2024, 1, 1), 0) == date(2024, 1, 1)
+
+
+@pytest.mark.django_db
+def test_partition_csv_log_convert(monkeypatch):
+    calls = []
+    monkeypatch.setattr(connection, 'vendor', 'postgresql')
+    monkeypatch.setattr(PartitionCommand, '_Command__is_partitioned', staticmethod(lambda table: False))
+    monkeypatch.setattr(PartitionCommand, '_Command__convert', lambda self, table: calls.append(('convert', table)))
+    monkeypatch.setattr(PartitionCommand, '_Command__create_partitions',
+                        lambda self, table, months_ahead: calls.append(('create', months_ahead)) or 2)
+
+    # パーティション化されていないテーブルは--convertなしでは変更しない
+    with pytest.raises(CommandError, match='--convert'):
+        call_command('partition_csv_log')
+    assert not calls
+
+    stdout = StringIO()
+    call_command('partition_csv_log', '--convert', '--months-ahead', '6', stdout=stdout)
+    assert calls == [('convert', CsvLog._meta.db_table), ('create', 6)]
+    assert '2 partitions created.' in stdout.getvalue()
@@ -0,0 +1,61 @@
+import pytest
+from cmm.csv import CsvLog
+from django.contrib.sessions.models import Session
+from cmm.models.utils import _unique_constraints
+from cmm.models import (AuthUser, get_existing_keys, get_unique_fields, get_unique_constraint, get_rows_by_unique_keys,
+                        clear_unique_constraint_cache)
+
+
+def test_get_unique_fields():
+    assert get_unique_fields(CsvLog) == ('lot_number', 'file_name', 'row_no')
+    assert get_unique_fields(AuthUser) == ('username', )
+
+
+@pytest.mark.django_db
+def test_get_unique_fields_cache(django_assert_num_queries):
+    clear_unique_constraint_cache()
+    # get_unique_constraint()のキャッシュを共有し、Metaに定義がない場合のDBへの問い合わせは1回だけ
+    assert get_unique_fields(Session) == ()
+    with django_assert_num_queries(0):
+        assert get_unique_fields(Session) == ()
+    assert Session in _unique_constraints
+    clear_unique_constraint_cache()
+    assert Session not in _unique_constraints
+
+
+@pytest.mark.django_db
+def test_get_existing_keys():
+    CsvLog(lot_number='lot', file_name='test.csv', row_no=1, updater='pytest').save()
+    CsvLog(lot_number='lot', file_name='test.csv', row_no=2, updater='pytest').save()
+
+    keys = [('lot', 'test.csv', '1'), ('lot', 'test.csv', 3), ('lot', 'other.csv', 2), ('lot', None, 1)]
+    assert get_existing_keys(CsvLog, get_unique_fields(CsvLog), keys) == {('lot', 'test.csv', '1')}
+
+
+@pytest.mark.django_db
+def test_get_unique_constraint(django_assert_num_queries):
+    clear_unique_constraint_cache()
+    with django_assert_num_queries(0):
+        assert get_unique_constraint(CsvLog) == {
+            'cmm_csv_log_lot_number_file_name_row_no_uniq': ['lot_number', 'file_name', 'row_no']}
+        assert list(get_unique_constraint(AuthUser).values()) == [['username']]
+
+
+@pytest.mark.django_db
+def test_get_unique_constraint_introspection(django_assert_num_queries):
+    clear_unique_constraint_cache()
+    # Metaに定義がない場合はDBに問い合わせ、結果をキャッシュする
+    assert get_unique_constraint(Session) == {}
+    with django_assert_num_queries(0):
+        assert get_unique_constraint(Session) == {}
+
+
+@pytest.mark.django_db
+def test_get_rows_by_unique_keys():
+    csv_log = CsvLog(lot_number='lot', file_name='test.csv', row_no=1, updater='pytest')
+    csv_log.save()
+
+    rows = get_rows_by_unique_keys(CsvLog, get_unique_fields(CsvLog),
+                                   [('lot', 'test.csv', '1'), ('lot', 'test.csv', 2)])
+    assert list(rows.keys()) == [('lot', 'test.csv', '1')]
+    assert rows[('lot', 'test.csv', '1')].pk == csv_log.pk
@@ -24,3 +24,45 @@ def test_save_race_condition():
     with pytest.raises(ValidationError) as error:
         copied.save()
         assert error.code == 'race_condition'
+
+
+@pytest.mark.django_db
+def test_save_update_fields():
+    csv_log = CsvLog(log_level='info', updater='pytest')
+    csv_log.save()
+    csv_log.message = 'updated'
+    csv_log.save(update_fields=['message'])
+    assert CsvLog.objects.get(pk=csv_log.pk).version == 2
+
+
+@pytest.mark.django_db
+def test_save_race_condition_keeps_version():
+    csv_log = CsvLog(log_level='info', updater='pytest')
+    csv_log.save()
+    copied = copy.deepcopy(csv_log)
+    csv_log.save()
+    with pytest.raises(ValidationError):
+        copied.save()
+    assert copied.version == 1
+    assert CsvLog.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_bulk_update_versioned():
+    csv_logs = [CsvLog(row_no=row_no, updater='pytest') for row_no in range(3)]
+    for csv_log in csv_logs:
+        csv_log.save()
+    stale = copy.deepcopy(csv_logs[1])
+    csv_logs[1].save()
+
+    stale.message = 'stale'
+    csv_logs[0].message = 'updated'
+    csv_logs[2].message = 'updated'
+    conflicts = CsvLog.objects.bulk_update_versioned([csv_logs[0], stale, csv_logs[2]], fields=['message'],
+                                                     batch_size=2)
+
+    assert conflicts == [stale]
+    assert csv_logs[0].version == 2
+    assert list(CsvLog.objects.order_by('row_no').values_list('message', 'version')) == [('updated', 2),
+                                                                                         (None, 2),
+                                                                                         ('updated', 2)]
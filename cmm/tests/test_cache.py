@@ -0,0 +1,100 @@
+import threading
+from cmm.cache import StampedCache
+
+
+class CountingCache(StampedCache[list]):
+    """for test"""
+    check_interval = 60
+
+    def __init__(self):
+        super().__init__()
+        self.stamp = 1
+        self.build_count = 0
+
+    def get_stamp(self):
+        return self.stamp
+
+    def build(self):
+        self.build_count += 1
+        return [self.stamp]
+
+
+def test_stamped_cache_get():
+    cache = CountingCache()
+    assert cache.get() == [1]
+    assert cache.get() == [1]
+    assert cache.build_count == 1
+
+    # check_interval内はstampを確認しない
+    cache.stamp = 2
+    assert cache.get() == [1]
+
+    cache.invalidate()
+    assert cache.get() == [2]
+    assert cache.build_count == 2
+
+    # stampが変わらなければ作り直さない
+    cache.invalidate()
+    assert cache.get() == [2]
+    assert cache.build_count == 2
+
+
+def test_stamped_cache_refresh():
+    cache = CountingCache()
+    # 未作成の場合は作らない
+    cache.refresh()
+    assert cache.build_count == 0
+
+    cache.get()
+    cache.refresh()
+    assert cache.build_count == 2
+
+
+def test_stamped_cache_get_while_building():
+    cache = CountingCache()
+    cache.get()
+    building, finish = threading.Event(), threading.Event()
+    build = cache.build
+
+    def slow_build():
+        building.set()
+        finish.wait(5)
+        return build()
+
+    cache.build = slow_build
+    cache.stamp = 2
+    cache.invalidate()
+    thread = threading.Thread(target=cache.get)
+    thread.start()
+    assert building.wait(5)
+    # 作り直している間も、他のスレッドは待たずに作成済みのキャッシュを参照する
+    assert cache.get() == [1]
+    finish.set()
+    thread.join()
+    assert cache.get() == [2]
+
+
+def test_stamped_cache_refresh_without_lock():
+    cache = CountingCache()
+    cache.get()
+    building, finish = threading.Event(), threading.Event()
+    build = cache.build
+
+    def slow_build():
+        if not building.is_set():
+            building.set()
+            finish.wait(5)
+        return build()
+
+    cache.build = slow_build
+    cache.stamp = 2
+    thread = threading.Thread(target=cache.refresh)
+    thread.start()
+    assert building.wait(5)
+    # refresh()はロックの外で作成するため、作成中もget()はロックを待たない
+    cache.invalidate()
+    assert cache.get() == [2]
+    finish.set()
+    thread.join()
+    assert cache.get() == [2]
+    assert cache.build_count == 3
@@ -0,0 +1,205 @@
+import logging
+import threading
+import pytest
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.http import HttpResponse
+from django.test import RequestFactory
+from cmm.logging import (QueueListenerHandler, LoggingRequestAttributesFilter, LoggingRequestAttributesMiddleware,
+                         LogRequestContext, get_request_context, _request_context, log_decorator,
+                         set_log_row_count, summarize_argument)
+from cmm.models import AuthUser
+from cmm.tests.cmm_fixtures import *
+
+
+class ListHandler(logging.Handler):
+    """for test"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def list_handler():
+    handler = ListHandler()
+    handler.set_name('pytest_list_handler')
+    handler.addFilter(LoggingRequestAttributesFilter())
+    yield handler
+    handler.close()
+
+
+def make_record(message: str) -> logging.LogRecord:
+    return logging.LogRecord('pytest', logging.INFO, __file__, 0, message, None, None)
+
+
+def test_queue_listener_handler(list_handler):
+    queue_handler = QueueListenerHandler(handlers=['pytest_list_handler'])
+    queue_handler.addFilter(LoggingRequestAttributesFilter())
+    token = _request_context.set(LogRequestContext(RequestFactory().get('/'), 'tester'))
+    try:
+        queue_handler.handle(make_record('message'))
+    finally:
+        _request_context.reset(token)
+    queue_handler.close()
+
+    # 出力元のスレッドで設定したユーザー名が、バックグラウンドスレッドでも保持される
+    assert [record.getMessage() for record in list_handler.records] == ['message']
+    assert list_handler.records[0].username == 'tester'
+    assert queue_handler.enqueued_count == 1
+
+
+def test_queue_listener_handler_dropped(list_handler):
+    blocker = threading.Event()
+    list_handler.emit = lambda record: blocker.wait(5) and list_handler.records.append(record)
+    queue_handler = QueueListenerHandler(handlers=['pytest_list_handler'], queue_size=1)
+    for n in range(5):
+        queue_handler.handle(make_record(f'message {n}'))
+    assert queue_handler.dropped_count > 0
+    blocker.set()
+    queue_handler.close()
+
+
+def test_queue_listener_handler_format_in_listener(list_handler):
+    format_threads = []
+
+    class ThreadFormatter(logging.Formatter):
+        def format(self, record):
+            format_threads.append(threading.current_thread())
+            return super().format(record)
+
+    list_handler.setFormatter(ThreadFormatter())
+    list_handler.emit = lambda record: list_handler.records.append(list_handler.format(record))
+    queue_handler = QueueListenerHandler(handlers=['pytest_list_handler'])
+    record = logging.LogRecord('pytest', logging.INFO, __file__, 0, 'message %s', ('arg', ), None)
+    queue_handler.handle(record)
+    queue_handler.close()
+
+    # 出力元のスレッドでは整形せず、出力先のhandlerがQueueListenerのスレッドで整形する
+    assert list_handler.records == ['message arg']
+    assert format_threads and threading.current_thread() not in format_threads
+    assert (record.msg, record.args) == ('message %s', ('arg', ))
+
+
+def test_queue_listener_handler_concurrent_enqueue(list_handler):
+    queue_handler = QueueListenerHandler(handlers=['pytest_list_handler'])
+    threads = [threading.Thread(target=lambda: [queue_handler.handle(make_record('message')) for _n in range(200)])
+               for _i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue_handler.close()
+    assert queue_handler.enqueued_count == len(list_handler.records) == 1600
+
+
+def test_queue_listener_handler_reset_after_fork(list_handler):
+    queue_handler = QueueListenerHandler(handlers=['pytest_list_handler'])
+    queue_handler.handle(make_record('before fork'))
+    # fork後の子プロセスでは親プロセスのQueueListenerのスレッドがないため、次の出力時に開始し直す
+    queue_handler.reset_after_fork()
+    assert queue_handler.listener is None
+    queue_handler.handle(make_record('after fork'))
+    assert queue_handler.listener is not None
+    queue_handler.close()
+    assert 'after fork' in [record.getMessage() for record in list_handler.records]
+    assert queue_handler.enqueued_count == 1
+
+
+def test_queue_listener_handler_unknown_handler():
+    with pytest.raises(ValueError):
+        QueueListenerHandler(handlers=['unknown_handler'])
+
+
+def test_log_request_context_forwarded_for():
+    request = RequestFactory().get('/', HTTP_X_FORWARDED_FOR='10.0.0.1, 192.168.0.1', REMOTE_ADDR='192.168.0.1')
+    assert LogRequestContext(request).ip_address == '10.0.0.1'
+    assert LogRequestContext(RequestFactory().get('/', REMOTE_ADDR='10.0.0.2')).ip_address == '10.0.0.2'
+
+
+def test_middleware_sync():
+    def get_response(request):
+        record = make_record('message')
+        LoggingRequestAttributesFilter().filter(record)
+        return HttpResponse(f'{record.username},{record.ip_address}')
+
+    middleware = LoggingRequestAttributesMiddleware(get_response)
+    request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+    request.user = type('User', (), {'username': 'tester'})()
+    assert middleware(request).content == b'tester,10.0.0.1'
+    assert get_request_context() is None
+
+
+def test_middleware_async():
+    async def get_response(request):
+        record = make_record('message')
+        LoggingRequestAttributesFilter().filter(record)
+        return HttpResponse(f'{record.username},{record.ip_address}')
+
+    middleware = LoggingRequestAttributesMiddleware(get_response)
+    assert iscoroutinefunction(middleware)
+    response = async_to_sync(middleware)(RequestFactory().get('/', REMOTE_ADDR='10.0.0.1'))
+    assert response.content == b'None,10.0.0.1'
+    assert get_request_context() is None
+
+
+@log_decorator
+def decorated_action(model_admin, request, queryset):
+    """for test"""
+    return queryset
+
+
+@pytest.mark.django_db
+def test_log_decorator(auth_user_admin, test_request, caplog, django_assert_num_queries):
+    queryset = AuthUser.objects.all()
+    with caplog.at_level(logging.INFO, logger=__name__), django_assert_num_queries(0):
+        assert decorated_action(auth_user_admin, test_request, queryset) is queryset
+
+    assert decorated_action.__name__ == 'decorated_action'
+    record = caplog.records[-1]
+    assert 'decorated_action(<AuthUserAdmin cmm.AuthUser>, <WSGIRequest GET /' in record.getMessage()
+    assert '<QuerySet cmm.AuthUser>' in record.getMessage()
+    assert record.elapsed_ms >= 0
+    # set_log_row_count()を呼び出していない場合はrow_countを設定しない
+    assert not hasattr(record, 'row_count')
+
+
+@log_decorator
+def decorated_counting_action(model_admin, request, queryset):
+    """for test"""
+    set_log_row_count(len(queryset))
+    return queryset
+
+
+@log_decorator
+def decorated_failing_action(model_admin, request, queryset):
+    """for test"""
+    raise ValueError('failed')
+
+
+@pytest.mark.django_db
+def test_log_decorator_row_count(auth_user_admin, test_request, caplog):
+    with caplog.at_level(logging.INFO, logger=__name__):
+        decorated_counting_action(auth_user_admin, test_request, AuthUser.objects.all())
+    assert caplog.records[-1].row_count == AuthUser.objects.count()
+
+    # log_decoratorの外では何もしない
+    set_log_row_count(1)
+
+
+@pytest.mark.django_db
+def test_log_decorator_exception(auth_user_admin, test_request, caplog):
+    with caplog.at_level(logging.INFO, logger=__name__), pytest.raises(ValueError):
+        decorated_failing_action(auth_user_admin, test_request, AuthUser.objects.all())
+    record = caplog.records[-1]
+    assert record.levelno == logging.ERROR
+    assert record.exc_info[0] is ValueError
+    assert 'raised an exception' in record.getMessage()
+
+
+def test_summarize_argument():
+    assert summarize_argument(None) == 'None'
+    assert summarize_argument(1) == '1'
+    assert summarize_argument('a' * 100) == repr('a' * 64 + '...')
+    assert summarize_argument(object()) == '<builtins.object>'
@@ -0,0 +1,68 @@
+import pytest
+from django.contrib import admin
+from django.core.cache import caches
+from cmm import paginator as cmm_paginator
+from cmm.csv import CsvLog
+from cmm.paginator import ApproximateCountMixin, ApproximateCountPaginator, estimate_row_count
+
+
+class CsvLogAdmin(ApproximateCountMixin, admin.ModelAdmin):
+    approximate_count_threshold = 10
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    caches['default'].clear()
+    yield
+    caches['default'].clear()
+
+
+def create_csv_log(count, lot_number='1', file_name='test.csv'):
+    CsvLog.objects.bulk_create(
+        CsvLog(lot_number=lot_number, file_name=file_name, row_no=i, updater='py_tester') for i in range(count))
+
+
+@pytest.mark.django_db
+def test_estimate_row_count_not_postgresql():
+    assert estimate_row_count(CsvLog) is None
+
+
+@pytest.mark.django_db
+def test_paginator_exact_count_cached():
+    create_csv_log(3)
+    assert ApproximateCountPaginator(CsvLog.objects.order_by('id'), 2).count == 3
+
+    # キャッシュされた件数を使う
+    create_csv_log(2, lot_number='2')
+    assert ApproximateCountPaginator(CsvLog.objects.order_by('id'), 2).count == 3
+
+    # 絞り込み条件ごとにキャッシュする
+    create_csv_log(1, lot_number='3', file_name='other.csv')
+    assert ApproximateCountPaginator(CsvLog.objects.filter(file_name='other.csv').order_by('id'), 2).count == 1
+
+
+@pytest.mark.django_db
+def test_paginator_approximate_count(monkeypatch):
+    monkeypatch.setattr(cmm_paginator, 'estimate_row_count', lambda model, using='default': 1000000)
+    create_csv_log(3)
+    assert ApproximateCountPaginator(CsvLog.objects.order_by('id'), 2, threshold=100).count == 1000000
+    # 閾値以下の場合、絞り込みがある場合は実際の件数
+    assert ApproximateCountPaginator(CsvLog.objects.order_by('id'), 2, threshold=10000000).count == 3
+    assert ApproximateCountPaginator(CsvLog.objects.filter(row_no__lt=2).order_by('id'), 2, threshold=100).count == 2
+
+
+@pytest.mark.django_db
+def test_show_full_result_count(monkeypatch, admin_user, rf, django_assert_num_queries):
+    model_admin = CsvLogAdmin(CsvLog, admin.site)
+    request = rf.get('/admin/cmm/csvlog/')
+    request.user = admin_user
+    changelist = model_admin.get_changelist_instance(request)
+    assert model_admin.show_full_result_count
+    assert changelist.full_result_count == 0
+
+    caches['default'].clear()
+    monkeypatch.setattr(cmm_paginator, 'estimate_row_count', lambda model, using='default': 11)
+    changelist = model_admin.get_changelist_instance(request)
+    assert not model_admin.show_full_result_count
+    assert changelist.full_result_count is None
+    assert model_admin.get_paginator(None, CsvLog.objects.order_by('id'), 2).count == 11
@@ -1,8 +1,16 @@
 from django.contrib import admin
+from django.core.exceptions import ValidationError
+from django.utils.translation import gettext_lazy as _
 
-from cmm.csv import (download_csv, download_excel, DOWNLOAD_CSV, DOWNLOAD_EXCEL, CsvMixin)
+from cmm.csv import (download_csv, download_excel, DOWNLOAD_CSV, DOWNLOAD_EXCEL,
+                     download_csv_gzip, download_csv_zip, DOWNLOAD_CSV_GZIP, DOWNLOAD_CSV_ZIP,
+                     CsvMixin, CsvImportEngine, CsvDownloadEngine, CsvLogStorage)
+from cmm.paginator import ApproximateCountMixin
 from busking.admin import buskingSite
-from cmm_data.models import Shikuchoson, Postcode
+from cmm_data.ken_all import merge_continued_choiki
+from cmm_data.models import ChangeTypeChoices, Shikuchoson, Postcode
+from cmm_data.postcode_index import postcode_index
+from cmm_data.shikuchoson_cache import shikuchoson_cache
 
 
 class ShikuchosonAdmin(CsvMixin, admin.ModelAdmin):
@@ -11,18 +19,55 @@ class ShikuchosonAdmin(CsvMixin, admin.ModelAdmin):
     list_display = ('shikuchoson_code', 'todofuken_name', 'shikuchoson_name')
     list_display_links = None       # remove the link to the model's edit view
 
+    def post_import_processing(self, *args, **kwargs):
+        """取り込み後に市区町村のキャッシュを作り直させる"""
+        shikuchoson_cache.invalidate()
 
-class PostcodeAdmin(CsvMixin, admin.ModelAdmin):
+
+class PostcodeAdmin(ApproximateCountMixin, CsvMixin, admin.ModelAdmin):
     """AdminSiteでの表示をカスタマイズする"""
     header_row_number = 0
     chunk_size = 10000
+    is_streaming = True
+    is_constant_memory = True
+    import_engine = CsvImportEngine.COPY
+    download_engine = CsvDownloadEngine.COPY
+    log_storage = CsvLogStorage.COMPACT
+    # 日本郵便の月次差分ファイル、DEL_YYMM.CSVの行は削除し、ADD_YYMM.CSVの行は通常どおり登録、更新する
+    delete_file_pattern = r'DEL_\d{4}\.CSV'
+    # 複数行に分割された町域名を1行にまとめてから取り込む
+    row_transforms = (merge_continued_choiki, )
     # encoding = 'SJIS'
-    list_display = ('postcode', 'todofuken_name', 'shikuchoson_name', 'choiki_name')
+    list_display = ('postcode', 'todofuken_name', 'shikuchoson_name', 'choiki_name', 'shikuchoson_master')
     list_display_links = None       # remove the link to the model's edit view
 
+    @admin.display(description=_('shikuchoson master'))
+    def shikuchoson_master(self, obj):
+        """市区町村マスタの名称、ページの行ごとにShikuchosonを検索しないようにキャッシュから取得する"""
+        entry = shikuchoson_cache.get().get(obj.shikuchoson_code)
+        return f'{entry.todofuken_name}{entry.shikuchoson_name}' if entry else '-'
+
+    def validate_csv_row(self, cleaned_data):
+        """市区町村コードが市区町村マスタにあるか、マスタが未登録の場合はチェックしない"""
+        shikuchoson = shikuchoson_cache.get()
+        code = cleaned_data.get('shikuchoson_code')
+        if len(shikuchoson) and code not in shikuchoson:
+            raise ValidationError(_('Shikuchoson code %(code)s does not exist.'), params={'code': code})
+
+    def is_delete_row(self, row_content):
+        """削除ファイルの行に加えて、更新の表示が廃止の行も削除する"""
+        is_abolition = row_content.get('change_type') == str(ChangeTypeChoices.ABOLITION.value)
+        return super().is_delete_row(row_content) or is_abolition
+
+    def post_import_processing(self, *args, **kwargs):
+        """取り込み後に検索用インデックスを作り直す"""
+        postcode_index.refresh()
+
 
 buskingSite.add_action(download_csv, DOWNLOAD_CSV)
 buskingSite.add_action(download_excel, DOWNLOAD_EXCEL)
+buskingSite.add_action(download_csv_gzip, DOWNLOAD_CSV_GZIP)
+buskingSite.add_action(download_csv_zip, DOWNLOAD_CSV_ZIP)
 
 buskingSite.register(Shikuchoson, ShikuchosonAdmin)
 buskingSite.register(Postcode, PostcodeAdmin)
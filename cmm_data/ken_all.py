@@ -0,0 +1,48 @@
+from typing import Iterator, List, Optional, Tuple
+
+
+# KEN_ALL.CSVの列(Postcodeの項目順と同じ)
+POSTCODE_COLUMN = 2
+CHOIKI_KANA_COLUMN = 5
+CHOIKI_NAME_COLUMN = 8
+
+
+def _is_open(choiki_name: str) -> bool:
+    """町域名の括弧が閉じていないか、閉じていない場合は次の行に続く"""
+    return choiki_name.count('（') > choiki_name.count('）')
+
+
+def merge_continued_choiki(rows: Iterator[Tuple[int, List[str]]]) -> Iterator[Tuple[int, List[str]]]:
+    """
+    KEN_ALL.CSVでは長い町域名(括弧内)が同じ郵便番号の複数行に分割されているため、1行にまとめる
+    括弧が閉じていない行に、括弧が閉じるまで後続行の町域名、町域名カナをつなげる
+    カナは分割されずに同じ値が繰り返される場合があるため、直前の値と同じ場合はつなげない
+    まとめている途中の1行のみ保持する
+    """
+    pending: Optional[List[str]] = None
+    pending_row_no = 0
+    last_kana = ''
+    for (row_no, row) in rows:
+        if pending is not None and len(row) > CHOIKI_NAME_COLUMN \
+                and row[POSTCODE_COLUMN] == pending[POSTCODE_COLUMN]:
+            pending[CHOIKI_NAME_COLUMN] += row[CHOIKI_NAME_COLUMN]
+            if row[CHOIKI_KANA_COLUMN] != last_kana:
+                pending[CHOIKI_KANA_COLUMN] += row[CHOIKI_KANA_COLUMN]
+                last_kana = row[CHOIKI_KANA_COLUMN]
+            if not _is_open(pending[CHOIKI_NAME_COLUMN]):
+                yield pending_row_no, pending
+                pending = None
+            continue
+
+        # 括弧が閉じないまま郵便番号が変わった場合は、そのまま出力して入力チェックに任せる
+        if pending is not None:
+            yield pending_row_no, pending
+            pending = None
+
+        if len(row) > CHOIKI_NAME_COLUMN and _is_open(row[CHOIKI_NAME_COLUMN]):
+            pending, pending_row_no, last_kana = list(row), row_no, row[CHOIKI_KANA_COLUMN]
+        else:
+            yield row_no, row
+
+    if pending is not None:
+        yield pending_row_no, pending
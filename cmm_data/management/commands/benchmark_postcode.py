@@ -0,0 +1,141 @@
+import copy
+import random
+import time
+import tracemalloc
+from statistics import quantiles
+from typing import Callable, List
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from busking.admin import buskingSite
+from cmm.csv import CsvLog, CsvPagination
+from cmm_data.models import Postcode
+from cmm_data.postcode_index import PostcodeIndexCache
+
+# 検索結果として返す項目、PostcodeIndex.get_row()と同じ
+SEARCH_FIELDS = ('postcode', 'shikuchoson_code', 'todofuken_name', 'shikuchoson_name', 'choiki_name',
+                 'todofuken_kana', 'shikuchoson_kana', 'choiki_kana')
+
+
+def synthetic_row(n: int) -> list[str]:
+    """KEN_ALL.CSV形式の合成行、郵便番号と町域名はnの連番"""
+    return ['13101', '100  ', f'{1000000 + n:07d}', 'ﾄｳｷｮｳﾄ', 'ﾁﾖﾀﾞｸ', f'ﾁｮｳｲｷ{n}', '東京都', '千代田区', f'町域{n}',
+            '0', '0', '0', '0', '0', '0']
+
+
+class _Rollback(Exception):
+    """ベンチマーク用に登録した行を残さないため、トランザクションをロールバックさせる"""
+
+
+class Command(BaseCommand):
+    help = 'Measure the Postcode CSV import and export paths. Run it on two commits to compare them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['validate', 'download', 'search'],
+                            help='validate: per-row ModelForm validation of KEN_ALL-style rows. '
+                                 'download: rows/sec of generate_csv_data over Postcode. '
+                                 'search: latency of postcode/town name prefix search, ORM vs PostcodeIndex.')
+        parser.add_argument('--rows', type=int, default=3000, help='Number of rows (default: 3000).')
+        parser.add_argument('--pagination', choices=[p.value for p in CsvPagination],
+                            help='Override PostcodeAdmin.pagination for download.')
+        parser.add_argument('--queries', type=int, default=2000, help='Number of search queries (default: 2000).')
+        parser.add_argument('--limit', type=int, default=20, help='Search results per query (default: 20).')
+
+    def handle(self, *args, **options):
+        # PostcodeAdminの処理を使う、インスタンスに状態を保持するためコピーする
+        model_admin = copy.copy(buskingSite._registry[Postcode])    # pylint: disable = protected-access
+        model_admin.user_name = 'benchmark_postcode'
+        benchmark = getattr(self, f'benchmark_{options["target"]}')
+        if options['target'] == 'validate':
+            benchmark(model_admin, options)
+            return
+
+        # 合成行を登録して計測し、最後にロールバックする(既存の行はそのまま対象になる)
+        try:
+            with transaction.atomic():
+                self.create_rows(model_admin, options['rows'])
+                benchmark(model_admin, options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    @staticmethod
+    def create_rows(model_admin, count: int) -> None:
+        field_names = model_admin.get_csv_field_names()
+        rows = (Postcode(**dict(zip(field_names, synthetic_row(n))), updater=model_admin.user_name)
+                for n in range(count))
+        Postcode.objects.bulk_create(rows, batch_size=model_admin.chunk_size)
+
+    def benchmark_validate(self, model_admin, options):
+        """
+        取り込みの行ごとの入力チェック(csv2model、ModelForm、Uniqueチェック)の1行あたりの時間
+        DBには保存しない、Uniqueチェックの問い合わせは含む
+        """
+        field_names = model_admin.get_csv_field_names()
+        csv_logs = [CsvLog(row_no=n, row_content=dict(zip(field_names, synthetic_row(n))))
+                    for n in range(options['rows'])]
+        # pylint: disable = protected-access
+        validate = model_admin._CsvUploadMixin__validate_by_modelform
+        started = time.perf_counter()
+        for csv_log in csv_logs:
+            validate(csv_log)
+        elapsed = time.perf_counter() - started
+        errors = sum(1 for csv_log in csv_logs if csv_log.log_level == CsvLog.ERROR)
+        self.stdout.write(f'validate: {len(csv_logs)} rows, {elapsed * 1000 / len(csv_logs):.3f} ms/row '
+                          f'({errors} errors)')
+
+    def benchmark_download(self, model_admin, options):
+        """CSV出力の行データの生成(問い合わせを含む)の1秒あたりの行数、CSVの書き出しは含まない"""
+        if options['pagination']:
+            model_admin.pagination = CsvPagination(options['pagination'])
+        started = time.perf_counter()
+        count = sum(1 for _row in model_admin.generate_csv_data(Postcode.objects.all()))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'download: {count} rows in {elapsed:.2f} s, {count / elapsed:,.0f} rows/sec '
+                          f'(pagination {model_admin.pagination}, chunk_size {model_admin.chunk_size})')
+
+    def benchmark_search(self, model_admin, options):
+        """
+        住所補完の前方一致検索の応答時間、ORMの問い合わせとPostcodeIndexを同じ検索条件で比較する
+        インデックスの作成時間と、作成したインデックスのメモリ使用量(tracemalloc)も出力する
+        """
+        # pylint: disable = unused-argument
+        started = time.perf_counter()
+        index = PostcodeIndexCache().build()
+        self.stdout.write(f'build: {len(index)} rows in {time.perf_counter() - started:.2f} s')
+        tracemalloc.start()
+        index = PostcodeIndexCache().build()
+        self.stdout.write(f'index size: {tracemalloc.get_traced_memory()[0] / 1024 / 1024:.1f} MB')
+        tracemalloc.stop()
+
+        limit = options['limit']
+        generator = random.Random(0)
+        samples = list(Postcode.objects.exclude(postcode=None).values_list('postcode', 'choiki_name'))
+        queries = [generator.choice(samples) for _n in range(options['queries'])]
+        postcodes = [postcode[:generator.randint(3, 7)] for (postcode, _) in queries]
+        names = [name[:generator.randint(2, 4)] for (_, name) in queries]
+        queryset = Postcode.objects.order_by('postcode', 'choiki_kana').values(*SEARCH_FIELDS)
+
+        self.write_latency('postcode prefix  ORM', postcodes,
+                           lambda prefix: list(queryset.filter(postcode__startswith=prefix)[:limit]))
+        self.write_latency('postcode prefix  index', postcodes,
+                           lambda prefix: index.search(postcode=prefix, limit=limit))
+        self.write_latency('town name prefix ORM', names,
+                           lambda prefix: list(queryset.filter(choiki_name__startswith=prefix)[:limit]))
+        self.write_latency('town name prefix index', names,
+                           lambda prefix: index.search(choiki_name=prefix, limit=limit))
+
+    def write_latency(self, label: str, prefixes: List[str], search: Callable[[str], list]) -> None:
+        elapsed = []
+        for prefix in prefixes:
+            started = time.perf_counter()
+            search(prefix)
+            elapsed.append(time.perf_counter() - started)
+        if len(elapsed) < 2:
+            elapsed *= 2      # quantiles()は2件以上必要
+        percentiles = quantiles(elapsed, n=100)
+        self.stdout.write(f'{label}: p50 {self.format_seconds(percentiles[49])} '
+                          f'p95 {self.format_seconds(percentiles[94])} p99 {self.format_seconds(percentiles[98])}')
+
+    @staticmethod
+    def format_seconds(seconds: float) -> str:
+        return f'{seconds * 1000:.1f} ms' if seconds >= 0.001 else f'{seconds * 1000000:.0f} us'
@@ -0,0 +1,47 @@
+import copy
+import os
+import re
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from busking.admin import buskingSite
+from cmm_data.models import Postcode
+
+
+# 日本郵便の差分ファイル名、ADD_YYMM.CSV / DEL_YYMM.CSV
+DIFF_FILE_PATTERN = re.compile(r'(ADD|DEL)_(\d{4})\.CSV', flags=re.IGNORECASE)
+
+
+def get_diff_file_order(path: str):
+    """年月順、同じ年月では削除ファイルを先に処理する(変更された町域は削除と追加の両方に含まれるため)"""
+    match = DIFF_FILE_PATTERN.fullmatch(os.path.basename(path))
+    if match is None:
+        raise CommandError(f'{path} is not a Japan Post diff file (ADD_YYMM.CSV or DEL_YYMM.CSV).')
+    return match.group(2), 0 if match.group(1).upper() == 'DEL' else 1
+
+
+class Command(BaseCommand):
+    help = 'Apply Japan Post monthly diff files (ADD_YYMM.CSV / DEL_YYMM.CSV) to Postcode.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Diff files, applied by month with DEL before ADD.')
+        parser.add_argument('--encoding', default='cp932', help='File encoding (default: cp932).')
+        parser.add_argument('--user', default='load_postcode_diff', help='User name recorded as the updater.')
+
+    def handle(self, *args, **options):
+        for path in sorted(options['files'], key=get_diff_file_order):
+            # PostcodeAdminの取り込み処理を使う、インスタンスにファイルごとの状態を保持するためコピーする
+            model_admin = copy.copy(buskingSite._registry[Postcode])    # pylint: disable = protected-access
+            model_admin.encoding = options['encoding']
+            model_admin.user_name = options['user']
+            with open(path, 'rb') as csv_file:
+                model_admin.csv_file = File(csv_file, name=os.path.basename(path))
+                lot_key = f'{model_admin.csv_file.name}{model_admin.user_name}{timezone.now()}'
+                model_admin.lot_number = str(hash(lot_key))
+                model_admin.read_csv_file()
+
+            summary = model_admin.lot_summary
+            self.stdout.write(f'{os.path.basename(path)}: inserted {summary.inserted_count}, '
+                              f'updated {summary.updated_count}, deleted {summary.deleted_count}, '
+                              f'skipped {summary.skipped_count}, errors {summary.error_count} '
+                              f'(lot {model_admin.lot_number})')
@@ -0,0 +1,153 @@
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+from django.db.models import Count, Max
+from cmm.cache import StampedCache
+from cmm_data.models import Postcode
+
+
+POSTCODE_LENGTH = 7
+# 前方一致検索の上限、これより大きい文字はない
+_MAX_CHAR = '\U0010ffff'
+_HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in range(ord('ぁ'), ord('ゖ') + 1)}
+
+
+def normalize_name(name: str) -> str:
+    """検索キー用に正規化する、半角カナは全角に、ひらがなはカタカナにそろえる"""
+    return unicodedata.normalize('NFKC', name).translate(_HIRAGANA_TO_KATAKANA)
+
+
+def prefix_range(keys, prefix) -> Tuple[int, int]:
+    """ソート済みのkeysで、prefixに前方一致する範囲"""
+    return bisect_left(keys, prefix), bisect_left(keys, prefix + _MAX_CHAR)
+
+
+class PostcodeIndex:
+    """
+    Postcodeを読み込んだ検索用のインデックス、作成後は変更しない
+    行は郵便番号順に並べ、列ごとの配列で保持する(郵便番号はarray('I')、市区町村の名称は市区町村コードから引く)
+    """
+
+    def __init__(self, rows: Iterable[Tuple[str, str, str, str, str, str, str, str]]):
+        postcodes = array('I')
+        codes: List[str] = []
+        choiki_names: List[str] = []
+        choiki_kanas: List[str] = []
+        # 市区町村コード -> (都道府県名, 市区町村名, 都道府県名カナ, 市区町村名カナ)
+        self.shikuchoson: Dict[str, Tuple[str, str, str, str]] = {}
+        by_shikuchoson: Dict[str, array] = {}
+
+        for (postcode, code, todofuken_name, shikuchoson_name, choiki_name,
+             todofuken_kana, shikuchoson_kana, choiki_kana) in rows:
+            if not postcode or not postcode.isdigit() or len(postcode) != POSTCODE_LENGTH:
+                continue
+            code = sys.intern(code)
+            if code not in self.shikuchoson:
+                self.shikuchoson[code] = (todofuken_name, shikuchoson_name, todofuken_kana, shikuchoson_kana)
+                by_shikuchoson[code] = array('I')
+            by_shikuchoson[code].append(len(postcodes))
+            postcodes.append(int(postcode))
+            codes.append(code)
+            choiki_names.append(choiki_name)
+            choiki_kanas.append(choiki_kana)
+
+        self.postcodes = postcodes
+        self.codes = tuple(codes)
+        self.choiki_names = tuple(choiki_names)
+        self.choiki_kanas = tuple(choiki_kanas)
+        self.by_shikuchoson = by_shikuchoson
+        self.name_keys, self.name_order = self.__sort_keys(choiki_names)
+        self.kana_keys, self.kana_order = self.__sort_keys(choiki_kanas)
+
+    @staticmethod
+    def __sort_keys(names: List[str]) -> Tuple[Tuple[str, ...], array]:
+        """町域名の前方一致検索用に、正規化した名称と行番号を名称順に並べる"""
+        keys = sorted((normalize_name(name), i) for (i, name) in enumerate(names))
+        return tuple(key for (key, _i) in keys), array('I', (i for (_key, i) in keys))
+
+    def __len__(self) -> int:
+        return len(self.postcodes)
+
+    def get_row(self, i: int) -> dict:
+        todofuken_name, shikuchoson_name, todofuken_kana, shikuchoson_kana = self.shikuchoson[self.codes[i]]
+        return {
+            'postcode': f'{self.postcodes[i]:0{POSTCODE_LENGTH}d}',
+            'shikuchoson_code': self.codes[i],
+            'todofuken_name': todofuken_name,
+            'shikuchoson_name': shikuchoson_name,
+            'choiki_name': self.choiki_names[i],
+            'todofuken_kana': todofuken_kana,
+            'shikuchoson_kana': shikuchoson_kana,
+            'choiki_kana': self.choiki_kanas[i],
+        }
+
+    def search_postcode(self, prefix: str, limit: int, shikuchoson_code: Optional[str] = None) -> Iterator[int]:
+        """郵便番号の前方一致、ハイフンは無視する、shikuchoson_codeを指定した場合はその市区町村内で検索する"""
+        prefix = prefix.replace('-', '')
+        if not prefix.isdigit() or len(prefix) > POSTCODE_LENGTH:
+            return
+        scale = 10 ** (POSTCODE_LENGTH - len(prefix))
+        start = bisect_left(self.postcodes, int(prefix) * scale)
+        end = bisect_left(self.postcodes, (int(prefix) + 1) * scale, lo=start)
+        yield from self.__limit(range(start, end), limit, shikuchoson_code)
+
+    def search_shikuchoson(self, shikuchoson_code: str, limit: int) -> Iterator[int]:
+        return iter(self.by_shikuchoson.get(shikuchoson_code, array('I'))[:limit])
+
+    def search_choiki(self, prefix: str, limit: int, is_kana: bool = False,
+                      shikuchoson_code: Optional[str] = None) -> Iterator[int]:
+        """町域名(漢字またはカナ)の前方一致、shikuchoson_codeを指定した場合はその市区町村内で検索する"""
+        keys, order = (self.kana_keys, self.kana_order) if is_kana else (self.name_keys, self.name_order)
+        start, end = prefix_range(keys, normalize_name(prefix))
+        return self.__limit((order[k] for k in range(start, end)), limit, shikuchoson_code)
+
+    def __limit(self, rows: Iterable[int], limit: int, shikuchoson_code: Optional[str]) -> Iterator[int]:
+        """行番号をlimit件まで返す、shikuchoson_codeを指定した場合はその市区町村の行のみ返す"""
+        count = 0
+        for i in rows:
+            if count >= limit:
+                return
+            if shikuchoson_code and self.codes[i] != shikuchoson_code:
+                continue
+            yield i
+            count += 1
+
+    def search(self, postcode: Optional[str] = None, shikuchoson_code: Optional[str] = None,
+               choiki_name: Optional[str] = None, choiki_kana: Optional[str] = None, limit: int = 20) -> List[dict]:
+        if limit <= 0:
+            return []
+        rows: Iterator[int]
+        if postcode:
+            rows = self.search_postcode(postcode, limit, shikuchoson_code=shikuchoson_code)
+        elif choiki_kana:
+            rows = self.search_choiki(choiki_kana, limit, is_kana=True, shikuchoson_code=shikuchoson_code)
+        elif choiki_name:
+            rows = self.search_choiki(choiki_name, limit, shikuchoson_code=shikuchoson_code)
+        elif shikuchoson_code:
+            rows = self.search_shikuchoson(shikuchoson_code, limit)
+        else:
+            return []
+        return [self.get_row(i) for i in rows]
+
+
+class PostcodeIndexCache(StampedCache[PostcodeIndex]):
+    """
+    PostcodeIndexのプロセス内キャッシュ、件数と最終更新日時が変わった場合に作り直す
+    CSVインポート後はrefresh()で作り直し、他のプロセスはcheck_interval秒以内に追従する
+    """
+
+    def get_stamp(self) -> Hashable:
+        stamp = Postcode.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+        return stamp['count'], stamp['updated_at']
+
+    def build(self) -> PostcodeIndex:
+        return PostcodeIndex(
+            Postcode.objects.order_by('postcode', 'choiki_kana')
+            .values_list('postcode', 'shikuchoson_code', 'todofuken_name', 'shikuchoson_name', 'choiki_name',
+                         'todofuken_kana', 'shikuchoson_kana', 'choiki_kana')
+            .iterator(chunk_size=10000))
+
+
+postcode_index = PostcodeIndexCache()
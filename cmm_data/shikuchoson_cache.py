@@ -0,0 +1,58 @@
+from typing import Dict, Hashable, NamedTuple, Optional
+from django.db.models import Count, Max
+from cmm.cache import StampedCache
+from cmm_data.models import Shikuchoson
+
+
+class ShikuchosonEntry(NamedTuple):
+    todofuken_name: str
+    shikuchoson_name: str
+    todofuken_kana: str
+    shikuchoson_kana: str
+
+
+class Todofuken(NamedTuple):
+    todofuken_name: str
+    todofuken_kana: str
+
+
+class ShikuchosonTable:
+    """市区町村コードと都道府県コード(市区町村コードの上2桁)から名称を引く、作成後は変更しない"""
+
+    def __init__(self, shikuchoson: Dict[str, ShikuchosonEntry]):
+        self.shikuchoson = shikuchoson
+        self.todofuken: Dict[str, Todofuken] = {}
+        for (code, entry) in shikuchoson.items():
+            self.todofuken.setdefault(code[:2], Todofuken(entry.todofuken_name, entry.todofuken_kana))
+
+    def __contains__(self, shikuchoson_code) -> bool:
+        return shikuchoson_code in self.shikuchoson
+
+    def __len__(self) -> int:
+        return len(self.shikuchoson)
+
+    def get(self, shikuchoson_code: str) -> Optional[ShikuchosonEntry]:
+        return self.shikuchoson.get(shikuchoson_code)
+
+    def get_todofuken(self, todofuken_code: str) -> Optional[Todofuken]:
+        return self.todofuken.get(todofuken_code[:2])
+
+
+class ShikuchosonCache(StampedCache[ShikuchosonTable]):
+    """
+    Shikuchosonのプロセス内キャッシュ、件数と最終更新日時が変わった場合に作り直す
+    Postcodeの取り込み時の市区町村コードのチェック、一覧表示で使い、行ごとにShikuchosonを検索しない
+    """
+
+    def get_stamp(self) -> Hashable:
+        stamp = Shikuchoson.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+        return stamp['count'], stamp['updated_at']
+
+    def build(self) -> ShikuchosonTable:
+        return ShikuchosonTable({
+            code: ShikuchosonEntry(*names) for (code, *names) in
+            Shikuchoson.objects.values_list('shikuchoson_code', 'todofuken_name', 'shikuchoson_name',
+                                            'todofuken_kana', 'shikuchoson_kana')})
+
+
+shikuchoson_cache = ShikuchosonCache()
@@ -1,3 +1,351 @@
-from django.test import TestCase
+import copy
+import json
+from io import BytesIO, StringIO
+import pytest
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser
+from django.core.files import File
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory
+from busking.admin import buskingSite
+from cmm.csv import CsvLog
+from cmm.models import AuthUser
+from cmm_data import views
+from cmm_data.ken_all import merge_continued_choiki
+from cmm_data.management.commands.load_postcode_diff import get_diff_file_order
+from cmm_data.models import ChangeTypeChoices, Postcode, Shikuchoson
+from cmm_data.postcode_index import PostcodeIndex, PostcodeIndexCache, normalize_name
+from cmm_data.shikuchoson_cache import shikuchoson_cache
 
-# Create your tests here.
+
+# (郵便番号, 市区町村コード, 都道府県名, 市区町村名, 町域名, 都道府県名カナ, 市区町村名カナ, 町域名カナ)
+POSTCODE_ROWS = [
+    ('0600000', '01101', '北海道', '札幌市中央区', '以下に掲載がない場合', 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ', 'ｲｶﾆｹｲｻｲｶﾞﾅｲﾊﾞｱｲ'),
+    ('0640941', '01101', '北海道', '札幌市中央区', '旭ケ丘', 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ', 'ｱｻﾋｶﾞｵｶ'),
+    ('0600041', '01101', '北海道', '札幌市中央区', '大通東', 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ', 'ｵｵﾄﾞｵﾘﾋｶﾞｼ'),
+    ('0600042', '01101', '北海道', '札幌市中央区', '大通西', 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ', 'ｵｵﾄﾞｵﾘﾆｼ'),
+    ('0600001', '01102', '北海道', '札幌市北区', '北一条', 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼｷﾀｸ', 'ｷﾀ1ｼﾞｮｳ'),
+    ('1000001', '13101', '東京都', '千代田区', '千代田', 'ﾄｳｷｮｳﾄ', 'ﾁﾖﾀﾞｸ', 'ﾁﾖﾀﾞ'),
+]
+
+
+def make_index(rows=None) -> PostcodeIndex:
+    return PostcodeIndex(sorted(rows or POSTCODE_ROWS))
+
+
+def postcodes(results) -> list:
+    return [row['postcode'] for row in results]
+
+
+def test_normalize_name():
+    assert normalize_name('ｵｵﾄﾞｵﾘ') == 'オオドオリ'
+    assert normalize_name('おおどおり') == 'オオドオリ'
+
+
+def test_postcode_index_search_postcode():
+    index = make_index()
+    assert postcodes(index.search(postcode='06000')) == ['0600000', '0600001', '0600041', '0600042']
+    # ハイフンは無視する
+    assert postcodes(index.search(postcode='060-0041')) == ['0600041']
+    assert postcodes(index.search(postcode='1')) == ['1000001']
+    assert not index.search(postcode='9')
+    assert not index.search(postcode='abc')
+    assert not index.search(postcode='12345678')
+    # 市区町村コードで絞り込む
+    assert postcodes(index.search(postcode='060', shikuchoson_code='01102')) == ['0600001']
+
+
+def test_postcode_index_search_choiki():
+    index = make_index()
+    assert postcodes(index.search(choiki_name='大通')) == ['0600041', '0600042']
+    # カナは半角、全角、ひらがなのいずれでも検索できる、カナ順(ニシ、ヒガシ)
+    assert postcodes(index.search(choiki_kana='ｵｵﾄﾞｵﾘ')) == ['0600042', '0600041']
+    assert postcodes(index.search(choiki_kana='おおどおりに')) == ['0600042']
+    assert postcodes(index.search(choiki_kana='ﾁﾖﾀﾞ', shikuchoson_code='01101')) == []
+    assert postcodes(index.search(choiki_kana='ﾁﾖﾀﾞ', shikuchoson_code='13101')) == ['1000001']
+
+
+def test_postcode_index_search_shikuchoson():
+    index = make_index()
+    assert postcodes(index.search(shikuchoson_code='01101')) == ['0600000', '0600041', '0600042', '0640941']
+    assert index.search(shikuchoson_code='01102')[0] == {
+        'postcode': '0600001', 'shikuchoson_code': '01102', 'todofuken_name': '北海道',
+        'shikuchoson_name': '札幌市北区', 'choiki_name': '北一条', 'todofuken_kana': 'ﾎｯｶｲﾄﾞｳ',
+        'shikuchoson_kana': 'ｻｯﾎﾟﾛｼｷﾀｸ', 'choiki_kana': 'ｷﾀ1ｼﾞｮｳ',
+    }
+    assert not index.search()
+
+
+def test_postcode_index_search_limit():
+    index = make_index([(f'{n:07d}', '01101', '北海道', '札幌市中央区', f'町域{n}', 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ',
+                         f'ﾁｮｳｲｷ{n}') for n in range(1000000, 1000150)])
+    assert len(index) == 150
+    assert len(index.search(postcode='1', limit=120)) == 120
+    assert len(index.search(choiki_kana='ﾁｮｳｲｷ', limit=30)) == 30
+    assert len(index.search(shikuchoson_code='01101', limit=5)) == 5
+    assert not index.search(postcode='1', limit=0)
+
+
+@pytest.fixture
+def postcode_search_index(monkeypatch):
+    for (postcode, code, todofuken_name, shikuchoson_name, choiki_name,
+         todofuken_kana, shikuchoson_kana, choiki_kana) in POSTCODE_ROWS:
+        Postcode(postcode=postcode, shikuchoson_code=code, todofuken_name=todofuken_name,
+                 shikuchoson_name=shikuchoson_name, choiki_name=choiki_name, todofuken_kana=todofuken_kana,
+                 shikuchoson_kana=shikuchoson_kana, choiki_kana=choiki_kana, updater='py_tester').save()
+    for n in range(1000100, 1000250):
+        Postcode(postcode=f'{n:07d}', shikuchoson_code='13101', todofuken_name='東京都', shikuchoson_name='千代田区',
+                 choiki_name=f'町域{n}', todofuken_kana='ﾄｳｷｮｳﾄ', shikuchoson_kana='ﾁﾖﾀﾞｸ', choiki_kana=f'ﾁｮｳｲｷ{n}',
+                 updater='py_tester').save()
+    monkeypatch.setattr(views, 'postcode_index', PostcodeIndexCache())
+
+
+def search_request(user=None, **params):
+    request = RequestFactory().get('/api/postcode/search/', params)
+    request.user = user or AuthUser.objects.create_user(username='py_tester', password='your_password')
+    return request
+
+
+@pytest.mark.django_db
+def test_postcode_search_view(postcode_search_index):
+    response = views.postcode_search(search_request(postcode='060', shikuchoson_code='01101'))
+    assert response.status_code == 200
+    assert postcodes(json.loads(response.content)['results']) == ['0600000', '0600041', '0600042']
+
+    response = views.postcode_search(search_request(user=AuthUser.objects.get(), choiki_name='大通西'))
+    assert json.loads(response.content)['results'][0]['choiki_name'] == '大通西'
+
+
+@pytest.mark.django_db
+def test_postcode_search_view_limit(postcode_search_index):
+    response = views.postcode_search(search_request(postcode='1', limit='1000'))
+    assert len(json.loads(response.content)['results']) == views.MAX_SEARCH_LIMIT
+
+    response = views.postcode_search(search_request(user=AuthUser.objects.get(), postcode='1', limit='x'))
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_postcode_search_view_login_required(postcode_search_index):
+    response = views.postcode_search(search_request(user=AnonymousUser(), postcode='060'))
+    assert response.status_code == 401
+    assert 'error' in json.loads(response.content)
+
+
+def ken_all_row(postcode: str, choiki_kana: str, choiki_name: str) -> list:
+    """KEN_ALL.CSVの1行、町域名と町域名カナ以外は固定値"""
+    return ['01101', '060  ', postcode, 'ﾎｯｶｲﾄﾞｳ', 'ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ', choiki_kana, '北海道', '札幌市中央区', choiki_name,
+            '0', '0', '0', '0', '0', '0']
+
+
+def merged_choiki(rows) -> list:
+    return [(row_no, row[2], row[5], row[8]) for (row_no, row) in merge_continued_choiki(enumerate(rows, 1))]
+
+
+def test_merge_continued_choiki_two_lines():
+    rows = [ken_all_row('0600000', 'ｲｶﾆｹｲｻｲｶﾞﾅｲﾊﾞｱｲ', '以下に掲載がない場合'),
+            ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ(1-19ﾁｮｳﾒ)', '大通西（１〜１９丁目）'),
+            ken_all_row('0640820', 'ｵｵﾄﾞｵﾘﾆｼ(20-28ﾁｮｳﾒ)', '大通西（２０〜２８丁目、'),
+            ken_all_row('0640820', 'ｵｵﾄﾞｵﾘﾆｼ(20-28ﾁｮｳﾒ)', '３０丁目）')]
+    # カナは分割されずに同じ値が繰り返されるため、つなげない
+    assert merged_choiki(rows) == [
+        (1, '0600000', 'ｲｶﾆｹｲｻｲｶﾞﾅｲﾊﾞｱｲ', '以下に掲載がない場合'),
+        (2, '0600042', 'ｵｵﾄﾞｵﾘﾆｼ(1-19ﾁｮｳﾒ)', '大通西（１〜１９丁目）'),
+        (3, '0640820', 'ｵｵﾄﾞｵﾘﾆｼ(20-28ﾁｮｳﾒ)', '大通西（２０〜２８丁目、３０丁目）'),
+    ]
+
+
+def test_merge_continued_choiki_three_lines():
+    rows = [ken_all_row('0482402', 'ｵｵｴ(1ﾁｮｳﾒ', '大江（１丁目、２丁目「６５１、'),
+            ken_all_row('0482402', '2ﾁｮｳﾒ651', '６６２、６６８番地」以外、'),
+            ken_all_row('0482402', '3ﾁｮｳﾒ)', '３丁目）'),
+            ken_all_row('0482403', 'ｵｵｴﾑﾗ', '大江村')]
+    assert merged_choiki(rows) == [
+        (1, '0482402', 'ｵｵｴ(1ﾁｮｳﾒ2ﾁｮｳﾒ6513ﾁｮｳﾒ)', '大江（１丁目、２丁目「６５１、６６２、６６８番地」以外、３丁目）'),
+        (4, '0482403', 'ｵｵｴﾑﾗ', '大江村'),
+    ]
+
+
+def test_merge_continued_choiki_unterminated():
+    # 括弧が閉じないまま郵便番号が変わった場合、ファイルが終わった場合も行を落とさずに出力する
+    rows = [ken_all_row('0600001', 'ｷﾀ1ｼﾞｮｳ(', '北一条（'),
+            ken_all_row('0600002', 'ｷﾀ2ｼﾞｮｳ', '北二条'),
+            ken_all_row('0600003', 'ｷﾀ3ｼﾞｮｳ(', '北三条（'),
+            ken_all_row('0600003', 'ﾆｼ', '西')]
+    assert merged_choiki(rows) == [
+        (1, '0600001', 'ｷﾀ1ｼﾞｮｳ(', '北一条（'),
+        (2, '0600002', 'ｷﾀ2ｼﾞｮｳ', '北二条'),
+        (3, '0600003', 'ｷﾀ3ｼﾞｮｳ(ﾆｼ', '北三条（西'),
+    ]
+
+
+def test_merge_continued_choiki_pass_through():
+    rows = [ken_all_row('0600041', 'ｵｵﾄﾞｵﾘﾋｶﾞｼ', '大通東'), ['short', 'row'],
+            ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ(1-19ﾁｮｳﾒ)', '大通西（１〜１９丁目）')]
+    merged = list(merge_continued_choiki(enumerate(rows, 1)))
+    assert merged == list(enumerate(rows, 1))
+    assert merged[0][1] is rows[0]
+
+
+def write_diff_file(path, rows) -> str:
+    path.write_bytes(''.join(','.join(f'"{v}"' for v in row) + '\r\n' for row in rows).encode('cp932'))
+    return str(path)
+
+
+def test_get_diff_file_order():
+    paths = ['ADD_2310.CSV', '/tmp/DEL_2310.CSV', 'add_2309.csv', 'DEL_2309.CSV']
+    # 年月順、同じ年月では削除ファイルが先
+    assert sorted(paths, key=get_diff_file_order) == ['DEL_2309.CSV', 'add_2309.csv', '/tmp/DEL_2310.CSV',
+                                                      'ADD_2310.CSV']
+    with pytest.raises(CommandError):
+        get_diff_file_order('KEN_ALL.CSV')
+
+
+@pytest.mark.django_db
+def test_load_postcode_diff(tmp_path):
+    files = [
+        write_diff_file(tmp_path / 'ADD_2310.CSV', [ken_all_row('0600043', 'ｵｵﾄﾞｵﾘﾆｼ', '大通西'),
+                                                    ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ', '大通西')]),
+        write_diff_file(tmp_path / 'DEL_2310.CSV', [ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ', '大通西')]),
+        write_diff_file(tmp_path / 'ADD_2309.CSV', [ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ', '大通西'),
+                                                    ken_all_row('0600041', 'ｵｵﾄﾞｵﾘﾋｶﾞｼ', '大通東')]),
+    ]
+    stdout = StringIO()
+    call_command('load_postcode_diff', *files, stdout=stdout)
+
+    # 2309の追加、2310の削除、2310の追加の順に処理するため、2310で削除してから追加した行が残る
+    lines = stdout.getvalue().splitlines()
+    assert [line.split(':')[0] for line in lines] == ['ADD_2309.CSV', 'DEL_2310.CSV', 'ADD_2310.CSV']
+    assert 'inserted 2,' in lines[0] and 'deleted 1,' in lines[1] and 'inserted 2,' in lines[2]
+    assert sorted(Postcode.objects.values_list('postcode', flat=True)) == ['0600041', '0600042', '0600043']
+    assert Postcode.objects.get(postcode='0600042').updater == 'load_postcode_diff'
+
+    # 登録済みのPostcodeAdminはファイルごとの状態を持たない
+    assert not hasattr(buskingSite._registry[Postcode], 'lot_number')     # pylint: disable = protected-access
+
+
+@pytest.mark.django_db
+def test_load_postcode_diff_abolition(tmp_path):
+    call_command('load_postcode_diff', write_diff_file(tmp_path / 'ADD_2309.CSV', [
+        ken_all_row('0600041', 'ｵｵﾄﾞｵﾘﾋｶﾞｼ', '大通東'), ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ', '大通西')]),
+        stdout=StringIO())
+
+    # 追加ファイルでも、更新の表示が廃止(2)の行は削除する
+    abolished = ken_all_row('0600042', 'ｵｵﾄﾞｵﾘﾆｼ', '大通西')
+    abolished[13] = str(ChangeTypeChoices.ABOLITION.value)
+    stdout = StringIO()
+    call_command('load_postcode_diff', write_diff_file(tmp_path / 'ADD_2310.CSV', [abolished]), stdout=stdout)
+    assert 'deleted 1,' in stdout.getvalue()
+    assert list(Postcode.objects.values_list('postcode', flat=True)) == ['0600041']
+
+
+def test_load_postcode_diff_invalid_file_name(tmp_path):
+    with pytest.raises(CommandError):
+        call_command('load_postcode_diff', write_diff_file(tmp_path / 'KEN_ALL.CSV', []))
+
+
+@pytest.fixture
+def shikuchoson_master():
+    Shikuchoson(shikuchoson_code='01101', todofuken_name='北海道', shikuchoson_name='札幌市中央区',
+                todofuken_kana='ﾎｯｶｲﾄﾞｳ', shikuchoson_kana='ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ', updater='py_tester').save()
+    shikuchoson_cache.invalidate()
+    yield
+    shikuchoson_cache.invalidate()
+
+
+def import_csv(model, file_name: str, content: str) -> admin.ModelAdmin:
+    model_admin = copy.copy(buskingSite._registry[model])      # pylint: disable = protected-access
+    model_admin.csv_file = File(BytesIO(content.encode(model_admin.encoding)), name=file_name)
+    model_admin.user_name = 'py_tester'
+    model_admin.lot_number = file_name
+    model_admin.read_csv_file()
+    return model_admin
+
+
+def postcode_csv(*rows) -> str:
+    return ''.join(','.join(row) + '\n' for row in rows)
+
+
+@pytest.mark.django_db
+def test_shikuchoson_table(shikuchoson_master):
+    table = shikuchoson_cache.get()
+    assert len(table) == 1 and '01101' in table and '01102' not in table
+    assert table.get('01101').shikuchoson_name == '札幌市中央区'
+    assert table.get('01102') is None
+    assert table.get_todofuken('01000').todofuken_name == '北海道'
+    assert table.get_todofuken('13101') is None
+
+
+@pytest.mark.django_db
+def test_postcode_validate_shikuchoson_code(shikuchoson_master):
+    unknown = ken_all_row('0600001', 'ｷﾀ1ｼﾞｮｳ', '北一条')
+    unknown[0] = '01102'
+    model_admin = import_csv(Postcode, 'postcode.csv',
+                             postcode_csv(ken_all_row('0600041', 'ｵｵﾄﾞｵﾘﾋｶﾞｼ', '大通東'), unknown))
+
+    # マスタにある市区町村コードは登録し、ない市区町村コードはエラーにする
+    assert list(Postcode.objects.values_list('postcode', flat=True)) == ['0600041']
+    error = CsvLog.objects.get(lot_number=model_admin.lot_number, log_level=CsvLog.ERROR)
+    assert error.row_no == 2
+    assert '01102' in error.message
+
+    postcode_admin = buskingSite._registry[Postcode]       # pylint: disable = protected-access
+    assert postcode_admin.shikuchoson_master(Postcode.objects.get()) == '北海道札幌市中央区'
+    assert postcode_admin.shikuchoson_master(Postcode(shikuchoson_code='01102')) == '-'
+
+
+@pytest.mark.django_db
+def test_postcode_validate_shikuchoson_code_after_shikuchoson_import(shikuchoson_master):
+    row = ken_all_row('0600001', 'ｷﾀ1ｼﾞｮｳ', '北一条')
+    row[0] = '01102'
+    # 取得済みのキャッシュはcheck_interval秒間stampを確認しない
+    shikuchoson_cache.get()
+    import_csv(Postcode, 'postcode1.csv', postcode_csv(row))
+    assert not Postcode.objects.exists()
+
+    # 市区町村の取り込み後の処理でキャッシュを作り直させるため、再起動せずに新しい市区町村コードを受け付ける
+    import_csv(Shikuchoson, 'shikuchoson.csv', '01102,北海道,札幌市北区,ﾎｯｶｲﾄﾞｳ,ｻｯﾎﾟﾛｼｷﾀｸ\n')
+    assert '01102' in shikuchoson_cache.get()
+    import_csv(Postcode, 'postcode2.csv', postcode_csv(row))
+    assert Postcode.objects.filter(shikuchoson_code='01102').exists()
+
+
+@pytest.mark.django_db
+def test_shikuchoson_reimport_increments_version(shikuchoson_master):
+    # BULKで上書きした既存行もversionを加算し、取り込み前の画面からの更新を排他エラーにする
+    import_csv(Shikuchoson, 'shikuchoson.csv', ('01101,北海道,札幌市中央区2,ﾎｯｶｲﾄﾞｳ,ｻｯﾎﾟﾛｼﾁｭｳｵｳｸ\n'
+                                                '01102,北海道,札幌市北区,ﾎｯｶｲﾄﾞｳ,ｻｯﾎﾟﾛｼｷﾀｸ\n'))
+    updated = Shikuchoson.objects.get(shikuchoson_code='01101')
+    assert (updated.shikuchoson_name, updated.version) == ('札幌市中央区2', 2)
+    assert Shikuchoson.objects.get(shikuchoson_code='01102').version == 1
+
+
+@pytest.mark.django_db
+def test_benchmark_postcode_validate():
+    stdout = StringIO()
+    call_command('benchmark_postcode', 'validate', '--rows', '10', stdout=stdout)
+    assert stdout.getvalue().startswith('validate: 10 rows, ')
+    assert '(0 errors)' in stdout.getvalue()
+    assert not Postcode.objects.exists()
+
+
+@pytest.mark.django_db
+def test_benchmark_postcode_download():
+    stdout = StringIO()
+    call_command('benchmark_postcode', 'download', '--rows', '30', '--pagination', 'offset', stdout=stdout)
+    assert stdout.getvalue().startswith('download: 30 rows in ')
+    assert '(pagination offset, ' in stdout.getvalue()
+    # 合成行はロールバックする
+    assert not Postcode.objects.exists()
+
+
+@pytest.mark.django_db
+def test_benchmark_postcode_search():
+    stdout = StringIO()
+    call_command('benchmark_postcode', 'search', '--rows', '30', '--queries', '5', stdout=stdout)
+    lines = stdout.getvalue().splitlines()
+    assert lines[0].startswith('build: 30 rows in ')
+    assert [line.split(':')[0] for line in lines[2:]] == [
+        'postcode prefix  ORM', 'postcode prefix  index', 'town name prefix ORM', 'town name prefix index']
+    assert not Postcode.objects.exists()
@@ -0,0 +1,8 @@
+from django.urls import path
+from cmm_data import views
+
+
+app_name = 'cmm_data'
+urlpatterns = [
+    path('postcode/search/', views.postcode_search, name='postcode_search'),
+]
@@ -1,3 +1,30 @@
-from django.shortcuts import render
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.views.decorators.http import require_GET
+from cmm_data.postcode_index import postcode_index
 
-# Create your views here.
+
+# 1回の検索で返す最大件数
+MAX_SEARCH_LIMIT = 100
+
+
+@require_GET
+def postcode_search(request):
+    """
+    住所入力の補完用の郵便番号検索、DBは参照せずにプロセス内のPostcodeIndexを検索する
+    postcode(前方一致)、choiki_name/choiki_kana(前方一致)、shikuchoson_codeのいずれかを指定する
+    postcode、choiki_name/choiki_kanaと同時にshikuchoson_codeを指定した場合は、その市区町村内で検索する
+    ログインユーザーのみ利用できる、未ログインの場合はログイン画面へのリダイレクトではなく401を返す
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required.'}, status=401)
+    try:
+        limit = min(int(request.GET.get('limit') or 20), MAX_SEARCH_LIMIT)
+    except ValueError:
+        return HttpResponseBadRequest('limit must be an integer.')
+
+    results = postcode_index.get().search(postcode=request.GET.get('postcode'),
+                                          shikuchoson_code=request.GET.get('shikuchoson_code'),
+                                          choiki_name=request.GET.get('choiki_name'),
+                                          choiki_kana=request.GET.get('choiki_kana'),
+                                          limit=limit)
+    return JsonResponse({'results': results}, json_dumps_params={'ensure_ascii': False})